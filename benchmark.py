@@ -0,0 +1,979 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Performance benchmarks for EasyDAV.
+
+Usage: python benchmark.py [options] [benchmark name ...]
+
+Runs the named benchmarks, or all of them if no names are given, and
+prints the results as a JSON object keyed by benchmark name. Run with
+--help for the options that control the size of the synthetic data.
+
+The 'handlers' benchmark builds a synthetic tree in a temporary
+directory and sends requests for every method in
+webdav.request_handlers, both directly to webdav.main and through a
+local server, with and without a lock database. For each
+request type it reports requests per second, median and 99th
+percentile latency, the number of file system calls per request and
+the peak resident set size of the process.
+
+The 'put' benchmark writes a large upload from a file to disk and
+reports the throughput and CPU time of the upload write path.
+
+The 'copy' benchmark copies a large file with each copy method of
+fileops and a tree of small files with and without threads, in each of
+the directories given with --copy-dirs.
+
+The 'locks' benchmark runs the lock queries of a PUT and of a directory
+DELETE against lock databases of different sizes, with the query of
+older versions and with the indexed query of LockManager.get_locks().
+
+The 'startup' benchmark runs OPTIONS and PROPFIND requests in new
+interpreters, as under CGI, and reports the time to the first byte of
+the response and the import time of each module.
+'''
+
+import __builtin__
+import httplib
+import json
+import logging
+import os
+import os.path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from optparse import OptionParser
+from StringIO import StringIO
+
+import davxml
+
+def measure(function, repeat = 3, setup = None):
+    '''Call function repeat times and return the best time in seconds.
+    Setup is an optional function called untimed before each call.
+    '''
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def percentile(values, percent):
+    '''Return the given percentile of a list of numbers.'''
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def peak_rss_kb():
+    '''Return the peak resident set size of this process in kilobytes.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        usage //= 1024 # Reported in bytes on Mac OS X
+    return usage
+
+def make_propstats(count):
+    '''Generate (real_url, propstats) tuples resembling an allprop
+    PROPFIND listing of count resources.
+    '''
+    collection = [ET.Element('{DAV:}collection')]
+    results = []
+    for i in range(count):
+        if i % 10 == 0:
+            resourcetype = collection
+        else:
+            resourcetype = ''
+        results.append(('http://localhost/dir/file%20' + str(i), {
+            '200 OK': [
+                ('{DAV:}creationdate', '2012-01-01T12:00:00Z'),
+                ('{DAV:}getlastmodified', 'Sun, 01 Jan 2012 12:00:00 +0000'),
+                ('{DAV:}getcontenttype', 'text/plain'),
+                ('{DAV:}getcontentlength', str(i)),
+                ('{DAV:}resourcetype', resourcetype),
+                ('{DAV:}getetag', '"1325419200.0S' + str(i) + '"'),
+            ],
+            '404 Not Found: Property': [('{urn:example}custom', '')],
+        }))
+    return results
+
+# The multistatus.kid template used before davxml, for comparison.
+KID_MULTISTATUS = '''<?xml version="1.0" encoding="utf-8" ?>
+<?python import kid.parser ?>
+<D:multistatus xmlns:D="DAV:" xmlns:py="http://purl.org/kid/ns#">
+    <D:response py:for="real_url, propstats in result_files">
+        <D:href py:content="real_url" />
+        <D:propstat py:for="status, props in propstats.items()">
+            <D:prop>
+                <element py:for="prop, value in props" py:strip="">
+                    <?python
+                        if isinstance(value, basestring):
+                            value  = [(kid.parser.TEXT, value)]
+                        else:
+                            value = [(kid.parser.START, e) for e in value] + [
+                                     (kid.parser.END, e) for e in value]
+                    ?>
+                    <element py:replace="kid.parser.ElementStream(
+                        [(kid.parser.START, kid.Element(prop))]
+                        + value
+                        + [(kid.parser.END, kid.Element(prop))])" />
+                </element>
+            </D:prop>
+            <D:status>HTTP/1.1 ${status}</D:status>
+        </D:propstat>
+    </D:response>
+</D:multistatus>
+'''
+
+def bench_multistatus(options, count = 10000):
+    '''Render a multistatus document of count resources with davxml and
+    with the old Kid template.
+    '''
+    results = make_propstats(count)
+    
+    def render_davxml():
+        parts = [davxml.MULTISTATUS_START]
+        for real_url, propstats in results:
+            parts.append(davxml.response(real_url, propstats))
+        parts.append(davxml.MULTISTATUS_END)
+        return ''.join(parts)
+    
+    output = {'resources': count, 'davxml_seconds': measure(render_davxml)}
+    
+    try:
+        import kid
+    except ImportError:
+        return output
+    
+    template = kid.Template(source = KID_MULTISTATUS, result_files = results)
+    output['kid_seconds'] = measure(
+        lambda: template.serialize(output = 'xml'), 1)
+    output['speedup'] = output['kid_seconds'] / output['davxml_seconds']
+    return output
+
+def load_config(root_dir):
+    '''Load webdavconfig, or the defaults from webdavconfig.py.example if
+    there is no configuration file, and point it to root_dir.
+    Must be called before webdav is imported.
+    '''
+    try:
+        import webdavconfig as config
+    except ImportError:
+        import imp
+        config = imp.new_module('webdavconfig')
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'webdavconfig.py.example')
+        exec open(path).read() in config.__dict__
+        sys.modules['webdavconfig'] = config
+    
+    config.root_dir = root_dir
+    config.root_url = None
+    config.log_file = None
+    config.log_level = logging.CRITICAL
+    
+    # Measure complete listings instead of the truncation.
+    config.propfind_max_resources = None
+    config.propfind_time_limit = None
+    return config
+
+class CallCounter:
+    '''Counts calls to the os module functions that access the file
+    system, and to open(). The counts only include calls made while
+    active is True.
+    '''
+    os_functions = ['stat', 'lstat', 'fstat', 'listdir', 'open', 'read',
+                    'write', 'close', 'unlink', 'rmdir', 'mkdir', 'rename',
+                    'utime', 'chmod', 'access', 'fsync']
+    
+    def __init__(self):
+        self.active = False
+        self.counts = {}
+        self._originals = []
+    
+    def _wrap(self, module, name, label):
+        original = getattr(module, name)
+        counts = self.counts
+        
+        def wrapper(*args, **kwargs):
+            if self.active:
+                counts[label] = counts.get(label, 0) + 1
+            return original(*args, **kwargs)
+        
+        self._originals.append((module, name, original))
+        setattr(module, name, wrapper)
+    
+    def install(self):
+        '''Replace the counted functions with wrappers.'''
+        import davutils
+        for name in self.os_functions:
+            if hasattr(os, name):
+                self._wrap(os, name, name)
+        self._wrap(__builtin__, 'open', 'builtin open')
+        if davutils.scandir is not None:
+            self._wrap(davutils, 'scandir', 'scandir')
+    
+    def uninstall(self):
+        '''Restore the original functions.'''
+        for module, name, original in reversed(self._originals):
+            setattr(module, name, original)
+        self._originals = []
+    
+    def take(self):
+        '''Return the counts so far and reset them.'''
+        counts = self.counts.copy()
+        self.counts.clear()
+        return counts
+
+def make_environ(method, path, body, headers):
+    '''Construct a WSGI environment for a request.'''
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    
+    for name, value in headers.items():
+        name = name.upper().replace('-', '_')
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = value
+    
+    return environ
+
+class InProcessClient:
+    '''Sends requests directly to a WSGI application.'''
+    def __init__(self, app):
+        self.app = app
+        self.host = 'localhost'
+    
+    def request(self, method, path, body = '', headers = {}):
+        '''Perform a request and return (status, response headers).
+        The response body is read and discarded.
+        '''
+        response = {}
+        def start_response(status, response_headers, exc_info = None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict((k.lower(), v)
+                                       for k, v in response_headers)
+        
+        result = self.app(make_environ(method, path, body, headers),
+                          start_response)
+        try:
+            for data in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        
+        return response['status'], response['headers']
+    
+    def close(self):
+        pass
+
+class ServerClient:
+    '''Sends requests over HTTP to the stand-alone server of webdav.py,
+    running the WSGI application in a background thread.
+    '''
+    def __init__(self, app):
+        from wsgi_server import make_server, SendfileRequestHandler
+        
+        class QuietHandler(SendfileRequestHandler):
+            def log_message(self, *args):
+                pass
+        
+        self.server = make_server('127.0.0.1', 0, app,
+                                  handler_class = QuietHandler)
+        self.port = self.server.server_address[1]
+        self.host = '127.0.0.1:%d' % self.port
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def request(self, method, path, body = '', headers = {}):
+        '''Perform a request and return (status, response headers).'''
+        connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            while response.read(65536):
+                pass
+            return response.status, dict(response.getheaders())
+        finally:
+            connection.close()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def build_tree(root_dir, options):
+    '''Create the synthetic data set used by the handler benchmarks.'''
+    flat = os.path.join(root_dir, 'flat')
+    os.mkdir(flat)
+    for i in range(options.flat_files):
+        open(os.path.join(flat, 'file%06d.txt' % i), 'w').write('x' * 100)
+    
+    def make_deep(path, level):
+        os.mkdir(path)
+        for i in range(4):
+            open(os.path.join(path, 'file%d.txt' % i), 'w').write('y' * 1000)
+        if level < options.deep_levels:
+            for i in range(2):
+                make_deep(os.path.join(path, 'dir%d' % i), level + 1)
+    
+    make_deep(os.path.join(root_dir, 'deep'), 1)
+    
+    block = 'z' * (1024 * 1024)
+    large = open(os.path.join(root_dir, 'large.bin'), 'wb')
+    for i in range(options.large_mb):
+        large.write(block)
+    large.close()
+    
+    open(os.path.join(root_dir, 'small.txt'), 'w').write('hello world\n' * 100)
+
+LOCK_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+    + '<D:lockinfo xmlns:D="DAV:"><D:lockscope><D:exclusive/></D:lockscope>'
+    + '<D:locktype><D:write/></D:locktype><D:owner>benchmark</D:owner>'
+    + '</D:lockinfo>')
+
+PROPPATCH_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+    + '<D:propertyupdate xmlns:D="DAV:" xmlns:B="urn:benchmark"><D:set>'
+    + '<D:prop><B:counter>%d</B:counter></D:prop></D:set></D:propertyupdate>')
+
+MULTIPART_BOUNDARY = 'easydavbenchmarkboundary'
+
+def multipart_upload(filename, data):
+    '''Return (body, content type) for a HTML interface upload.'''
+    body = ('--' + MULTIPART_BOUNDARY + '\r\n'
+        + 'Content-Disposition: form-data; name="file"; filename="'
+        + filename + '"\r\n'
+        + 'Content-Type: application/octet-stream\r\n\r\n'
+        + data + '\r\n--' + MULTIPART_BOUNDARY + '--\r\n')
+    content_type = 'multipart/form-data; boundary=' + MULTIPART_BOUNDARY
+    return body, content_type
+
+def handler_scenarios(scratch, host, locking):
+    '''Return a list of (name, weight, prepare, request, statuses) for the
+    handler benchmarks. Request is a function of the iteration number that
+    returns (method, path, body, headers). Prepare is None or a function
+    taking the iteration number and an in-process client, run before each
+    request without timing. Statuses lists the expected response statuses.
+    Requests that write go under the collection scratch. Weight 0 marks
+    scenarios that are run only a few times.
+    
+    Host is the host and port that the client connects to, used in the
+    Destination headers. LOCK and UNLOCK are left out if locking is False.
+    '''
+    def depth(value):
+        return {'Depth': value}
+    
+    def create_file(name):
+        def prepare(i, client):
+            client.request('PUT', scratch + name % i, 'data')
+        return prepare
+    
+    unlock_tokens = {}
+    def prepare_unlock(i, client):
+        client.request('PUT', scratch + 'unlock%d' % i, 'data')
+        status, headers = client.request('LOCK', scratch + 'unlock%d' % i,
+            LOCK_BODY, depth('0'))
+        unlock_tokens[i] = headers.get('lock-token', '')
+    
+    upload, upload_type = multipart_upload('upload.bin', 'u' * 10000)
+    destination = 'http://' + host + scratch
+    
+    scenarios = [
+        ('OPTIONS', 1, None,
+            lambda i: ('OPTIONS', '/', '', {}), [200]),
+        ('PROPFIND depth 0 file', 1, None,
+            lambda i: ('PROPFIND', '/small.txt', '', depth('0')), [207]),
+        ('PROPFIND depth 1 flat', 0, None,
+            lambda i: ('PROPFIND', '/flat/', '', depth('1')), [207]),
+        ('PROPFIND depth infinity deep', 0, None,
+            lambda i: ('PROPFIND', '/deep/', '', depth('infinity')), [207]),
+        ('PROPPATCH', 1, None,
+            lambda i: ('PROPPATCH', '/small.txt', PROPPATCH_BODY % i, {}),
+            [207]),
+        ('GET small file', 1, None,
+            lambda i: ('GET', '/small.txt', '', {}), [200]),
+        ('GET large file', 0, None,
+            lambda i: ('GET', '/large.bin', '', {}), [200]),
+        ('HEAD small file', 1, None,
+            lambda i: ('HEAD', '/small.txt', '', {}), [200]),
+        ('GET directory index', 1, None,
+            lambda i: ('GET', '/deep/', '', {}), [200]),
+        ('PUT small file', 1, None,
+            lambda i: ('PUT', scratch + 'put%d' % i, 'p' * 10000, {}),
+            [201]),
+        ('MKCOL', 1, None,
+            lambda i: ('MKCOL', scratch + 'mkcol%d' % i, '', {}), [201]),
+        ('DELETE file', 1, create_file('delete%d'),
+            lambda i: ('DELETE', scratch + 'delete%d' % i, '', {}), [204]),
+        ('COPY file', 1, None,
+            lambda i: ('COPY', '/small.txt', '', {
+                'Destination': destination + 'copy%d' % i}), [201, 204]),
+        ('MOVE file', 1, create_file('move%d'),
+            lambda i: ('MOVE', scratch + 'move%d' % i, '', {
+                'Destination': destination + 'moved%d' % i}), [201, 204]),
+        ('POST upload', 1, None,
+            lambda i: ('POST', scratch, upload,
+                {'Content-Type': upload_type}), [200]),
+    ]
+    
+    if locking:
+        scenarios += [
+            ('LOCK', 1, create_file('lock%d'),
+                lambda i: ('LOCK', scratch + 'lock%d' % i, LOCK_BODY,
+                           depth('0')), [200]),
+            ('UNLOCK', 1, prepare_unlock,
+                lambda i: ('UNLOCK', scratch + 'unlock%d' % i, '', {
+                    'Lock-Token': unlock_tokens[i]}), [204]),
+        ]
+    
+    return scenarios
+
+def run_scenario(client, setup_client, counter, prepare, request, count,
+                 expected):
+    '''Send count requests and return the statistics as a dictionary.
+    Raises an exception if a response status is not in expected, so that
+    error responses are not mistaken for fast requests.
+    '''
+    latencies = []
+    statuses = {}
+    counter.take()
+    
+    for i in range(count):
+        if prepare is not None:
+            prepare(i, setup_client)
+        
+        method, path, body, headers = request(i)
+        counter.active = True
+        start = time.time()
+        status, response_headers = client.request(method, path, body, headers)
+        latencies.append(time.time() - start)
+        counter.active = False
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        
+        if status not in expected:
+            raise Exception('Unexpected status %d for %s %s' % (
+                status, method, path))
+    
+    calls = counter.take()
+    return {
+        'requests': count,
+        'statuses': statuses,
+        'requests_per_second': count / sum(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'fs_calls_per_request': float(sum(calls.values())) / count,
+        'fs_calls': calls,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+def bench_handlers(options):
+    '''Benchmark every request handler through the selected transports,
+    with and without a lock database.
+    '''
+    root_dir = tempfile.mkdtemp(prefix = 'easydav-benchmark-')
+    config = load_config(root_dir)
+    lock_db = config.lock_db or '.easydav_locks'
+    
+    # Kid finds the templates relative to the working directory.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import webdav
+    
+    counter = CallCounter()
+    setup_client = InProcessClient(webdav.main)
+    output = {
+        'tree': {
+            'flat_files': options.flat_files,
+            'deep_levels': options.deep_levels,
+            'large_mb': options.large_mb,
+        },
+        'results': {},
+    }
+    
+    try:
+        start = time.time()
+        build_tree(root_dir, options)
+        output['tree']['build_seconds'] = time.time() - start
+        
+        counter.install()
+        for transport in options.transports.split(','):
+            for locking in [True, False]:
+                if locking:
+                    config.lock_db = lock_db
+                    mode = transport + '/lock_db'
+                else:
+                    config.lock_db = None
+                    mode = transport + '/no_lock_db'
+                
+                scratch = '/scratch-' + mode.replace('/', '-') + '/'
+                setup_client.request('MKCOL', scratch)
+                
+                if transport == 'server':
+                    client = ServerClient(webdav.main)
+                else:
+                    client = InProcessClient(webdav.main)
+                
+                try:
+                    scenarios = handler_scenarios(scratch, client.host, locking)
+                    for name, weight, prepare, request, expected in scenarios:
+                        if weight:
+                            count = options.requests
+                        else:
+                            count = options.heavy_requests
+                        
+                        result = run_scenario(client, setup_client, counter,
+                                              prepare, request, count, expected)
+                        output['results'][mode + '/' + name] = result
+                        
+                        if options.verbose:
+                            sys.stderr.write('%s/%s: %.1f req/s\n' % (
+                                mode, name, result['requests_per_second']))
+                finally:
+                    client.close()
+    finally:
+        counter.uninstall()
+        shutil.rmtree(root_dir)
+    
+    return output
+
+def bench_put(options):
+    '''Write a large upload to disk with the old fixed block size path
+    and with webdav.write_file, reporting throughput and CPU time.
+    '''
+    root_dir = tempfile.mkdtemp(prefix = 'easydav-benchmark-')
+    config = load_config(root_dir)
+    
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import davutils
+    import webdav
+    from wsgi_input_wrapper import WSGIInputWrapper
+    
+    size = options.upload_mb * 1024 * 1024
+    source_path = os.path.join(root_dir, 'source')
+    dest_path = os.path.join(root_dir, 'dest')
+    block = os.urandom(1024 * 1024)
+    source = open(source_path, 'wb')
+    for i in range(options.upload_mb):
+        source.write(block)
+    source.close()
+    
+    def write_legacy(source):
+        dest = open(dest_path, 'wb')
+        try:
+            davutils.write_blocks(dest, davutils.read_blocks(source, size))
+        finally:
+            dest.close()
+    
+    def write_new(source):
+        environ = {'wsgi.input': source, 'CONTENT_LENGTH': str(size)}
+        webdav.write_file(dest_path, WSGIInputWrapper(environ), size)
+    
+    output = {'upload_mb': options.upload_mb}
+    try:
+        for name, function in [('legacy', write_legacy),
+                               ('write_file', write_new)]:
+            best = None
+            for i in range(3):
+                source = open(source_path, 'rb')
+                before = resource.getrusage(resource.RUSAGE_SELF)
+                start = time.time()
+                function(source)
+                elapsed = time.time() - start
+                after = resource.getrusage(resource.RUSAGE_SELF)
+                source.close()
+                
+                cpu = (after.ru_utime - before.ru_utime
+                       + after.ru_stime - before.ru_stime)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu)
+                os.unlink(dest_path)
+            
+            output[name] = {
+                'seconds': best[0],
+                'mb_per_second': options.upload_mb / best[0],
+                'cpu_seconds': best[1],
+            }
+            if options.verbose:
+                sys.stderr.write('put/%s: %.1f MB/s\n' % (
+                    name, output[name]['mb_per_second']))
+    finally:
+        shutil.rmtree(root_dir)
+    
+    return output
+
+def filesystem_type(path):
+    '''Return the type of the file system mounted at or above path, as
+    listed in /proc/mounts, or None if it is not known.
+    '''
+    path = os.path.realpath(path)
+    best = ('', None)
+    try:
+        for line in open('/proc/mounts'):
+            fields = line.split()
+            mountpoint = fields[1].replace('\\040', ' ')
+            if (path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) \
+                    and len(mountpoint) >= len(best[0]):
+                best = (mountpoint, fields[2])
+    except IOError:
+        pass
+    return best[1]
+
+def bench_copy(options):
+    '''Copy a large file with each fileops method and a tree of small
+    files with shutil.copytree and fileops.copy_tree, in each of the
+    directories given with --copy-dirs.
+    '''
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import fileops
+    
+    directories = options.copy_dirs.split(',')
+    if not options.copy_dirs:
+        directories = [tempfile.gettempdir()]
+    
+    output = {}
+    for directory in directories:
+        scratch = tempfile.mkdtemp(prefix = 'easydav-benchmark-', dir = directory)
+        result = {'filesystem': filesystem_type(scratch),
+                  'copy_mb': options.copy_mb, 'files': options.copy_files}
+        try:
+            source = os.path.join(scratch, 'source')
+            block = os.urandom(1024 * 1024)
+            outfile = open(source, 'wb')
+            for i in range(options.copy_mb):
+                outfile.write(block)
+            outfile.close()
+            
+            dest = os.path.join(scratch, 'dest')
+            def remove_dest():
+                if os.path.exists(dest):
+                    os.unlink(dest)
+            
+            for method in fileops.METHODS:
+                copy = lambda: fileops.copy_file(source, dest, [method])
+                try:
+                    elapsed = measure(copy, setup = remove_dest)
+                except ValueError:
+                    result[method] = 'not supported'
+                    continue
+                
+                result[method] = {'seconds': elapsed,
+                                  'mb_per_second': options.copy_mb / elapsed}
+            os.unlink(source)
+            os.unlink(dest)
+            
+            tree = os.path.join(scratch, 'tree')
+            for i in range(options.copy_files):
+                subdir = os.path.join(tree, str(i // 100))
+                if i % 100 == 0:
+                    os.makedirs(subdir)
+                open(os.path.join(subdir, str(i)), 'wb').write(block[:64 * 1024])
+            
+            copy_dest = os.path.join(scratch, 'copy')
+            copiers = [
+                ('copytree', lambda: shutil.copytree(tree, copy_dest, True)),
+                ('copy_tree_1', lambda: fileops.copy_tree(tree, copy_dest, 1)),
+                ('copy_tree_8', lambda: fileops.copy_tree(tree, copy_dest, 8)),
+            ]
+            def remove_copy():
+                if os.path.exists(copy_dest):
+                    shutil.rmtree(copy_dest)
+            
+            for name, function in copiers:
+                elapsed = measure(function, setup = remove_copy)
+                result[name] = {'seconds': elapsed,
+                                'files_per_second': options.copy_files / elapsed}
+        finally:
+            shutil.rmtree(scratch)
+        
+        if options.verbose:
+            sys.stderr.write('copy/%s: %s\n' % (directory, result))
+        output[directory] = result
+    
+    return output
+
+def legacy_get_locks(lockmanager, rel_path, recursive):
+    '''The get_locks() query of older versions, which scans the table.'''
+    path_exprs = ['path = ?']
+    path_args = [rel_path]
+    
+    partial_path = rel_path
+    while partial_path:
+        partial_path = os.path.dirname(partial_path)
+        path_exprs.append('(infinite_depth AND path = ?)')
+        path_args.append(partial_path)
+    
+    if recursive:
+        prefix = rel_path + '/'
+        path_exprs.append('SUBSTR(path,1,?) = ?')
+        path_args += [len(prefix), prefix]
+    
+    lockmanager.db_cursor.execute('SELECT * FROM locks WHERE '
+        + ' OR '.join(path_exprs), path_args)
+    return lockmanager.db_cursor.fetchall()
+
+def bench_locks(options):
+    '''Query lock databases of each size in --lock-counts with the old
+    and the new get_locks() queries, reporting the median time per query.
+    '''
+    import datetime
+    import random
+    root_dir = tempfile.mkdtemp(prefix = 'easydav-benchmark-')
+    config = load_config(root_dir)
+    import lock_manager
+    
+    valid_until = datetime.datetime.utcnow() + datetime.timedelta(days = 1)
+    output = {}
+    try:
+        for count in [int(value) for value in options.lock_counts.split(',')]:
+            config.lock_db = 'locks-%d.db' % count
+            mgr = lock_manager.LockManager()
+            
+            # Locks on files in a tree of 100 directories with 10
+            # subdirectories each, like many sync clients holding locks.
+            # Every tenth subdirectory has an infinite depth lock.
+            rows = []
+            for i in range(count):
+                path = 'dir%d/sub%d/file%d' % (i % 100, i // 100 % 10, i)
+                infinite = i < 1000 and i % 10 == 0
+                if infinite:
+                    path = os.path.dirname(path)
+                rows.append(('urn:uuid:%d' % i, path, True, '', infinite,
+                             valid_until))
+            mgr.db_cursor.execute('BEGIN')
+            mgr.db_cursor.executemany(
+                'INSERT INTO locks VALUES (?,?,?,?,?,?)', rows)
+            mgr.db_cursor.execute('COMMIT')
+            del rows
+            
+            random.seed(count)
+            queries = [
+                # Write check of a PUT to a new file
+                ('file', lambda: 'dir%d/sub%d/new%d' % (random.randrange(100),
+                    random.randrange(10), random.randrange(count)), False),
+                # DELETE or MOVE of a directory
+                ('subtree', lambda: 'dir%d/sub%d' % (random.randrange(100),
+                    random.randrange(10)), True),
+            ]
+            
+            result = {}
+            for name, make_path, recursive in queries:
+                for variant, function in [('legacy', legacy_get_locks),
+                        ('indexed', lock_manager.LockManager.get_locks)]:
+                    times = []
+                    for i in range(options.requests):
+                        path = make_path()
+                        start = time.time()
+                        function(mgr, path, recursive)
+                        times.append(time.time() - start)
+                    result[name + '_' + variant + '_ms'] = \
+                        percentile(times, 50) * 1000
+            
+            if options.verbose:
+                sys.stderr.write('locks/%d: %s\n' % (count, result))
+            output[str(count)] = result
+    finally:
+        shutil.rmtree(root_dir)
+    
+    return output
+
+# Script run in a new interpreter for each request of the startup
+# benchmark, like webdav.cgi. Arguments are the configuration file, the
+# root directory and 'imports' to report import times to stderr.
+STARTUP_SCRIPT = '''
+import sys
+import time
+start = time.time()
+
+if sys.argv[3] == 'imports':
+    import __builtin__
+    times = {}
+    stack = []
+    real_import = __builtin__.__import__
+    
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return real_import(name, *args, **kwargs)
+        
+        stack.append(0.0)
+        begin = time.time()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - begin
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if name not in times:
+                times[name] = {'cumulative': elapsed, 'self': elapsed - children}
+    
+    __builtin__.__import__ = timed_import
+
+import imp
+config = imp.new_module('webdavconfig')
+exec open(sys.argv[1]).read() in config.__dict__
+config.root_dir = sys.argv[2]
+config.log_file = None
+sys.modules['webdavconfig'] = config
+
+from wsgiref.handlers import CGIHandler
+import webdav
+CGIHandler().run(webdav.main)
+
+if sys.argv[3] == 'imports':
+    __builtin__.__import__ = real_import
+    import json
+    sys.stderr.write(json.dumps(times))
+'''
+
+def bench_startup(options):
+    '''Measure the time from starting a new interpreter to the first byte
+    of the response, like under CGI, and the import time of each module.
+    The modules are compiled first, as in an installation where the
+    .pyc files have been written.
+    '''
+    import compileall
+    import subprocess
+    root_dir = tempfile.mkdtemp(prefix = 'easydav-benchmark-')
+    mypath = os.path.dirname(os.path.abspath(__file__))
+    config_path = os.path.join(mypath, 'webdavconfig.py.example')
+    compileall.compile_dir(mypath, maxlevels = 0, quiet = True)
+    
+    requests = {
+        'OPTIONS': {'REQUEST_METHOD': 'OPTIONS'},
+        'PROPFIND_depth0': {'REQUEST_METHOD': 'PROPFIND', 'HTTP_DEPTH': '0'},
+    }
+    
+    def run(method, mode):
+        environ = dict(os.environ)
+        environ.update({
+            'SCRIPT_NAME': '/webdav.cgi',
+            'PATH_INFO': '/',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_LENGTH': '0',
+            'LC_CTYPE': 'en_US.UTF-8',
+        })
+        environ.update(requests[method])
+        
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, '-c', STARTUP_SCRIPT, config_path, root_dir, mode],
+            cwd = mypath, env = environ, stdin = open(os.devnull),
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        first_byte = process.stdout.read(1)
+        elapsed = time.time() - start
+        output, errors = process.communicate()
+        
+        if not first_byte.startswith('S') or process.returncode != 0:
+            raise Exception('Startup benchmark request failed: ' + errors)
+        return elapsed, errors
+    
+    output = {}
+    try:
+        for method in sorted(requests.keys()):
+            times = [run(method, 'time')[0] for i in range(options.startup_runs)]
+            output[method] = {
+                'median_first_byte_ms': percentile(times, 50) * 1000,
+                'min_first_byte_ms': min(times) * 1000,
+            }
+            if options.verbose:
+                sys.stderr.write('startup/%s: %.1f ms\n' % (
+                    method, output[method]['median_first_byte_ms']))
+        
+        imports = json.loads(run('PROPFIND_depth0', 'imports')[1])
+        output['imports_ms'] = dict([(name, {
+                'cumulative': round(value['cumulative'] * 1000, 2),
+                'self': round(value['self'] * 1000, 2)})
+            for name, value in imports.items()])
+    finally:
+        shutil.rmtree(root_dir)
+    
+    return output
+
+benchmarks = {
+    'multistatus': bench_multistatus,
+    'handlers': bench_handlers,
+    'put': bench_put,
+    'copy': bench_copy,
+    'locks': bench_locks,
+    'startup': bench_startup,
+}
+
+def main(argv):
+    '''Run the benchmarks named in argv and print the results as JSON.'''
+    parser = OptionParser(usage = '%prog [options] [benchmark name ...]')
+    parser.add_option('--requests', type = 'int', default = 100,
+        help = 'Requests per request type [default: %default]')
+    parser.add_option('--heavy-requests', type = 'int', default = 3,
+        help = 'Requests for large listings and downloads [default: %default]')
+    parser.add_option('--flat-files', type = 'int', default = 100000,
+        help = 'Files in the flat directory [default: %default]')
+    parser.add_option('--deep-levels', type = 'int', default = 8,
+        help = 'Levels in the binary directory tree [default: %default]')
+    parser.add_option('--large-mb', type = 'int', default = 64,
+        help = 'Size of the large file in megabytes [default: %default]')
+    parser.add_option('--upload-mb', type = 'int', default = 2048,
+        help = 'Size of the upload in the put benchmark [default: %default]')
+    parser.add_option('--copy-mb', type = 'int', default = 1024,
+        help = 'Size of the file in the copy benchmark [default: %default]')
+    parser.add_option('--copy-files', type = 'int', default = 10000,
+        help = 'Files in the tree in the copy benchmark [default: %default]')
+    parser.add_option('--copy-dirs', default = '',
+        help = 'Comma separated directories to run the copy benchmark in, '
+               'such as a tmpfs and a loop mounted ext4 or XFS image '
+               '[default: the temporary directory]')
+    parser.add_option('--lock-counts', default = '1000,10000,100000,1000000',
+        help = 'Comma separated sizes of the lock database in the locks '
+               'benchmark [default: %default]')
+    parser.add_option('--startup-runs', type = 'int', default = 20,
+        help = 'Interpreter starts per request type [default: %default]')
+    parser.add_option('--transports', default = 'inprocess,server',
+        help = 'Comma separated list of inprocess, server [default: %default]')
+    parser.add_option('-v', '--verbose', action = 'store_true',
+        help = 'Print progress to stderr')
+    options, names = parser.parse_args(argv)
+    
+    for name in names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: ' + name
+                + ', choose from ' + ', '.join(sorted(benchmarks.keys())))
+    
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+    }
+    for name in names or sorted(benchmarks.keys()):
+        results[name] = benchmarks[name](options)
+    print json.dumps(results, indent = 2, sort_keys = True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
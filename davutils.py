@@ -4,11 +4,28 @@
 tests.
 '''
 
-import mimetypes
+import binascii
+import errno
 import time
+import os
 import os.path
 import re
-from fnmatch import fnmatchcase
+import stat
+import sys
+from fnmatch import fnmatchcase, translate
+from mime_types import MIME_TYPES
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Prefix for the names of files that EasyDAV creates for its own use,
+# such as uploads in progress. These are never visible to clients.
+INTERNAL_PREFIX = '.easydav-'
 
 class DAVError(Exception):
     '''A protocol exception that is passed to client through HTTP.
@@ -59,11 +76,222 @@ def read_blocks(source, count = None, blocksize = 1024*1024):
         
         yield data
 
+class FileRange(object):
+    '''Response body that sends count bytes of an open file, starting
+    at offset, or the rest of the file if count is None. The file is
+    closed when the server calls close() on the body.
+    
+    Can be returned as a WSGI iterable, or given to wsgi.file_wrapper.
+    It deliberately has no fileno(), so that servers don't send past the
+    end of the range. Servers that know this class can use the source,
+    offset and count attributes to send the data with sendfile().
+    '''
+    def __init__(self, source, offset = 0, count = None,
+                 blocksize = 1024*1024):
+        self.source = source
+        self.offset = offset
+        self.count = count
+        self.blocksize = blocksize
+        self._remaining = count
+        source.seek(offset)
+    
+    def read(self, size = -1):
+        '''Read at most size bytes, stopping at the end of the range.'''
+        if self._remaining is not None:
+            if size < 0 or size > self._remaining:
+                size = self._remaining
+        
+        data = self.source.read(size)
+        
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+    
+    def __iter__(self):
+        return read_blocks(self, None, self.blocksize)
+    
+    def close(self):
+        self.source.close()
+
+class ClosingIterator(object):
+    '''Wraps a WSGI response iterable so that the function close is
+    called when the server closes the response, even if the iterable
+    was never iterated.
+    '''
+    def __init__(self, iterable, close):
+        self.iterable = iterable
+        self._close = close
+    
+    def __iter__(self):
+        return iter(self.iterable)
+    
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self._close()
+
+def copy_stream(source, dest, length = None,
+                min_blocksize = 64*1024, max_blocksize = 4*1024*1024,
+                digest = None):
+    '''Copy data from file object source to file object dest until end
+    of file, or until length bytes have been copied. If digest is given,
+    it is a hashlib object that is updated with the data.
+    Returns the number of bytes copied. Dest must not keep a reference
+    to the data passed to its write(), as the buffer is reused.
+    
+    If source has readinto(), the data goes through a single reusable
+    buffer. The block size starts at min_blocksize and doubles up to
+    max_blocksize while the source keeps filling whole blocks, so that
+    fast sources are copied with few large reads and slow ones don't
+    waste memory.
+    '''
+    copied = 0
+    blocksize = min_blocksize
+    
+    if length is not None:
+        blocksize = max(1, min(blocksize, length))
+    
+    if not hasattr(source, 'readinto') or sys.version_info < (2, 7):
+        # Memoryview is not available before Python 2.7
+        for block in read_blocks(source, length, max_blocksize):
+            dest.write(block)
+            if digest is not None:
+                digest.update(block)
+            copied += len(block)
+        return copied
+    
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while length is None or copied < length:
+        if length is not None and length - copied < len(buf):
+            count = source.readinto(view[:length - copied])
+        else:
+            count = source.readinto(buf)
+        
+        if not count:
+            break # End of file
+        
+        if count == len(buf):
+            data = buf
+        else:
+            data = buffer(buf, 0, count)
+        
+        dest.write(data)
+        if digest is not None:
+            digest.update(data)
+        copied += count
+        
+        if count == len(buf) and len(buf) < max_blocksize:
+            blocksize = min(len(buf) * 2, max_blocksize)
+            if length is not None:
+                blocksize = max(1, min(blocksize, length - copied))
+            if blocksize > len(buf):
+                buf = bytearray(blocksize)
+                view = memoryview(buf)
+    
+    return copied
+
+# Content-Length comes from the client, so no more than this is reserved
+# before the data has actually arrived.
+PREALLOCATE_LIMIT = 256*1024*1024
+
+def _find_fallocate():
+    '''Return a function fallocate(fd, offset, length) or None if it is
+    not available. This is the Linux fallocate() system call, which fails
+    with EOPNOTSUPP on file systems that can't preallocate. Unlike it,
+    posix_fallocate() of the C library would fall back to writing every
+    block of the file, which is slower than not preallocating at all.
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        import ctypes
+        function = ctypes.CDLL(None, use_errno = True).fallocate64
+    except (ImportError, OSError, AttributeError):
+        return None
+    
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                         ctypes.c_int64]
+    function.restype = ctypes.c_int
+    
+    def fallocate(fd, offset, length):
+        if function(fd, 0, offset, length) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    return fallocate
+
+_fallocate = None
+
+def preallocate(fd, length):
+    '''Reserve length bytes of disk space for the file open as fd, so that
+    the file system can allocate it contiguously. At most PREALLOCATE_LIMIT
+    bytes are reserved. Raises DAVError if the disk is full. Does nothing
+    if the platform or file system does not support preallocation.
+    '''
+    global _fallocate
+    if _fallocate is None:
+        _fallocate = _find_fallocate() or False
+    
+    if not _fallocate or length <= 0:
+        return
+    
+    try:
+        _fallocate(fd, 0, min(length, PREALLOCATE_LIMIT))
+    except OSError, e:
+        if e.errno in (errno.ENOSPC, errno.EFBIG):
+            raise DAVError('507 Insufficient Storage')
+        # Other errors mean that preallocation is not supported.
+
 def write_blocks(dest, blocks):
     '''Write a series of blocks to open file object.'''
     for block in blocks:
         dest.write(block)
 
+def create_temp_file(directory, prefix = INTERNAL_PREFIX + 'tmp-'):
+    '''Create a new file with a random name in directory and return
+    a tuple (path, file object opened for writing). Unlike tempfile,
+    the file gets the normal permissions for new files, as it will be
+    renamed to its final name.
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    
+    while True:
+        path = os.path.join(directory, prefix + binascii.hexlify(os.urandom(8)))
+        try:
+            fd = os.open(path, flags, 0666)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        return path, os.fdopen(fd, 'wb')
+
+def fsync_directory(directory):
+    '''Flush the directory entries of directory to disk, so that
+    a renamed or created file stays after a crash.
+    '''
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(source, dest):
+    '''Rename source to dest, replacing dest if it exists. On POSIX
+    systems the replacement is atomic.
+    '''
+    try:
+        os.rename(source, dest)
+    except OSError:
+        # Windows does not allow renaming over an existing file.
+        if os.name != 'nt' or not os.path.exists(dest):
+            raise
+        os.unlink(dest)
+        os.rename(source, dest)
+
 def path_inside_directory(path, root):
     '''Check if path is inside root directory.
     '''
@@ -91,6 +319,32 @@ def get_relpath(path, root):
     assert path_parts[:len(root_parts)] == root_parts
     return os.path.sep.join(path_parts[len(root_parts):])
 
+# Characters that quote_url() leaves unescaped, the same as urllib.quote().
+_URL_SAFE = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+             '0123456789_.-/')
+_URL_QUOTED = dict([(chr(i), '%%%02X' % i) for i in range(256)]
+                   + [(c, c) for c in _URL_SAFE])
+
+def quote_url(path):
+    '''Escape a byte string path for use in an URL, like urllib.quote().
+    Urllib takes a long time to import, as it imports the socket and
+    ssl modules.
+    '''
+    return ''.join(map(_URL_QUOTED.__getitem__, path))
+
+def subtree_condition(rel_path):
+    '''Return an SQL condition and arguments that match the path column
+    of all resources inside the collection rel_path, not including
+    rel_path itself. The condition is a range on the path, so that
+    SQLite can use an index on that column.
+    '''
+    if rel_path == '':
+        return "path > ''", []
+    
+    # All paths starting with 'dir/' sort between 'dir/' and 'dir0',
+    # because '0' is the next character after '/'.
+    return 'path > ? AND path < ?', [rel_path + '/', rel_path + '0']
+
 def get_isoformat(timestamp):
     '''Format the timestamp according to ISO8601 / RFC3339.'''
     t = time.gmtime(timestamp)
@@ -101,6 +355,20 @@ def get_rfcformat(timestamp):
     t = time.gmtime(timestamp)
     return time.strftime('%a, %d %b %Y %H:%M:%S %z', t)
 
+def parse_rfcdate(string):
+    '''Parse a HTTP date, such as in If-Range header, to a timestamp.
+    Returns None if the date is not valid.
+    '''
+    import email.utils # Imports most of the email package
+    parsed = email.utils.parsedate_tz(string)
+    if parsed is None:
+        return None
+    
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
 def get_usertime(timestamp):
     '''Format the timestamp for reading by user.'''
     t = time.localtime(timestamp)
@@ -139,22 +407,71 @@ def pretty_unit(value, base=1000, minunit=None, format="%0.1f"):
             return format % v + " " + unit
 
 def get_mimetype(real_path):
-    '''Use mimetypes module to guess Content-Type for the file.
+    '''Guess Content-Type for the file from the prebuilt table, or with
+    the mimetypes module for other extensions.
     If it fails, use application/octet-stream.
     '''
-    mimetype = mimetypes.guess_type(real_path)[0]
+    extension = os.path.splitext(real_path)[1]
+    mimetype = MIME_TYPES.get(extension) or MIME_TYPES.get(extension.lower())
+    
+    if not mimetype and extension:
+        import mimetypes
+        mimetype = mimetypes.guess_type(real_path)[0]
+    
     if not mimetype:
         mimetype = 'application/octet-stream'
     return mimetype
 
-def create_etag(real_path):
+class ResourceInfo(object):
+    '''Snapshot of the metadata of a file or directory, taken with a
+    single os.stat() call. Property handlers, ETag generation and
+    directory listings all read from this instead of stat'ing the
+    file again.
+    
+    Attributes:
+    - path: real file system path
+    - name: last component of the path
+    - isdir: True for directories
+    - islink: True if the path is a symbolic link. Only known for
+      entries returned by list_directory(), otherwise False.
+    - size, mtime, ctime: as in os.stat() results
+    
+    Raises OSError if the file does not exist. A stat result
+    obtained elsewhere can be passed in as st.
+    '''
+    def __init__(self, real_path, st = None, islink = False):
+        if st is None:
+            st = os.stat(real_path)
+        
+        self.path = real_path
+        self.islink = islink
+        self.name = os.path.basename(real_path.rstrip('/'))
+        self.stat = st
+        self.isdir = stat.S_ISDIR(st.st_mode)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+    
+    def __repr__(self):
+        return '<ResourceInfo ' + repr(self.path) + '>'
+
+def get_resourceinfo(real_path):
+    '''Return a ResourceInfo for the path, or None if it does not exist.'''
+    try:
+        return ResourceInfo(real_path)
+    except OSError:
+        return None
+
+def create_etag(info):
     '''Get an unique identifier for this revision of the file.
     This is used by HTTP clients for caching purposes.
+    Argument is either a ResourceInfo or a file system path.
     '''
-    return ('"' + str(os.path.getmtime(real_path)) +
-        'S' + str(os.path.getsize(real_path)) + '"')
+    if not isinstance(info, ResourceInfo):
+        info = ResourceInfo(info)
+    return '"' + str(info.mtime) + 'S' + str(info.size) + '"'
 
-def compare_etags(etag, etag_list):
+def compare_etags(etag, etag_list, weak = False):
     '''Compare the specified etag against the list.
     List can be either a single tag, a list separated with comma,
     or an asterisk:
@@ -162,6 +479,9 @@ def compare_etags(etag, etag_list):
     - '"tag1", "tag2"': matches if etag in ['"tag1"', '"tag2"']
     - '*': matches any etag
     
+    By default uses the strong comparison of RFC 7232, where weak tags
+    (W/"tag") never match. If weak is True, the W/ prefixes are ignored.
+    
     Note: the ETags generated by this application do not contain
     commas. This function can't match against ETags with commas.
     '''
@@ -169,10 +489,132 @@ def compare_etags(etag, etag_list):
     
     if parts == ['*']:
         return True
-    elif etag in parts:
-        return True
-    else:
+    elif etag is None:
         return False
+    elif weak:
+        strip = lambda tag: tag[2:] if tag.startswith('W/') else tag
+        return strip(etag) in map(strip, parts)
+    elif etag.startswith('W/'):
+        return False
+    else:
+        return etag in parts
+
+def parse_range(range_header, size):
+    '''Parse a HTTP Range header for a resource of the given size.
+    
+    Returns a sorted list of (first, last) byte positions, with the last
+    position inclusive and overlapping or adjacent ranges combined.
+    Returns an empty list if none of the ranges can be satisfied, and None
+    if the header is not a valid byte range request and should be ignored.
+    '''
+    unit, sep, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        
+        first, sep, last = spec.partition('-')
+        first = first.strip()
+        last = last.strip()
+        
+        if not sep or not (first or last):
+            return None
+        elif first and not first.isdigit():
+            return None
+        elif last and not last.isdigit():
+            return None
+        
+        if not first:
+            # Suffix range, i.e. the last N bytes
+            if int(last) == 0:
+                continue
+            first = max(0, size - int(last))
+            last = size - 1
+        else:
+            first = int(first)
+            if last:
+                last = int(last)
+                if last < first:
+                    return None
+            else:
+                last = size - 1
+        
+        if first >= size:
+            continue
+        
+        ranges.append((first, min(last, size - 1)))
+    
+    ranges.sort()
+    combined = []
+    for first, last in ranges:
+        if combined and first <= combined[-1][1] + 1:
+            combined[-1] = (combined[-1][0], max(last, combined[-1][1]))
+        else:
+            combined.append((first, last))
+    
+    return combined
+
+def parse_content_range(header):
+    '''Parse a Content-Range header of an upload segment, of the form
+    'bytes first-last/total' or 'bytes */total'.
+    
+    Returns a tuple (first, last, total) with the last position inclusive.
+    First and last are None for the form without a range. Raises DAVError
+    if the header is invalid or does not give the total length.
+    '''
+    unit, sep, spec = header.strip().partition(' ')
+    byterange, sep2, total = spec.strip().partition('/')
+    
+    if unit.lower() != 'bytes' or not sep or not sep2 or not total.isdigit():
+        raise DAVError('400 Bad Request: Invalid Content-Range')
+    
+    total = int(total)
+    if byterange == '*':
+        return None, None, total
+    
+    first, sep, last = byterange.partition('-')
+    if not sep or not first.isdigit() or not last.isdigit():
+        raise DAVError('400 Bad Request: Invalid Content-Range')
+    
+    first = int(first)
+    last = int(last)
+    if last < first or last >= total:
+        raise DAVError('400 Bad Request: Invalid Content-Range')
+    
+    return first, last, total
+
+def multipart_byteranges(source, ranges, size, content_type):
+    '''Prepare a multipart/byteranges response body containing the given
+    ranges of an open file object, as returned by parse_range().
+    
+    Returns a tuple (content_type, content_length, blocks), where blocks
+    is a generator that seeks to each range and yields its data.
+    '''
+    boundary = binascii.hexlify(os.urandom(12))
+    
+    headers = []
+    for first, last in ranges:
+        headers.append('\r\n--' + boundary + '\r\n'
+            + 'Content-Type: ' + content_type + '\r\n'
+            + 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (first, last, size))
+    trailer = '\r\n--' + boundary + '--\r\n'
+    
+    length = sum(map(len, headers)) + len(trailer)
+    length += sum([last - first + 1 for first, last in ranges])
+    
+    def generate():
+        for header, (first, last) in zip(headers, ranges):
+            yield header
+            source.seek(first)
+            for block in read_blocks(source, last - first + 1):
+                yield block
+        yield trailer
+    
+    return ('multipart/byteranges; boundary=' + boundary, length, generate())
 
 def add_to_dict_list(dictionary, key, item):
     '''Add the item to the list stored in the dictionary with
@@ -183,46 +625,109 @@ def add_to_dict_list(dictionary, key, item):
         dictionary[key] = []
     dictionary[key].append(item)
 
-def search_directory(directory, depth = -1):
+def _stat_entry(path, strict):
+    '''Return (stat result, islink) for a directory entry, or None if it
+    should be skipped. See _scan_entries().
+    '''
+    try:
+        st = os.lstat(path)
+    except OSError, e:
+        if strict and e.errno != errno.ENOENT:
+            raise
+        return None # Removed after listing
+    
+    islink = stat.S_ISLNK(st.st_mode)
+    if islink:
+        try:
+            st = os.stat(path)
+        except OSError:
+            if not strict:
+                return None # Broken symlink
+    return st, islink
+
+def _scan_entries(directory, strict = False):
+    '''Yield (path, stat result, islink) for each entry in directory.
+    Uses scandir when available, so that the file type comes from the
+    directory listing and each entry is stat'ed only once.
+    
+    Entries removed after listing are skipped. Broken symbolic links and
+    entries that can't be stat'ed are skipped too, unless strict is True.
+    Then a broken link is returned with the stat result of the link
+    itself, and other errors are raised.
+    '''
+    if scandir is not None:
+        for entry in scandir(directory):
+            try:
+                result = entry.stat(), entry.is_symlink()
+            except OSError:
+                result = _stat_entry(entry.path, strict)
+            if result is not None:
+                yield (entry.path, ) + result
+    else:
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            result = _stat_entry(path, strict)
+            if result is not None:
+                yield (path, ) + result
+
+def list_directory(directory, prune = None, ordered = False, strict = False):
+    '''Yield a ResourceInfo for each entry in the directory.
+    Prune is an optional function taking a ResourceInfo, which returns
+    True for entries that should be left out.
+    If ordered is True, entries are yielded sorted by name.
+    Strict is as in walk_directory().
+    '''
+    entries = _scan_entries(directory, strict)
+    if ordered:
+        entries = sorted(entries)
+    
+    for path, st, islink in entries:
+        info = ResourceInfo(path, st, islink)
+        if prune is None or not prune(info):
+            yield info
+
+def walk_directory(directory, depth = -1, prune = None, ordered = False,
+                   strict = False):
     '''Find all files and directories under a directory tree,
-    yielding paths. Depth is the recursion limit:
+    yielding ResourceInfo objects. Depth is the recursion limit:
         0 == yield just the start directory,
         1 == yield start directory and files there,
         -1 == infinite.
-    '''
-    
-    yield directory
     
-    if depth == 0 or not os.path.isdir(directory):
-        return
+    Prune is an optional function taking a ResourceInfo. If it returns
+    True, the entry is not yielded and a directory is not descended into.
+    It is not called for the start directory.
+    Symbolic links to directories are yielded but not followed.
+    If ordered is True, the entries of each directory are yielded
+    sorted by name.
     
-    for filename in os.listdir(directory):
-        path = os.path.join(directory, filename)
-        if os.path.isdir(filename):
-            for path in search_directory(path, depth - 1):
-                yield path
-        else:
-            yield path
-
-def add_to_zip_recursively(zipobj, real_path, root_dir, check_read):
-    '''Adds the file at real_path, and if it is a directory,
-    all files under it to a ZIP archive.
-    Filenames are converted from UTF-8 to CP437.
-    Root_dir is stripped from beginning of each file name.
-    Check_read is a function that returns False for files that
-    should not be included in archive.
+    By default broken symbolic links and directories that can't be
+    listed are left out, which suits listings. Callers that copy or
+    move the tree set strict to True, so that broken links are yielded
+    too and other errors raise OSError instead of losing data.
     '''
-    if not root_dir.endswith('/'):
-        root_dir += '/'
+    info = ResourceInfo(directory)
+    yield info
     
-    for path in search_directory(real_path):
-        if not os.path.isdir(path) and not check_read(path):
-            continue
+    if depth != 0 and info.isdir:
+        for info in _walk_children(directory, depth - 1, prune, ordered,
+                                   strict):
+            yield info
+
+def _walk_children(directory, depth, prune, ordered, strict):
+    '''Recursive part of walk_directory().'''
+    for info in list_directory(directory, prune, ordered, strict):
+        yield info
         
-        assert path[:len(root_dir)] == root_dir
-        rel_path = path[len(root_dir):]
-        rel_path = rel_path.encode('cp437', 'replace')
-        zipobj.write(path, rel_path)
+        if depth != 0 and info.isdir and not info.islink:
+            try:
+                for child in _walk_children(info.path, depth - 1,
+                                            prune, ordered, strict):
+                    yield child
+            except OSError:
+                if strict:
+                    raise
+                # Directory removed or not listable
 
 def compare_path(real_path, patterns):
     '''Compare a path to a list of patterns.
@@ -244,6 +749,73 @@ def compare_path(real_path, patterns):
     
     return False
 
+class PathMatcher:
+    '''Compiled form of a compare_path() pattern list, for checking
+    many paths against the same patterns.
+    
+    All glob patterns are combined into a single regular expression.
+    Because a glob matching any path component matches the whole path,
+    the result for each parent directory is remembered and reused for
+    the files inside it. Functions in the pattern list are called for
+    every path, as in compare_path().
+    '''
+    memo_size = 10000
+    
+    def __init__(self, patterns):
+        self.functions = [p for p in patterns if callable(p)]
+        globs = [p for p in patterns if not callable(p)]
+        
+        if globs:
+            regexes = ['(?:' + self._translate(p) + ')' for p in globs]
+            self.regex = re.compile('(?:' + '|'.join(regexes) + r')\Z', re.S)
+        else:
+            self.regex = None
+        
+        self._memo = {}
+    
+    def _translate(self, pattern):
+        '''Convert a glob to regex without the end of string match and
+        flags added by fnmatch.translate().
+        '''
+        regex = translate(pattern)
+        for suffix in [r'\Z(?ms)', r'\Z']:
+            if regex.endswith(suffix):
+                return regex[:-len(suffix)]
+        return regex
+    
+    def _match_directory(self, directory):
+        '''Check if any component of the directory, given without leading
+        or trailing slashes, matches one of the glob patterns.
+        '''
+        result = self._memo.get(directory)
+        if result is None:
+            parent, sep, name = directory.rpartition('/')
+            result = bool((sep and self._match_directory(parent))
+                          or self.regex.match(name))
+            
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+            self._memo[directory] = result
+        return result
+    
+    def match(self, real_path):
+        '''Return True if the path matches any of the patterns.
+        Same result as compare_path(real_path, patterns).
+        '''
+        real_path = os.path.normpath(real_path)
+        
+        for function in self.functions:
+            if function(real_path):
+                return True
+        
+        if self.regex is None:
+            return False
+        
+        parent, sep, name = real_path.strip('/').rpartition('/')
+        if sep and self._match_directory(parent):
+            return True
+        return bool(self.regex.match(name))
+
 def parse_if_list(string):
     '''Read a "List" structure as defined in RFC4918
     Returns list of tuples (Type, Invert, Value).
@@ -359,12 +931,147 @@ if __name__ == '__main__':
     add_to_dict_list(test_dict, 'ankka', 'koira')
     assert test_dict['ankka'] == ['heppa', 'koira']
     
+    import hashlib
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    open(os.path.join(tmpdir, 'file'), 'w').write('foobar')
+    info = ResourceInfo(os.path.join(tmpdir, 'file'))
+    assert not info.isdir and info.size == 6 and info.name == 'file'
+    assert create_etag(info) == create_etag(info.path)
+    assert ResourceInfo(tmpdir + '/').isdir
+    assert get_resourceinfo(os.path.join(tmpdir, 'nothing')) is None
+    
+    os.makedirs(os.path.join(tmpdir, 'dir1', 'dir2'))
+    open(os.path.join(tmpdir, 'dir1', 'dir2', 'file2'), 'w').write('')
+    os.symlink(tmpdir, os.path.join(tmpdir, 'dir1', 'link'))
+    walk = lambda *args, **kwargs: [get_relpath(i.path, tmpdir)
+        for i in walk_directory(*args, **kwargs)]
+    assert (walk(tmpdir, ordered = True) ==
+        ['', 'dir1', 'dir1/dir2', 'dir1/dir2/file2', 'dir1/link', 'file'])
+    assert walk(tmpdir, 0) == ['']
+    assert sorted(walk(tmpdir, 1)) == ['', 'dir1', 'file']
+    assert (walk(tmpdir, prune = lambda i: i.name == 'dir2', ordered = True)
+        == ['', 'dir1', 'dir1/link', 'file'])
+    assert [i.name for i in list_directory(tmpdir, ordered = True)] == ['dir1', 'file']
+    
+    # Broken symlinks and unlistable directories are only skipped
+    # when not strict
+    os.symlink('missing', os.path.join(tmpdir, 'dir1', 'broken'))
+    assert 'dir1/broken' not in walk(tmpdir)
+    assert walk(tmpdir, strict = True, ordered = True) == ['', 'dir1',
+        'dir1/broken', 'dir1/dir2', 'dir1/dir2/file2', 'dir1/link', 'file']
+    assert [i.islink for i in list_directory(os.path.join(tmpdir, 'dir1'),
+        strict = True) if i.name == 'broken'] == [True]
+    
+    saved = scandir, os.listdir
+    def listdir(path):
+        if path.endswith('dir2'):
+            raise OSError(errno.EACCES, 'Permission denied')
+        return saved[1](path)
+    scandir, os.listdir = None, listdir
+    assert 'dir1/dir2' in walk(tmpdir) and 'dir1/dir2/file2' not in walk(tmpdir)
+    try:
+        walk(tmpdir, strict = True)
+        assert False
+    except OSError, e:
+        assert e.errno == errno.EACCES
+    scandir, os.listdir = saved
+    
+    # Preallocation reserves at most PREALLOCATE_LIMIT bytes, if supported
+    PREALLOCATE_LIMIT = 4096
+    fd = os.open(os.path.join(tmpdir, 'prealloc'), os.O_WRONLY | os.O_CREAT)
+    preallocate(fd, 100000)
+    assert os.fstat(fd).st_size in (0, 4096)
+    os.close(fd)
+    
+    import shutil
+    shutil.rmtree(tmpdir)
+    
     assert compare_etags('"foo"', '"foo"')
     assert not compare_etags('"foo"', '"foo2"')
     assert compare_etags('"foo"', '"foo", "foo2"')
     assert compare_etags('"foo"', '"foo2","foo"')
     assert compare_etags('"foo"', '*')
     assert not compare_etags('"foo"', '')
+    assert not compare_etags('W/"foo"', 'W/"foo"')
+    assert compare_etags('W/"foo"', '"bar", W/"foo"', weak = True)
+    assert compare_etags('"foo"', 'W/"foo"', weak = True)
+    
+    assert parse_range('bytes=0-499', 1000) == [(0, 499)]
+    assert parse_range('bytes=500-', 1000) == [(500, 999)]
+    assert parse_range('bytes=-200', 1000) == [(800, 999)]
+    assert parse_range('bytes=-2000', 1000) == [(0, 999)]
+    assert parse_range('bytes=900-2000', 1000) == [(900, 999)]
+    assert parse_range('bytes=500-600, 0-10,601-700', 1000) == [(0, 10), (500, 700)]
+    assert parse_range('bytes=1000-', 1000) == []
+    assert parse_range('bytes=-0', 1000) == []
+    assert parse_range('bytes=0-', 0) == []
+    assert parse_range('bytes=1000-, 5-5', 1000) == [(5, 5)]
+    assert parse_range('bytes=5-1', 1000) is None
+    assert parse_range('bytes=a-b', 1000) is None
+    assert parse_range('bytes=-', 1000) is None
+    assert parse_range('lines=1-2', 1000) is None
+    
+    from StringIO import StringIO
+    content_type, length, blocks = multipart_byteranges(
+        StringIO('0123456789'), [(0, 1), (8, 9)], 10, 'text/plain')
+    body = ''.join(blocks)
+    assert len(body) == length
+    assert '\r\nContent-Range: bytes 8-9/10\r\n\r\n89\r\n--' in body
+    assert body.endswith('\r\n--' + content_type.split('=')[1] + '--\r\n')
+    
+    assert parse_rfcdate(get_rfcformat(1325419200)) == 1325419200
+    
+    source = StringIO('0123456789')
+    body = FileRange(source, 2, 5, blocksize = 2)
+    assert list(body) == ['23', '45', '6']
+    body.close()
+    assert source.closed
+    assert ''.join(FileRange(StringIO('0123456789'), 7)) == '789'
+    
+    class ReadInto(StringIO):
+        def readinto(self, buf):
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+    
+    class Output(StringIO):
+        # Unlike files, StringIO would keep a reference to the buffer.
+        def write(self, data):
+            StringIO.write(self, str(data))
+    
+    data = ''.join([chr(i % 256) for i in range(300000)])
+    for length in [None, 0, 1, 65536, 100000, 300000]:
+        for source in [StringIO(data), ReadInto(data)]:
+            dest = Output()
+            digest = hashlib.md5()
+            copied = copy_stream(source, dest, length, 1000, 20000, digest)
+            assert dest.getvalue() == data[:length] and copied == len(dest.getvalue())
+            assert digest.digest() == hashlib.md5(data[:length]).digest()
+    
+    closed = []
+    body = ClosingIterator(iter(['a']), lambda: closed.append(True))
+    body.close()
+    assert closed == [True]
+    assert parse_rfcdate('Sun, 01 Jan 2012 12:00:00 GMT') == 1325419200
+    assert parse_rfcdate('"etag"') is None
+    
+    assert parse_content_range('bytes 0-99/1000') == (0, 99, 1000)
+    assert parse_content_range('bytes */1000') == (None, None, 1000)
+    for header in ['bytes 0-99/*', 'bytes 5-4/10', 'bytes 0-10/10', 'items 0-1/2']:
+        try:
+            parse_content_range(header)
+            assert False
+        except DAVError:
+            pass
+    
+    assert quote_url('/a b/\xc3\xa4%?#~') == '/a%20b/%C3%A4%25%3F%23%7E'
+    
+    assert get_mimetype('/tmp/a.HTML') == 'text/html'
+    assert get_mimetype('/tmp/a.md') == 'text/markdown'
+    assert get_mimetype('/tmp/dir/') == 'application/octet-stream'
+    assert 'mimetypes' not in sys.modules
+    assert get_mimetype('/tmp/a.tar.gz') == 'application/x-tar'
     
     assert compare_path('/tmp/.svn/foo', ['foo'])
     assert not compare_path('/tmp/.svn/foo2', ['foo'])
@@ -374,6 +1081,21 @@ if __name__ == '__main__':
     assert compare_path('/tmp/hack.php.txt', ['*.php.*'])
     assert compare_path('/tmp/foo', ['*'])
     
+    test_patterns = ['.ht*', '.svn', '*.php', '*.php.*', 'f?o', '[!a]b',
+                     'x[ab]', '', lambda p: p.endswith('/callable')]
+    test_paths = ['/', '', '/tmp', '/tmp/.htaccess', '/tmp/.svn/foo',
+                  'foo/bar', '/tmp/a.php', '/tmp/a.php.txt', '/tmp/foo',
+                  '/foo/tmp', '/tmp/ab', '/tmp/bb/c', '/xa/b', '/xc/b',
+                  '//tmp//.svn', '/tmp/../.svn', '/tmp/callable',
+                  u'/tmp/\xe4.php', '/tmp/a/', '/tmp/sub/']
+    for patterns in [test_patterns, test_patterns[:2], [], ['*'],
+                     [test_patterns[-1]]]:
+        matcher = PathMatcher(patterns)
+        for i in range(2): # Second round tests the memoized results
+            for path in test_paths:
+                assert (matcher.match(path) ==
+                        compare_path(path, patterns)), (patterns, path)
+    
     assert (parse_if_list('(["Foobar"]Not["foobar"])') ==
             [('etag', False, '"Foobar"'), ('etag', True, '"foobar"')])
     
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+'''XML output for WebDAV responses. Multistatus and lock discovery
+documents are written directly as strings from the property data,
+without going through a template engine.
+
+Property values are either strings, which are written as escaped text,
+lists of ElementTree elements, which are written as the contents of the
+property element, or a single ElementTree element, which is written in
+place of the whole property element.
+
+Element names are given in ElementTree's {namespace}name notation. The
+DAV: namespace always uses the prefix D, which is declared on the root
+element. Other namespaces are declared on the element that uses them.
+'''
+
+import urlparse
+import xml.etree.ElementTree as ET
+
+import davutils
+
+MULTISTATUS_START = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                     + '<D:multistatus xmlns:D="DAV:">\n')
+MULTISTATUS_END = '</D:multistatus>\n'
+
+def escape(text):
+    '''Escape a string for use as XML character data.'''
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def escape_attribute(text):
+    '''Escape a string for use as a double-quoted XML attribute value.'''
+    return escape(text).replace('"', '&quot;')
+
+def to_utf8(parts):
+    '''Join a list of strings into an UTF-8 encoded string.'''
+    result = u''.join(parts)
+    return result.encode('utf-8')
+
+def _qname(tag, scope, declarations):
+    '''Get the prefixed name for a tag in {namespace}name notation.
+    Scope is a dictionary of namespace => prefix for the namespaces
+    already declared. New declarations are added to scope and appended
+    to declarations as strings.
+    '''
+    if not tag.startswith('{'):
+        return tag
+    
+    namespace, name = tag[1:].split('}', 1)
+    prefix = scope.get(namespace)
+    if prefix is None:
+        prefix = 'ns' + str(len(scope))
+        scope[namespace] = prefix
+        declarations.append(' xmlns:' + prefix + '="'
+            + escape_attribute(namespace) + '"')
+    return prefix + ':' + name
+
+def write_element(out, element, scope):
+    '''Append an ElementTree element and its children to the list out.'''
+    scope = scope.copy()
+    declarations = []
+    tag = _qname(element.tag, scope, declarations)
+    
+    out.append('<' + tag)
+    for name, value in element.items():
+        out.append(' ' + _qname(name, scope, declarations) + '="'
+            + escape_attribute(value) + '"')
+    out.extend(declarations)
+    
+    if not element.text and not len(element):
+        out.append('/>')
+    else:
+        out.append('>')
+        if element.text:
+            out.append(escape(element.text))
+        for child in element:
+            write_element(out, child, scope)
+            if child.tail:
+                out.append(escape(child.tail))
+        out.append('</' + tag + '>')
+
+def write_property(out, name, value, scope):
+    '''Append a property element with the given value to the list out.'''
+    if ET.iselement(value):
+        write_element(out, value, scope)
+        return
+    
+    scope = scope.copy()
+    declarations = []
+    tag = _qname(name, scope, declarations)
+    out.append('<' + tag)
+    out.extend(declarations)
+    
+    if not value:
+        out.append('/>')
+    elif isinstance(value, basestring):
+        out.append('>' + escape(value) + '</' + tag + '>')
+    else:
+        out.append('>')
+        for element in value:
+            write_element(out, element, scope)
+        out.append('</' + tag + '>')
+
+def response(real_url, propstats = None, status = None, description = None):
+    '''Return an UTF-8 encoded <DAV:response> element for use inside
+    <DAV:multistatus>.
+    
+    Propstats is a dictionary of status => list of (name, value) tuples.
+    If status is a DAVError, its body is included as <DAV:error>.
+    Alternatively status and optional description can be given for the
+    whole resource.
+    '''
+    scope = {'DAV:': 'D'}
+    out = ['<D:response><D:href>', escape(real_url), '</D:href>']
+    
+    if status is not None:
+        out.append('<D:status>HTTP/1.1 ' + escape(str(status)) + '</D:status>')
+    
+    for propstatus, props in (propstats or {}).items():
+        out.append('<D:propstat><D:prop>')
+        for name, value in props:
+            write_property(out, name, value, scope)
+        out.append('</D:prop><D:status>HTTP/1.1 ' + escape(str(propstatus))
+            + '</D:status>')
+        
+        if hasattr(propstatus, 'body'):
+            if propstatus.body:
+                out.append('<D:error>' + escape(propstatus.body) + '</D:error>')
+            else:
+                out.append('<D:error/>')
+        
+        out.append('</D:propstat>')
+    
+    if description:
+        out.append('<D:responsedescription>' + escape(description)
+            + '</D:responsedescription>')
+    
+    out.append('</D:response>\n')
+    return to_utf8(out)
+
+def _text_element(parent, tag, text):
+    '''Add a child element with text content.'''
+    element = ET.SubElement(parent, tag)
+    element.text = text
+    return element
+
+def activelock(lock, root_url):
+    '''Return an ElementTree <DAV:activelock> element describing a
+    lock_manager.Lock object.
+    '''
+    element = ET.Element('{DAV:}activelock')
+    locktype = ET.SubElement(element, '{DAV:}locktype')
+    ET.SubElement(locktype, '{DAV:}write')
+    
+    lockscope = ET.SubElement(element, '{DAV:}lockscope')
+    if lock.shared:
+        ET.SubElement(lockscope, '{DAV:}shared')
+    else:
+        ET.SubElement(lockscope, '{DAV:}exclusive')
+    
+    if lock.infinite_depth:
+        _text_element(element, '{DAV:}depth', 'infinity')
+    else:
+        _text_element(element, '{DAV:}depth', '0')
+    
+    element.append(ET.fromstring(lock.owner))
+    _text_element(element, '{DAV:}timeout',
+        'Second-' + str(lock.seconds_until_timeout()))
+    
+    locktoken = ET.SubElement(element, '{DAV:}locktoken')
+    _text_element(locktoken, '{DAV:}href', lock.urn)
+    
+    lockroot = ET.SubElement(element, '{DAV:}lockroot')
+    rel_url = davutils.quote_url(lock.path.encode('utf-8'))
+    _text_element(lockroot, '{DAV:}href', urlparse.urljoin(root_url, rel_url))
+    return element
+
+def lock_response(lock, root_url):
+    '''Return an UTF-8 encoded response body for a LOCK request.'''
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n',
+           '<D:prop xmlns:D="DAV:"><D:lockdiscovery>']
+    write_element(out, activelock(lock, root_url), {'DAV:': 'D'})
+    out.append('</D:lockdiscovery></D:prop>\n')
+    return to_utf8(out)
+
+if __name__ == '__main__':
+    print "Unit tests"
+    
+    import datetime
+    from davutils import DAVError
+    
+    def canonical(element):
+        '''Representation of an element tree for comparing documents,
+        ignoring whitespace, prefixes and the order of siblings.'''
+        return (element.tag, (element.text or '').strip(),
+                sorted(element.items()),
+                sorted([canonical(child) for child in element]))
+    
+    def equivalent(xml1, xml2):
+        return canonical(ET.fromstring(xml1)) == canonical(ET.fromstring(xml2))
+    
+    def equivalent_response(fragment, kid_fragment):
+        '''Compare a response from this module against a Kid rendered one,
+        wrapping both in a multistatus element.'''
+        return equivalent(MULTISTATUS_START + fragment + MULTISTATUS_END,
+            '<D:multistatus xmlns:D="DAV:">' + kid_fragment + '</D:multistatus>')
+    
+    # Reference outputs are from the Kid templates used before this module.
+    collection = [ET.Element('{DAV:}collection')]
+    xml = response('http://example.com/dav/a%20b/', {
+        '200 OK': [('{DAV:}getcontentlength', '123'),
+                   ('{DAV:}resourcetype', collection),
+                   ('{DAV:}getcontenttype', u'text/plain & <\xe4>')],
+        '404 Not Found: Property': [('{http://example.com/ns}foo', ''),
+                                    ('{DAV:}bar', '')]})
+    assert equivalent_response(xml, '<D:response xmlns:D="DAV:">\n    <D:href>http://example.com/dav/a%20b/</D:href>\n    <D:propstat>\n        <D:prop>\n                <D:getcontentlength>123</D:getcontentlength>\n                <D:resourcetype><D:collection /></D:resourcetype>\n                <D:getcontenttype>text/plain &amp; &lt;\xc3\xa4></D:getcontenttype>\n        </D:prop>\n        <D:status>HTTP/1.1 200 OK</D:status>\n    </D:propstat><D:propstat>\n        <D:prop>\n                <foo xmlns="http://example.com/ns" />\n                <D:bar />\n        </D:prop>\n        <D:status>HTTP/1.1 404 Not Found: Property</D:status>\n    </D:propstat>\n</D:response>')
+    
+    xml = response('http://example.com/dav/', {
+        DAVError('403 Forbidden', '<DAV:cannot-modify-protected-property/>'):
+            [('{DAV:}getetag', '')],
+        DAVError('409 Conflict'): [('{urn:x}y', '')]})
+    assert equivalent_response(xml, '<D:response xmlns:D="DAV:">\n    <D:href>http://example.com/dav/</D:href>\n    <D:propstat>\n        <D:prop>\n                <D:getetag />\n        </D:prop>\n        <D:status>HTTP/1.1 403 Forbidden</D:status>\n        <D:error>&lt;DAV:cannot-modify-protected-property/></D:error>\n    </D:propstat><D:propstat>\n        <D:prop>\n                <y xmlns="urn:x" />\n        </D:prop>\n        <D:status>HTTP/1.1 409 Conflict</D:status>\n        <D:error />\n    </D:propstat>\n</D:response>')
+    
+    xml = response('http://example.com/dav/',
+        status = '507 Insufficient Storage', description = 'Truncated')
+    assert equivalent_response(xml, '<D:response xmlns:D="DAV:">\n    <D:href>http://example.com/dav/</D:href>\n    <D:status>HTTP/1.1 507 Insufficient Storage</D:status>\n    <D:responsedescription>Truncated</D:responsedescription>\n</D:response>')
+    
+    class TestLock:
+        shared = True
+        infinite_depth = True
+        owner = ('<ns0:owner xmlns:ns0="DAV:">'
+                 + '<ns0:href>mailto:x@y</ns0:href></ns0:owner>')
+        urn = 'urn:uuid:1234'
+        path = u'dir/file'
+        def seconds_until_timeout(self):
+            return 100
+    
+    xml = lock_response(TestLock(), 'http://example.com/dav/')
+    assert equivalent(xml, '<?xml version="1.0" encoding="utf-8"?>\n<D:prop xmlns:D="DAV:"> \n    <D:lockdiscovery>\n        <D:activelock> \n            <D:locktype><D:write /></D:locktype> \n            <D:lockscope>\n                <D:shared />\n            </D:lockscope> \n            <D:depth>infinity</D:depth>\n            <D:owner xmlns:ns0="DAV:"><D:href>mailto:x@y</D:href></D:owner> \n            <D:timeout>Second-100</D:timeout>\n            <D:locktoken>\n                <D:href>urn:uuid:1234</D:href>\n            </D:locktoken> \n            <D:lockroot> \n                <D:href>http://example.com/dav/dir/file</D:href>\n            </D:lockroot> \n        </D:activelock>\n    </D:lockdiscovery>\n</D:prop>')
+    
+    # Foreign namespaces, attributes, mixed content and whole elements
+    value = ET.fromstring('<x:prop xmlns:x="urn:x" xmlns:y="urn:y" y:a="&quot;">'
+        + 'text<y:child>1 &amp; 2</y:child>tail<x:empty/></x:prop>')
+    xml = MULTISTATUS_START + response('/', {'200 OK': [('{urn:x}prop', value)]})
+    xml += MULTISTATUS_END
+    assert ET.fromstring(xml).find('*/*/*/{urn:x}prop/{urn:y}child').text == '1 & 2'
+    assert equivalent(xml, '<D:multistatus xmlns:D="DAV:"><D:response>'
+        + '<D:href>/</D:href><D:propstat><D:prop>'
+        + '<x:prop xmlns:x="urn:x" xmlns:y="urn:y" y:a="&quot;">text<y:child>'
+        + '1 &amp; 2</y:child>tail<x:empty/></x:prop>'
+        + '</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat>'
+        + '</D:response></D:multistatus>')
+    
+    print "Unit tests OK"
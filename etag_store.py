@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+'''Content digest ETags. When config.etag_mode is 'digest', the ETag of
+a file is the SHA-256 digest of its contents instead of its modification
+time and size, so that touching a file or saving identical contents does
+not make clients download it again.
+
+Digests are computed when first needed and stored in a SQLite database,
+keyed by the device and inode of the file. The stored modification time
+and size tell whether the digest still belongs to the current version of
+the file. Uploads compute the digest while writing, so new files never
+have to be read again.
+'''
+
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import davutils
+from davutils import DAVError
+
+def new_digest():
+    '''Return a hash object for computing a content digest.'''
+    return hashlib.sha256()
+
+def format_etag(digest):
+    '''Return the ETag for a hexadecimal content digest.'''
+    return '"' + digest + '"'
+
+def stat_version(st):
+    '''Return the tuple (mtime in nanoseconds, size) that identifies
+    a version of a file.
+    '''
+    return int(round(st.st_mtime * 1e9)), st.st_size
+
+class DigestStore:
+    '''Cache of file content digests.'''
+    def __init__(self):
+        # Etag_db can be absolute path or relative to root dir.
+        dbpath = os.path.join(config.root_dir, config.etag_db)
+        newfile = not os.path.exists(dbpath)
+        
+        self.db_conn = sqlite3.connect(dbpath,
+            isolation_level = None,
+            timeout = config.lock_wait)
+        self.db_cursor = self.db_conn.cursor()
+        
+        if newfile:
+            self._create_tables()
+    
+    def _create_tables(self):
+        # A new version of a file replaces the row of the old one.
+        self._sql_query('''CREATE TABLE IF NOT EXISTS digests (
+            device INTEGER,
+            inode INTEGER,
+            mtime_ns INTEGER,
+            size INTEGER,
+            digest TEXT,
+            PRIMARY KEY (device, inode))''')
+    
+    def _sql_query(self, *args, **kwargs):
+        '''Run a database query and wrap SQLite OperationalErrors, such
+        as locked databases.
+        '''
+        try:
+            self.db_cursor.execute(*args, **kwargs)
+        except sqlite3.OperationalError, e:
+            if 'locked' in e.message:
+                raise DAVError('503 Service Unavailable: ETag DB is busy')
+            else:
+                raise DAVError('500 Internal Server Error: ETag DB: '
+                               + e.message)
+    
+    def get(self, st):
+        '''Return the stored digest for the file version described by
+        the stat result st, or None.
+        '''
+        self._sql_query('''SELECT digest FROM digests
+            WHERE device = ? AND inode = ? AND mtime_ns = ? AND size = ?''',
+            (st.st_dev, st.st_ino) + stat_version(st))
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+    
+    def put(self, st, digest):
+        '''Store the digest of the file version described by st.'''
+        self._sql_query('''INSERT OR REPLACE INTO digests
+            VALUES (?,?,?,?,?)''',
+            (st.st_dev, st.st_ino) + stat_version(st) + (digest, ))
+
+# SQLite connections can't be shared between threads.
+_local = threading.local()
+
+def get_store():
+    '''Return the DigestStore of the current thread.'''
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = DigestStore()
+    return store
+
+def hash_file(real_path):
+    '''Compute the digest of a file. Returns a tuple (stat result, digest),
+    where the stat result is None if the file changed while it was read.
+    '''
+    infile = open(real_path, 'rb')
+    try:
+        st = os.fstat(infile.fileno())
+        digest = new_digest()
+        for block in davutils.read_blocks(infile):
+            digest.update(block)
+        
+        if stat_version(os.fstat(infile.fileno())) != stat_version(st):
+            st = None
+    finally:
+        infile.close()
+    
+    return st, digest.hexdigest()
+
+def remember(st, digest):
+    '''Store the digest of a file computed while writing it. St is the
+    stat result of the complete file.
+    '''
+    try:
+        get_store().put(st, digest)
+    except DAVError:
+        pass # The digest is computed again when needed
+
+def get_etag(info):
+    '''Return the ETag for a file, like davutils.create_etag().
+    Argument is either a ResourceInfo or a file system path.
+    '''
+    if not isinstance(info, davutils.ResourceInfo):
+        info = davutils.ResourceInfo(info)
+    
+    if config.etag_mode != 'digest' or info.isdir:
+        return davutils.create_etag(info)
+    
+    try:
+        digest = get_store().get(info.stat)
+    except DAVError:
+        digest = None
+    
+    if digest is None:
+        st, digest = hash_file(info.path)
+        if st is not None:
+            remember(st, digest)
+    
+    return format_etag(digest)
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import tempfile
+    print "Unit tests"
+    
+    tmpdir = tempfile.mkdtemp()
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = tmpdir
+        etag_db = '.easydav_etags'
+        etag_mode = 'digest'
+        lock_wait = 5
+    
+    path = os.path.join(tmpdir, 'file')
+    open(path, 'w').write('foobar')
+    etag = get_etag(path)
+    assert etag == format_etag(hashlib.sha256('foobar').hexdigest())
+    
+    # Touching the file gives the same ETag, through a new hash
+    os.utime(path, (1000, 1000))
+    assert get_store().get(os.stat(path)) is None
+    assert get_etag(path) == etag
+    assert get_store().get(os.stat(path)) is not None
+    
+    # Cached digest is used as long as the version matches
+    get_store().put(os.stat(path), 'cached')
+    assert get_etag(path) == '"cached"'
+    open(path, 'w').write('foobaz')
+    os.utime(path, (2000, 2000))
+    assert get_etag(path) == format_etag(hashlib.sha256('foobaz').hexdigest())
+    
+    # Directories and the default mode use modification time
+    assert get_etag(tmpdir) == davutils.create_etag(tmpdir)
+    config.etag_mode = 'mtime'
+    assert get_etag(path) == davutils.create_etag(path)
+    
+    # Each thread gets its own connection
+    stores = []
+    thread = threading.Thread(target = lambda: stores.append(get_store()))
+    thread.start()
+    thread.join()
+    assert stores[0] is not get_store()
+    
+    import shutil
+    shutil.rmtree(tmpdir)
+    
+    print "Unit tests OK"
@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+
+'''Copying and moving of files and directory trees for COPY and MOVE.
+
+Files are copied with the fastest method the platform and file system
+support, trying in turn:
+- 'clone': a reflink with the FICLONE ioctl, which shares the data blocks
+  of the source on copy-on-write file systems such as Btrfs and XFS
+- 'copy_file_range': copy inside the kernel, which NFS and some other
+  file systems can also do on the server side
+- 'sendfile': copy inside the kernel on older Linux versions
+- 'buffered': read and write through a buffer in Python
+
+Directory trees are copied with a pool of worker threads, so that the
+kernel can work on several files at once.
+
+Moves are renames, which replace an existing destination atomically with
+renameat2(RENAME_EXCHANGE) where available. Between file systems, they
+are copies followed by removal of the source.
+'''
+
+import binascii
+import collections
+import errno
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+import sys
+
+import davutils
+
+METHODS = ['clone', 'copy_file_range', 'sendfile', 'buffered']
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# Largest count accepted by copy_file_range() and sendfile() on Linux.
+MAX_COUNT = 0x7ffff000
+
+# Errors that mean that a method is not supported for these files, so the
+# next one should be tried.
+FALLBACK_ERRORS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+    errno.ENOTTY, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+def _find_clone():
+    '''Return a function clone(in_fd, out_fd) that makes out_fd a reflink
+    of in_fd, or None if it is not available.
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    
+    def clone(in_fd, out_fd):
+        fcntl.ioctl(out_fd, FICLONE, in_fd)
+    
+    return clone
+
+def _find_copy_file_range():
+    '''Return a function copy_file_range(in_fd, out_fd, offset, count)
+    that copies from offset in in_fd to the same offset in out_fd and
+    returns the number of bytes copied, or None if it is not available.
+    Python 2 has no os.copy_file_range, so on Linux it is called through
+    ctypes.
+    '''
+    if hasattr(os, 'copy_file_range'):
+        return lambda in_fd, out_fd, offset, count: \
+            os.copy_file_range(in_fd, out_fd, count, offset, offset)
+    
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        import ctypes
+        function = ctypes.CDLL(None, use_errno = True).copy_file_range
+    except (ImportError, OSError, AttributeError):
+        return None
+    
+    function.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                         ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                         ctypes.c_size_t, ctypes.c_uint]
+    function.restype = ctypes.c_long
+    
+    def copy_file_range(in_fd, out_fd, offset, count):
+        in_offset = ctypes.c_int64(offset)
+        out_offset = ctypes.c_int64(offset)
+        result = function(in_fd, ctypes.byref(in_offset),
+                          out_fd, ctypes.byref(out_offset), count, 0)
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+    
+    return copy_file_range
+
+def _find_sendfile():
+    '''Return a function sendfile(in_fd, out_fd, offset, count) with the
+    same semantics as the one returned by _find_copy_file_range(),
+    or None if it is not available. Linux can sendfile() to regular files.
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    # Imported here, as the server is not needed for other requests.
+    from wsgi_server import sendfile
+    if sendfile is None:
+        return None
+    
+    def file_sendfile(in_fd, out_fd, offset, count):
+        # Sendfile() writes at the current position of out_fd.
+        os.lseek(out_fd, offset, os.SEEK_SET)
+        return sendfile(out_fd, in_fd, offset, count)
+    
+    return file_sendfile
+
+# Functions of each method, found when first used. False means that the
+# method is not available.
+_functions = {}
+
+def _get_function(method):
+    '''Return the function for a kernel copy method or for 'exchange',
+    or False if it is not available.
+    '''
+    if method not in _functions:
+        finder = {
+            'exchange': _find_exchange,
+            'clone': _find_clone,
+            'copy_file_range': _find_copy_file_range,
+            'sendfile': _find_sendfile,
+        }[method]
+        _functions[method] = finder() or False
+    return _functions[method]
+
+def _copy_data(infile, outfile, methods):
+    '''Copy the contents of infile to the empty file outfile. Returns the
+    name of the method that completed the copy.
+    '''
+    in_fd = infile.fileno()
+    out_fd = outfile.fileno()
+    offset = 0
+    
+    for method in methods:
+        if method == 'buffered':
+            infile.seek(offset)
+            outfile.seek(offset)
+            davutils.copy_stream(infile, outfile)
+            return method
+        
+        function = _get_function(method)
+        if not function:
+            continue
+        
+        try:
+            if method == 'clone':
+                if offset == 0:
+                    function(in_fd, out_fd)
+                    return method
+                continue
+            
+            while True:
+                count = function(in_fd, out_fd, offset, MAX_COUNT)
+                if count == 0:
+                    return method # End of file
+                offset += count
+        except (IOError, OSError), e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+            if e.errno == errno.ENOSYS:
+                _functions[method] = False # Not in this kernel
+    
+    raise ValueError('No usable copy method in ' + repr(methods))
+
+def copy_file(source, dest, methods = METHODS):
+    '''Copy file contents, permissions and times like shutil.copy2(),
+    using the first of the methods in METHODS that works.
+    Returns the name of the method that copied the data.
+    '''
+    infile = open(source, 'rb')
+    try:
+        outfile = open(dest, 'wb')
+        try:
+            method = _copy_data(infile, outfile, methods)
+        finally:
+            outfile.close()
+    finally:
+        infile.close()
+    
+    shutil.copystat(source, dest)
+    return method
+
+def _is_copied(info, target):
+    '''Return True if target is a complete copy of the file described by
+    the ResourceInfo info, made by copy_file(). Partial copies don't have
+    the modification time of the source yet.
+    '''
+    try:
+        st = os.lstat(target)
+    except OSError:
+        return False
+    
+    # Utime() only has microsecond precision.
+    return st.st_size == info.size and abs(st.st_mtime - info.mtime) < 1e-5
+
+def copy_tree(source, dest, threads = 1, resume = False):
+    '''Copy a directory tree like shutil.copytree(source, dest,
+    symlinks = True), with up to threads files copied at the same time.
+    If resume is True, dest may contain an interrupted copy, and the
+    files that were already copied completely are skipped. Broken
+    symbolic links are copied too, and a directory that can't be listed
+    raises OSError instead of being left out of the copy.
+    '''
+    pool = None
+    if threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+    
+    # Directory times are copied last, as adding the files changes them.
+    directories = []
+    pending = collections.deque()
+    
+    try:
+        for info in davutils.walk_directory(source, strict = True):
+            target = dest + info.path[len(source):]
+            
+            if info.islink:
+                if not (resume and os.path.lexists(target)):
+                    os.symlink(os.readlink(info.path), target)
+            elif info.isdir:
+                try:
+                    os.mkdir(target)
+                except OSError, e:
+                    if not (resume and e.errno == errno.EEXIST):
+                        raise
+                directories.append((info.path, target))
+            elif resume and _is_copied(info, target):
+                continue
+            elif pool is None:
+                copy_file(info.path, target)
+            else:
+                # Limit the queue, so that listing doesn't run far ahead.
+                pending.append(pool.apply_async(copy_file, (info.path, target)))
+                if len(pending) > threads * 4:
+                    pending.popleft().get()
+        
+        while pending:
+            pending.popleft().get()
+        
+        for path, target in reversed(directories):
+            shutil.copystat(path, target)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def remove(path):
+    '''Remove a file, symbolic link or directory tree.'''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def encode_path(path):
+    '''Return path as a byte string in the file system encoding, for
+    functions that don't accept unicode, like os.rename() does.
+    '''
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+# From fcntl.h and linux/fs.h
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def _find_exchange():
+    '''Return a function exchange(path1, path2) that atomically swaps two
+    paths with renameat2(RENAME_EXCHANGE), or None if it is not available.
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        import ctypes
+        function = ctypes.CDLL(None, use_errno = True).renameat2
+    except (ImportError, OSError, AttributeError):
+        return None
+    
+    function.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                         ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    function.restype = ctypes.c_int
+    
+    def exchange(path1, path2):
+        if function(AT_FDCWD, encode_path(path1), AT_FDCWD,
+                    encode_path(path2), RENAME_EXCHANGE) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    return exchange
+
+def _rename_over(source, dest):
+    '''Rename source to dest, which may be an existing file or directory.
+    Dest is always either the old or the new resource. Returns the path
+    where the old dest now is, to be removed by the caller, or None.
+    Raises OSError with EXDEV if the paths are on different file systems.
+    '''
+    if not os.path.lexists(dest):
+        os.rename(source, dest)
+        return None
+    
+    exchange = _get_function('exchange')
+    if exchange:
+        try:
+            exchange(source, dest)
+            return source
+        except OSError, e:
+            if e.errno == errno.ENOSYS:
+                _functions['exchange'] = False
+            elif e.errno not in FALLBACK_ERRORS or e.errno == errno.EXDEV:
+                raise
+    
+    if not os.path.isdir(source) and not os.path.isdir(dest):
+        os.rename(source, dest) # Atomic for files
+        return None
+    
+    # Move the old dest aside, and put it back if the rename fails.
+    aside = os.path.join(os.path.dirname(dest),
+        davutils.INTERNAL_PREFIX + 'old-' + binascii.hexlify(os.urandom(8)))
+    os.rename(dest, aside)
+    try:
+        os.rename(source, dest)
+    except:
+        os.rename(aside, dest)
+        raise
+    return aside
+
+MOVE_PREFIX = davutils.INTERNAL_PREFIX + 'move-'
+
+def move(source, dest, threads = 1):
+    '''Move a file or directory tree to dest, replacing any existing dest.
+    The old dest is removed only after the move has succeeded.
+    
+    Within a file system this is a rename. Across file systems the source
+    is copied with copy_tree() to a hidden path next to dest, which then
+    replaces dest, and finally the source is removed. If any part of the
+    source can't be read, the copy fails and the source is kept. The hidden path
+    depends only on the source and dest, so a move that is interrupted
+    and requested again continues where the first one stopped.
+    '''
+    try:
+        old = _rename_over(source, dest)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        
+        temp = os.path.join(os.path.dirname(dest),
+            MOVE_PREFIX + hashlib.md5(encode_path(source) + '\0'
+                                     + encode_path(dest)).hexdigest())
+        info = davutils.ResourceInfo(source, os.lstat(source))
+        if stat.S_ISLNK(info.stat.st_mode):
+            if os.path.lexists(temp):
+                os.unlink(temp)
+            os.symlink(os.readlink(source), temp)
+        elif info.isdir:
+            copy_tree(source, temp, threads, resume = True)
+        elif not _is_copied(info, temp):
+            copy_file(source, temp)
+        
+        old = _rename_over(temp, dest)
+        remove(source)
+    
+    if old is not None:
+        remove(old)
+
+if __name__ == '__main__':
+    import tempfile
+    print "Unit tests"
+    
+    tmpdir = tempfile.mkdtemp()
+    data = os.urandom(300000)
+    source = os.path.join(tmpdir, 'source')
+    open(source, 'wb').write(data)
+    os.chmod(source, 0640)
+    os.utime(source, (1000, 2000))
+    
+    for method in METHODS:
+        dest = os.path.join(tmpdir, 'dest-' + method)
+        used = copy_file(source, dest, [method, 'buffered'])
+        assert used in (method, 'buffered')
+        assert open(dest, 'rb').read() == data
+        assert os.stat(dest).st_mtime == 2000
+        assert os.stat(dest).st_mode & 0777 == 0640
+    
+    # Kernel copy that stops in the middle is finished by the next method
+    def cross_device(*args):
+        raise OSError(errno.EXDEV, 'Cross-device link')
+    _functions['copy_file_range'] = cross_device
+    
+    def partial(in_fd, out_fd, offset, count):
+        if offset > 0:
+            raise OSError(errno.EINVAL, 'Invalid')
+        os.write(out_fd, data[:1000])
+        return 1000
+    _functions['sendfile'] = partial
+    dest = os.path.join(tmpdir, 'dest-partial')
+    assert copy_file(source, dest) in ('clone', 'buffered')
+    assert open(dest, 'rb').read() == data
+    _functions.clear()
+    
+    # Tree copy with and without threads
+    tree = os.path.join(tmpdir, 'tree')
+    os.makedirs(os.path.join(tree, 'a', 'b'))
+    for i in range(20):
+        open(os.path.join(tree, 'a', 'b', str(i)), 'w').write(str(i) * 1000)
+    os.symlink('a', os.path.join(tree, 'link'))
+    os.utime(os.path.join(tree, 'a'), (1000, 3000))
+    
+    for threads in (1, 4):
+        copy = os.path.join(tmpdir, 'copy%d' % threads)
+        copy_tree(tree, copy, threads)
+        assert sorted(os.listdir(os.path.join(copy, 'a', 'b'))) == \
+            sorted(os.listdir(os.path.join(tree, 'a', 'b')))
+        assert open(os.path.join(copy, 'a', 'b', '7')).read() == '7' * 1000
+        assert os.readlink(os.path.join(copy, 'link')) == 'a'
+        assert os.stat(os.path.join(copy, 'a')).st_mtime == 3000
+    
+    # Broken symlinks are copied, unreadable directories are errors
+    os.symlink('missing', os.path.join(tree, 'a', 'broken'))
+    copy_tree(tree, os.path.join(tmpdir, 'copy-broken'))
+    assert os.readlink(os.path.join(tmpdir, 'copy-broken', 'a', 'broken')) \
+        == 'missing'
+    
+    real_scandir, real_listdir = davutils.scandir, os.listdir
+    def unreadable_listdir(path):
+        if path.endswith('b'):
+            raise OSError(errno.EACCES, 'Permission denied')
+        return real_listdir(path)
+    davutils.scandir, os.listdir = None, unreadable_listdir
+    try:
+        copy_tree(tree, os.path.join(tmpdir, 'copy-unreadable'))
+        assert False
+    except OSError, e:
+        assert e.errno == errno.EACCES
+    davutils.scandir, os.listdir = real_scandir, real_listdir
+    
+    # Resuming an interrupted copy
+    os.unlink(os.path.join(copy, 'a', 'b', '3'))
+    open(os.path.join(copy, 'a', 'b', '4'), 'w').write('partial')
+    copy_tree(tree, copy, 4, resume = True)
+    assert open(os.path.join(copy, 'a', 'b', '3')).read() == '3' * 1000
+    assert open(os.path.join(copy, 'a', 'b', '4')).read() == '4' * 1000
+    
+    # Moves over files and directories, with and without renameat2()
+    for exchange in (_get_function('exchange'), False):
+        _functions['exchange'] = exchange
+        open(os.path.join(tmpdir, 'file'), 'w').write('new')
+        move(os.path.join(tmpdir, 'file'), os.path.join(tmpdir, 'source'))
+        assert open(os.path.join(tmpdir, 'source')).read() == 'new'
+        
+        move(os.path.join(tmpdir, 'copy1'), os.path.join(tmpdir, 'copy4'))
+        assert not os.path.exists(os.path.join(tmpdir, 'copy1'))
+        assert os.path.exists(os.path.join(tmpdir, 'copy4', 'a', 'b', '3'))
+        
+        move(os.path.join(tmpdir, 'source'), os.path.join(tmpdir, 'copy4'))
+        assert os.path.isfile(os.path.join(tmpdir, 'copy4'))
+        copy_tree(tree, os.path.join(tmpdir, 'copy1'))
+        os.rename(os.path.join(tmpdir, 'copy4'), os.path.join(tmpdir, 'source'))
+    
+        # Non-ASCII names
+        if u'\xe4'.encode(sys.getfilesystemencoding() or 'ascii', 'replace') != '?':
+            os.mkdir(os.path.join(tmpdir, u'\xe4src'))
+            os.mkdir(os.path.join(tmpdir, u'\xe4dst'))
+            move(os.path.join(unicode(tmpdir), u'\xe4src'),
+                 os.path.join(unicode(tmpdir), u'\xe4dst'))
+            assert not os.path.exists(os.path.join(tmpdir, u'\xe4src'))
+            os.rmdir(os.path.join(tmpdir, u'\xe4dst'))
+    
+    # Failed rename leaves the old destination in place
+    real_rename = os.rename
+    def failing_rename(source, dest):
+        if not os.path.basename(dest).startswith(davutils.INTERNAL_PREFIX) \
+                and not os.path.basename(source).startswith(davutils.INTERNAL_PREFIX):
+            raise OSError(errno.EACCES, 'Permission denied')
+        real_rename(source, dest)
+    os.rename = failing_rename
+    try:
+        move(tree, os.path.join(tmpdir, 'copy1'))
+        assert False
+    except OSError:
+        pass
+    os.rename = real_rename
+    assert os.path.isdir(os.path.join(tmpdir, 'copy1', 'a'))
+    assert len(os.listdir(tmpdir)) == len(set(os.listdir(tmpdir)))
+    
+    # Move between file systems, interrupted once
+    real_rename_over = _rename_over
+    def cross_device_rename(source, dest):
+        if davutils.INTERNAL_PREFIX not in source:
+            raise OSError(errno.EXDEV, 'Cross-device link')
+        return real_rename_over(source, dest)
+    _rename_over = cross_device_rename
+    
+    real_copy_file = copy_file
+    def interrupted_copy(source, dest):
+        if source.endswith('5'):
+            raise IOError(errno.EIO, 'Input/output error')
+        real_copy_file(source, dest)
+    copy_file = interrupted_copy
+    try:
+        move(tree, os.path.join(tmpdir, 'copy1'))
+        assert False
+    except IOError:
+        pass
+    copy_file = real_copy_file
+    
+    # A directory that can't be read keeps the whole source in place
+    davutils.scandir, os.listdir = None, unreadable_listdir
+    try:
+        move(tree, os.path.join(tmpdir, 'copy1'))
+        assert False
+    except OSError, e:
+        assert e.errno == errno.EACCES
+    davutils.scandir, os.listdir = real_scandir, real_listdir
+    assert len(os.listdir(os.path.join(tree, 'a', 'b'))) == 20
+    
+    move(tree, os.path.join(tmpdir, 'copy1'))
+    
+    assert not os.path.exists(tree)
+    assert os.path.islink(os.path.join(tmpdir, 'copy1', 'a', 'broken'))
+    
+    if u'\xe4'.encode(sys.getfilesystemencoding() or 'ascii', 'replace') != '?':
+        os.mkdir(os.path.join(tmpdir, u'\xe4src'))
+        open(os.path.join(tmpdir, u'\xe4src', u'\xf6'), 'w').write('x')
+        os.mkdir(os.path.join(tmpdir, u'\xe4dst'))
+        move(os.path.join(unicode(tmpdir), u'\xe4src'),
+             os.path.join(unicode(tmpdir), u'\xe4dst'))
+        assert os.listdir(os.path.join(tmpdir, u'\xe4dst')) == [u'\xf6']
+        shutil.rmtree(os.path.join(tmpdir, u'\xe4dst'))
+    assert open(os.path.join(tmpdir, 'copy1', 'a', 'b', '5')).read() == '5' * 1000
+    assert os.readlink(os.path.join(tmpdir, 'copy1', 'link')) == 'a'
+    assert [name for name in os.listdir(tmpdir)
+            if name.startswith(davutils.INTERNAL_PREFIX)] == []
+    
+    shutil.rmtree(tmpdir)
+    
+    print "Unit tests OK"
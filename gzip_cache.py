@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+'''Gzip Content-Encoding for downloads of compressible files.
+
+The first download of a file is compressed while it is sent, and the
+result is stored in a hidden sidecar file next to it. Later downloads
+send the sidecar as long as it is fresh. The sidecar has the modification
+time of the original file, and the gzip trailer records the original
+size, so a changed file is detected without reading it. Files that don't
+compress well get an empty sidecar as a marker, and are sent uncompressed.
+If the sidecar can't be written, the file is still sent compressed.
+'''
+
+import fnmatch
+import logging
+import os
+import os.path
+import struct
+import zlib
+
+import davutils
+
+SIDECAR_PREFIX = davutils.INTERNAL_PREFIX + 'gz.'
+
+def get_sidecar_path(real_path):
+    '''Return the path of the compressed copy of real_path.'''
+    return os.path.join(os.path.dirname(real_path),
+                        SIDECAR_PREFIX + os.path.basename(real_path))
+
+def remove_sidecar(real_path):
+    '''Remove the compressed copy of a deleted or moved file.'''
+    try:
+        os.unlink(get_sidecar_path(real_path))
+    except OSError:
+        pass
+
+def is_compressible(content_type, size):
+    '''Return True if files of content_type and size should be compressed,
+    according to config.gzip_types and config.gzip_min_size.
+    '''
+    if size < config.gzip_min_size:
+        return False
+    
+    for pattern in config.gzip_types:
+        if fnmatch.fnmatch(content_type, pattern):
+            return True
+    return False
+
+def accepts_gzip(accept_encoding):
+    '''Return True if an Accept-Encoding header allows gzip encoding.'''
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if coding not in ('gzip', 'x-gzip', '*'):
+            continue
+        
+        quality = 1.0
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        
+        return quality > 0
+    return False
+
+def gzip_etag(etag):
+    '''Return the ETag of the gzip encoded representation, which must
+    differ from the ETag of the plain file.
+    '''
+    return etag[:-1] + '-gzip"'
+
+def open_sidecar(info):
+    '''Return a tuple (file, size) for a fresh sidecar of the file
+    described by info, or None if there is none. The file is None if
+    the sidecar is a marker for a file that doesn't compress well enough.
+    '''
+    try:
+        sidecar = open(get_sidecar_path(info.path), 'rb')
+    except IOError:
+        return None
+    
+    try:
+        st = os.fstat(sidecar.fileno())
+        
+        # Utime() only has microsecond precision.
+        fresh = abs(st.st_mtime - info.mtime) < 1e-5
+        if fresh and st.st_size == 0:
+            sidecar.close()
+            return None, 0 # Marker of an incompressible file
+        
+        fresh = fresh and st.st_size >= 18
+        if fresh:
+            sidecar.seek(-4, 2)
+            isize = struct.unpack('<I', sidecar.read(4))[0]
+            fresh = isize == info.size & 0xffffffff
+        
+        if not fresh:
+            sidecar.close()
+            return None
+        
+        if st.st_size > info.size * config.gzip_max_ratio:
+            sidecar.close()
+            return None, st.st_size
+        
+        sidecar.seek(0)
+        return sidecar, st.st_size
+    except:
+        sidecar.close()
+        raise
+
+def _gzip_blocks(infile, blocksize):
+    '''Generate the gzip encoded contents of infile.'''
+    # Window bits 16 + MAX_WBITS give gzip header and trailer.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in davutils.read_blocks(infile, None, blocksize):
+        yield compressor.compress(block)
+    yield compressor.flush()
+
+def compress_file(info, blocksize = 64*1024):
+    '''Generate the gzip encoded contents of the file described by info,
+    writing them also to a new sidecar. The sidecar replaces any old one
+    once the whole file has been compressed and the file has not changed
+    in the meantime. If the result is too large to be worth sending, the
+    sidecar is left empty as a marker. Errors in writing the sidecar
+    don't interrupt the response, the sidecar is just given up.
+    '''
+    directory = os.path.dirname(info.path)
+    infile = open(info.path, 'rb')
+    max_size = info.size * config.gzip_max_ratio
+    written = 0
+    
+    try:
+        temp_path, outfile = davutils.create_temp_file(directory)
+    except (IOError, OSError), e:
+        logging.info('Not caching compressed file: ' + str(e))
+        temp_path, outfile = None, None
+    caching = outfile is not None
+    
+    try:
+        for data in _gzip_blocks(infile, blocksize):
+            if not data:
+                continue
+            
+            written += len(data)
+            if caching:
+                try:
+                    if written <= max_size:
+                        outfile.write(data)
+                    elif written - len(data) <= max_size:
+                        outfile.truncate(0) # Only a marker is kept
+                except (IOError, OSError), e:
+                    logging.info('Not caching compressed file: ' + str(e))
+                    caching = False
+            yield data
+        
+        if caching:
+            try:
+                outfile.close()
+                # The file must not have changed or been replaced while
+                # it was compressed, or the sidecar would be stale.
+                st = os.fstat(infile.fileno())
+                current = os.stat(info.path)
+                if (st.st_mtime == info.mtime and st.st_size == info.size
+                        and (st.st_dev, st.st_ino)
+                            == (current.st_dev, current.st_ino)):
+                    os.utime(temp_path, (st.st_atime, st.st_mtime))
+                    davutils.replace_file(temp_path,
+                                          get_sidecar_path(info.path))
+                    temp_path = None
+            except (IOError, OSError), e:
+                logging.info('Not caching compressed file: ' + str(e))
+    finally:
+        infile.close()
+        if outfile is not None:
+            try:
+                outfile.close()
+            except IOError:
+                pass
+        if temp_path is not None:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import gzip
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        gzip_types = ['text/*', 'application/json']
+        gzip_min_size = 100
+        gzip_max_ratio = 0.9
+    
+    assert accepts_gzip('gzip, deflate')
+    assert accepts_gzip('deflate, GZIP;q=0.5')
+    assert accepts_gzip('*')
+    assert not accepts_gzip('gzip;q=0, identity')
+    assert not accepts_gzip('deflate')
+    assert not accepts_gzip('')
+    
+    assert is_compressible('text/csv', 1000)
+    assert not is_compressible('text/csv', 10)
+    assert not is_compressible('image/png', 1000)
+    assert gzip_etag('"123S4"') == '"123S4-gzip"'
+    
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'data.csv')
+    data = 'a,b,c\n' * 10000
+    open(path, 'w').write(data)
+    info = davutils.ResourceInfo(path)
+    
+    assert open_sidecar(info) is None
+    compressed = ''.join(compress_file(info))
+    assert gzip.GzipFile(fileobj = StringIO(compressed)).read() == data
+    assert sorted(os.listdir(tmpdir)) == [SIDECAR_PREFIX + 'data.csv', 'data.csv']
+    
+    sidecar, size = open_sidecar(info)
+    assert sidecar.read() == compressed and size == len(compressed)
+    sidecar.close()
+    
+    # Changed file makes the sidecar stale
+    open(path, 'a').write('x')
+    assert open_sidecar(davutils.ResourceInfo(path)) is None
+    
+    # Incompressible data gets a marker without a file
+    path = os.path.join(tmpdir, 'random.txt')
+    open(path, 'wb').write(os.urandom(1000))
+    info = davutils.ResourceInfo(path)
+    ''.join(compress_file(info))
+    assert open_sidecar(info) == (None, 0)
+    assert os.path.getsize(get_sidecar_path(path)) == 0
+    
+    # Interrupted compression leaves nothing behind
+    stream = compress_file(davutils.ResourceInfo(os.path.join(tmpdir, 'data.csv')), 100)
+    stream.next()
+    stream.close()
+    remove_sidecar(path)
+    assert len(os.listdir(tmpdir)) == 3
+    
+    # A file replaced while it is compressed gets no sidecar
+    path = os.path.join(tmpdir, 'replaced.csv')
+    open(path, 'w').write(data)
+    info = davutils.ResourceInfo(path)
+    stream = compress_file(info, 1000)
+    stream.next()
+    open(path + '.new', 'w').write(data.upper())
+    os.utime(path + '.new', (info.mtime, info.mtime))
+    os.rename(path + '.new', path)
+    ''.join(stream)
+    assert open_sidecar(info) is None
+    os.unlink(path)
+    
+    # Failures to write the sidecar don't break the response
+    path = os.path.join(tmpdir, 'data.csv')
+    remove_sidecar(path)
+    info = davutils.ResourceInfo(path)
+    data = open(path).read()
+    
+    class FullFile:
+        '''File object on a full disk'''
+        def write(self, data):
+            raise IOError(28, 'No space left on device')
+        def close(self):
+            pass
+    
+    original = davutils.create_temp_file
+    def create_readonly(directory):
+        raise OSError(13, 'Permission denied')
+    def create_full(directory):
+        temp_path, outfile = original(directory)
+        outfile.close()
+        return temp_path, FullFile()
+    
+    for davutils.create_temp_file in [create_readonly, create_full]:
+        compressed = ''.join(compress_file(info, 100))
+        assert gzip.GzipFile(fileobj = StringIO(compressed)).read() == data
+        assert open_sidecar(info) is None
+        assert len(os.listdir(tmpdir)) == 2
+    davutils.create_temp_file = original
+    
+    shutil.rmtree(tmpdir)
+    
+    print "Unit tests OK"
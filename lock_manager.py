@@ -7,7 +7,6 @@ and cross-thread synchronization, while this code handles WebDAV lock semantics.
 import os.path
 import davutils
 import sqlite3
-from uuid import uuid4
 import datetime
 from davutils import DAVError
 
@@ -34,6 +33,42 @@ class Lock:
         delta = self.valid_until - datetime.datetime.utcnow()
         return delta.seconds + delta.days * 86400
 
+class LockSet:
+    '''Locks loaded with a single LockManager.get_locks() call, for finding
+    the locks that apply to each resource of a listing without further
+    queries.
+    '''
+    def __init__(self, locks):
+        self._locks = {} # Path => list of Lock objects
+        for lock in locks:
+            self._locks.setdefault(lock.path, []).append(lock)
+    
+    def __len__(self):
+        return sum(map(len, self._locks.values()))
+    
+    def get_locks(self, rel_path):
+        '''Return the locks that apply to rel_path: locks on the resource
+        itself and infinite depth locks on its parent collections.
+        '''
+        result = list(self._locks.get(rel_path, []))
+        
+        partial_path = rel_path
+        while partial_path:
+            partial_path = os.path.dirname(partial_path)
+            for lock in self._locks.get(partial_path, []):
+                if lock.infinite_depth:
+                    result.append(lock)
+        
+        return result
+
+# Statements that upgrade the database schema, one list per version.
+SCHEMA_UPGRADES = [
+    # Version 1: Infinite depth locks on the parents of a path are found
+    # from the index, without reading the table rows of other locks.
+    ['CREATE INDEX IF NOT EXISTS locks_idx3 ON locks (path, infinite_depth)',
+     'DROP INDEX IF EXISTS locks_idx1'],
+]
+
 class LockManager:
     '''Implementation of WebDAV lock semantics.'''
     def __init__(self):
@@ -51,6 +86,7 @@ class LockManager:
         if newfile:
             self._create_tables()
         else:
+            self._upgrade_tables()
             self._purge_locks()
     
     def _create_tables(self):
@@ -62,8 +98,35 @@ class LockManager:
             infinite_depth BOOLEAN,
             valid_until TIMESTAMP)''')
         
-        self._sql_query('CREATE INDEX locks_idx1 ON locks (path)')
+        self._sql_query('''CREATE INDEX locks_idx3
+            ON locks (path, infinite_depth)''')
         self._sql_query('CREATE INDEX locks_idx2 ON locks (valid_until)')
+        self._sql_query('PRAGMA user_version = ' + str(len(SCHEMA_UPGRADES)))
+    
+    def _upgrade_tables(self):
+        '''Apply the SCHEMA_UPGRADES that a database created by an older
+        version is missing. The version is kept in the user_version field
+        of the database header.
+        '''
+        self._sql_query('PRAGMA user_version')
+        if self.db_cursor.fetchone()[0] >= len(SCHEMA_UPGRADES):
+            return
+        
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            # Another process may have upgraded the database meanwhile.
+            self._sql_query('PRAGMA user_version')
+            version = self.db_cursor.fetchone()[0]
+            for statements in SCHEMA_UPGRADES[version:]:
+                for statement in statements:
+                    self._sql_query(statement)
+            
+            self._sql_query('PRAGMA user_version = '
+                            + str(len(SCHEMA_UPGRADES)))
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
     
     def _purge_locks(self):
         '''Remove all expired locks from the database.'''
@@ -96,32 +159,36 @@ class LockManager:
          - If recursive is True, locks on any resources inside the collection
         Result is a list of Lock objects.
         '''
+        self._sql_query(*self._locks_query(rel_path, recursive))
+        return map(Lock, self.db_cursor.fetchall())
+    
+    def _locks_query(self, rel_path, recursive):
+        '''Return the SQL statement and its arguments for get_locks().'''
         assert not rel_path.startswith('/')
         path_exprs = ['path = ?']
         path_args = [rel_path]
         
         # Construct a list of parent directories that have to be checked
-        # for locks.
+        # for infinite depth locks.
+        parents = []
         partial_path = rel_path
         while partial_path:
             partial_path = os.path.dirname(partial_path)
-            path_exprs.append('(infinite_depth AND path = ?)')
-            path_args.append(partial_path)
-
+            parents.append(partial_path)
+        
+        if parents:
+            path_exprs.append('(path IN (' + ','.join('?' * len(parents))
+                              + ') AND infinite_depth)')
+            path_args += parents
+        
         # Check for any resources inside this collection
         if recursive:
-            if rel_path != '':
-                prefix = rel_path + '/'
-            else:
-                prefix = ''
-            
-            path_exprs.append('SUBSTR(path,1,?) = ?')
-            path_args.append(len(prefix))
-            path_args.append(prefix)
-
-        self._sql_query('SELECT * FROM locks WHERE '
-            + ' OR '.join(path_exprs), path_args)
-        return map(Lock, self.db_cursor.fetchall())
+            condition, args = davutils.subtree_condition(rel_path)
+            path_exprs.append('(' + condition + ')')
+            path_args += args
+        
+        # Each term is a lookup or range scan of the path index.
+        return 'SELECT * FROM locks WHERE ' + ' OR '.join(path_exprs), path_args
     
     def validate_lock(self, rel_path, urn):
         '''Check that a lock with the specified urn exists and that it applies
@@ -157,6 +224,7 @@ class LockManager:
         assert depth in [-1, 0]
         assert not rel_path.startswith('/')
         
+        from uuid import uuid4 # Loads libuuid with ctypes on import
         urn = uuid4().urn
         timeout = min(timeout, config.lock_max_time) or config.lock_max_time
         valid_until = datetime.datetime.utcnow()
@@ -197,6 +265,26 @@ class LockManager:
             self._sql_query('ROLLBACK')
             raise
 
+    def release_subtree(self, rel_path):
+        '''Remove all locks on rel_path and on any resources inside it,
+        when the resource is deleted or moved. Returns the number of
+        locks removed.
+        '''
+        assert not rel_path.startswith('/')
+        condition, args = davutils.subtree_condition(rel_path)
+        
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._sql_query('DELETE FROM locks WHERE path = ? OR ('
+                + condition + ')', [rel_path] + args)
+            count = self.db_cursor.rowcount
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+        
+        return count
+    
     def refresh_lock(self, rel_path, urn, timeout):
         '''Refresh the given lock and return new Lock object.'''
         timeout = min(timeout, config.lock_max_time) or config.lock_max_time
@@ -269,12 +357,59 @@ else:
     lock4 = mgr1.create_lock('testdir/testfile3', False, '', -1, 100)
     assert mgr1.get_locks('testdir', True) == [lock4]
     
+    # Lock set for a listing of the whole tree
+    lockset = LockSet(mgr1.get_locks('', True))
+    assert len(lockset) == 4
+    assert len(lockset.get_locks('testfile2/subdir')) == 2
+    assert lock3 in lockset.get_locks('testfile2/subdir')
+    assert lockset.get_locks('testfile') == [lock1]
+    assert lockset.get_locks('testdir') == []
+    assert lockset.get_locks('testdir/testfile3/x') == [lock4]
+    
     mgr1.release_lock(lock1.path, lock1.urn)
     mgr1.release_lock(lock2.path, lock2.urn)
     mgr1.release_lock(lock3.path, lock3.urn)
     
     assert not mgr1.validate_lock(lock1.path, lock1.urn)
     
+    # Removing a subtree leaves other paths with the same prefix
+    for path in ['tree', 'tree/a', 'tree/a/b', u'tree/\xe4', 'tree0', 'tree.txt', 'treeb']:
+        mgr1.create_lock(path, True, '', 0, 100)
+    assert mgr1.release_subtree('tree') == 4
+    assert sorted([lock.path for lock in mgr1.get_locks('', True)]) == \
+        ['testdir/testfile3', 'tree.txt', 'tree0', 'treeb']
+    assert mgr1.release_subtree('') == 4
+    
+    # Queries use the index
+    for rel_path, recursive in [('a/b', True), ('a/b', False), ('', True)]:
+        sql, args = mgr1._locks_query(rel_path, recursive)
+        mgr1._sql_query('EXPLAIN QUERY PLAN ' + sql, args)
+        plan = repr([tuple(row) for row in mgr1.db_cursor.fetchall()])
+        assert 'SEARCH' in plan and 'SCAN' not in plan
+    
+    # Upgrade of a database created by an older version
+    old_db = sqlite3.connect(config.lock_db + '.old')
+    old_db.execute('''CREATE TABLE locks (urn TEXT PRIMARY KEY, path TEXT,
+        shared BOOLEAN, owner TEXT, infinite_depth BOOLEAN,
+        valid_until TIMESTAMP)''')
+    old_db.execute('CREATE INDEX locks_idx1 ON locks (path)')
+    old_db.execute('CREATE INDEX locks_idx2 ON locks (valid_until)')
+    old_db.execute('''INSERT INTO locks VALUES ('urn:x', 'dir', 0, '', 1,
+        DATETIME('now', '+1 hour'))''')
+    old_db.commit()
+    old_db.close()
+    
+    config.lock_db += '.old'
+    mgr3 = LockManager()
+    mgr3._sql_query('PRAGMA user_version')
+    assert mgr3.db_cursor.fetchone()[0] == len(SCHEMA_UPGRADES)
+    mgr3._sql_query("SELECT name FROM sqlite_master WHERE type = 'index'")
+    assert 'locks_idx1' not in repr(mgr3.db_cursor.fetchall())
+    assert [lock.urn for lock in mgr3.get_locks('dir/file', False)] == ['urn:x']
+    assert LockManager().get_locks('dir', True) == mgr3.get_locks('dir', True)
+    os.unlink(config.lock_db)
+    config.lock_db = config.lock_db[:-4]
+    
     # Test lock timeouts
     lock1 = mgr1.create_lock('testfile', False, '', 0, 2)
     lock2 = mgr1.create_lock('testfile2', False, '', 0, 2)
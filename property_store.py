@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''Stores dead properties, i.e. arbitrary properties set by clients with
+PROPPATCH, in a SQLite database. Each property is stored as the XML of the
+complete property element, keyed by the path of the resource relative to
+root_dir.
+'''
+
+import os.path
+import sqlite3
+import davutils
+from davutils import DAVError
+
+class PropertyStore:
+    '''Storage for dead properties of resources.'''
+    def __init__(self):
+        # Property_db can be absolute path or relative to root dir.
+        dbpath = os.path.join(config.root_dir, config.property_db)
+        newfile = not os.path.exists(dbpath)
+        
+        self.db_conn = sqlite3.connect(dbpath,
+            isolation_level = None,
+            timeout = config.lock_wait)
+        self.db_cursor = self.db_conn.cursor()
+        
+        if newfile:
+            self._create_tables()
+    
+    def _create_tables(self):
+        # Parent is the path of the parent collection, for fetching the
+        # properties of all entries of a directory at once.
+        self._sql_query('''CREATE TABLE IF NOT EXISTS properties (
+            path TEXT,
+            parent TEXT,
+            name TEXT,
+            value TEXT,
+            PRIMARY KEY (path, name))''')
+        
+        self._sql_query('''CREATE INDEX IF NOT EXISTS properties_idx1
+            ON properties (parent)''')
+    
+    def _sql_query(self, *args, **kwargs):
+        '''Run a database query and wrap SQLite OperationalErrors, such
+        as locked databases.
+        '''
+        try:
+            self.db_cursor.execute(*args, **kwargs)
+        except sqlite3.OperationalError, e:
+            if 'locked' in e.message:
+                raise DAVError('503 Service Unavailable: Property DB is busy')
+            else:
+                raise DAVError('500 Internal Server Error: Property DB: '
+                               + e.message)
+    
+    def _fetch_dict(self):
+        '''Collect the results of a query on path, name, value to a
+        dictionary of path => list of (name, value).
+        '''
+        result = {}
+        for path, name, value in self.db_cursor.fetchall():
+            result.setdefault(path, []).append((name, value))
+        return result
+    
+    def get_properties(self, rel_path):
+        '''Return a list of (name, value) tuples for the dead properties
+        of a single resource. Value is the property element as XML.
+        '''
+        self._sql_query('''SELECT path, name, value FROM properties
+            WHERE path = ?''', (rel_path, ))
+        return self._fetch_dict().get(rel_path, [])
+    
+    def get_children_properties(self, rel_path):
+        '''Return the dead properties of all resources directly inside
+        the collection rel_path, as a dictionary of
+        path => list of (name, value) tuples.
+        '''
+        self._sql_query('''SELECT path, name, value FROM properties
+            WHERE parent = ? AND path != ?''', (rel_path, rel_path))
+        return self._fetch_dict()
+    
+    def set_properties(self, rel_path, changes):
+        '''Apply a list of changes to the properties of a resource in a
+        single transaction. Each change is a tuple (name, value), where
+        value None removes the property.
+        '''
+        parent = os.path.dirname(rel_path)
+        
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            for name, value in changes:
+                if value is None:
+                    self._sql_query('''DELETE FROM properties
+                        WHERE path = ? AND name = ?''', (rel_path, name))
+                else:
+                    self._sql_query('''INSERT OR REPLACE INTO properties
+                        VALUES (?,?,?,?)''', (rel_path, parent, name, value))
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+    
+    def _delete(self, rel_path):
+        '''Delete properties of rel_path and everything inside it.'''
+        condition, args = davutils.subtree_condition(rel_path)
+        self._sql_query('DELETE FROM properties WHERE path = ? OR ('
+            + condition + ')', [rel_path] + args)
+    
+    def delete(self, rel_path):
+        '''Remove the properties of a deleted resource and all resources
+        inside it.
+        '''
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._delete(rel_path)
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+    
+    def _copy_rows(self, source, dest, move, recursive):
+        '''Copy or move the rows of source and optionally everything inside
+        it to dest, replacing any existing properties of dest.
+        '''
+        self._delete(dest)
+        
+        # Rows of the resource itself get a new parent, rows inside it
+        # keep their parent relative to the moved resource.
+        condition, args = davutils.subtree_condition(source)
+        cut = len(source) + 1
+        if move:
+            self._sql_query('''UPDATE properties SET path = ?, parent = ?
+                WHERE path = ?''', (dest, os.path.dirname(dest), source))
+            if recursive:
+                self._sql_query('''UPDATE properties
+                    SET path = ? || SUBSTR(path, ?),
+                        parent = ? || SUBSTR(parent, ?)
+                    WHERE ''' + condition, [dest, cut, dest, cut] + args)
+        else:
+            self._sql_query('''INSERT INTO properties
+                SELECT ?, ?, name, value FROM properties
+                WHERE path = ?''', (dest, os.path.dirname(dest), source))
+            if recursive:
+                self._sql_query('''INSERT INTO properties
+                    SELECT ? || SUBSTR(path, ?), ? || SUBSTR(parent, ?),
+                        name, value
+                    FROM properties WHERE ''' + condition,
+                    [dest, cut, dest, cut] + args)
+    
+    def copy(self, source, dest, recursive = True):
+        '''Copy the properties of source to dest. If recursive is True,
+        also copy the properties of all resources inside source.
+        '''
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._copy_rows(source, dest, False, recursive)
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+    
+    def move(self, source, dest):
+        '''Move the properties of source and all resources inside it
+        to dest.
+        '''
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._copy_rows(source, dest, True, True)
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+
+class PropertyReader:
+    '''Reads dead properties for the resources of a directory walk.
+    The properties of all entries in a directory are fetched with a single
+    query when the first entry is requested, and kept for as long as the
+    walk is inside that directory.
+    '''
+    def __init__(self, store, start_path):
+        self.store = store
+        self.start_path = start_path
+        self._directories = {}
+    
+    def get(self, rel_path):
+        '''Return the list of (name, value) tuples for rel_path.'''
+        if rel_path == self.start_path:
+            return self.store.get_properties(rel_path)
+        
+        parent = os.path.dirname(rel_path)
+        properties = self._directories.get(parent)
+        
+        if properties is None:
+            # The walk has finished with any directory that is not
+            # a parent of this one.
+            for path in self._directories.keys():
+                if not davutils.path_inside_directory(parent, path):
+                    del self._directories[path]
+            
+            properties = self.store.get_children_properties(parent)
+            self._directories[parent] = properties
+        
+        return properties.get(rel_path, [])
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import tempfile
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = '/tmp'
+        property_db = tempfile.mktemp()
+        lock_wait = 5
+    
+    store = PropertyStore()
+    
+    store.set_properties(u'dir', [('{urn:x}a', '<a/>')])
+    store.set_properties(u'dir/file', [('{urn:x}a', '<a/>'), ('{urn:x}b', '<b/>')])
+    store.set_properties(u'dir/sub/file', [('{urn:x}c', '<c/>')])
+    store.set_properties(u'dir2/file', [('{urn:x}d', '<d/>')])
+    store.set_properties(u'dir/file', [('{urn:x}b', None)])
+    
+    assert store.get_properties(u'dir/file') == [('{urn:x}a', '<a/>')]
+    assert store.get_children_properties(u'dir') == {
+        u'dir/file': [('{urn:x}a', '<a/>')]}
+    assert store.get_children_properties(u'') == {u'dir': [('{urn:x}a', '<a/>')]}
+    
+    # Reader fetches whole directories and drops finished ones
+    reader = PropertyReader(store, u'dir')
+    assert reader.get(u'dir') == [('{urn:x}a', '<a/>')]
+    assert reader.get(u'dir/file') == [('{urn:x}a', '<a/>')]
+    assert reader.get(u'dir/sub/file') == [('{urn:x}c', '<c/>')]
+    assert sorted(reader._directories.keys()) == [u'dir', u'dir/sub']
+    assert reader.get(u'dir/other') == []
+    assert reader.get(u'dir2/file') == [('{urn:x}d', '<d/>')]
+    assert reader._directories.keys() == [u'dir2']
+    
+    store.copy(u'dir', u'copy')
+    assert store.get_properties(u'copy/sub/file') == [('{urn:x}c', '<c/>')]
+    assert store.get_children_properties(u'copy/sub') == {
+        u'copy/sub/file': [('{urn:x}c', '<c/>')]}
+    
+    store.copy(u'dir', u'copy0', recursive = False)
+    assert store.get_properties(u'copy0') == [('{urn:x}a', '<a/>')]
+    assert store.get_properties(u'copy0/file') == []
+    
+    # Move overwrites the destination and leaves the similarly
+    # named dir2 alone
+    store.move(u'copy', u'dir2')
+    assert store.get_properties(u'dir2/file') == [('{urn:x}a', '<a/>')]
+    assert store.get_children_properties(u'dir2') == {
+        u'dir2/file': [('{urn:x}a', '<a/>')]}
+    assert store.get_properties(u'copy/file') == []
+    assert store.get_properties(u'dir2/sub/file') == [('{urn:x}c', '<c/>')]
+    
+    store.delete(u'dir')
+    assert store.get_properties(u'dir') == []
+    assert store.get_properties(u'dir/sub/file') == []
+    assert store.get_properties(u'dir2/file') == [('{urn:x}a', '<a/>')]
+    
+    store.delete(u'')
+    assert store.get_properties(u'dir2/file') == []
+    
+    os.unlink(config.property_db)
+    
+    print "Unit tests OK"
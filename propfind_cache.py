@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+'''In-process cache for rendered PROPFIND responses. Long-lived FCGI
+processes keep the <DAV:response> fragments of recently listed
+directories, so that clients polling the same directories don't cause
+the directory to be listed, access checked and rendered again.
+'''
+
+import os.path
+import threading
+import time
+
+class PropfindCache:
+    '''Least recently used cache of rendered PROPFIND listings.
+    
+    Keys are tuples whose first item is the real path of the listed
+    directory. The rest of the key should describe everything else the
+    response depends on. Values are lists of strings, and the cache
+    keeps their total length below max_size bytes.
+    Entries older than max_age seconds are never returned.
+    
+    Counters hits and misses report the cache efficiency. The cache
+    may be shared by the threads of the server.
+    '''
+    def __init__(self, max_size, max_age = None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        
+        # Entries are kept in a doubly linked list in the order of use,
+        # most recently used first. Each link is a list:
+        # [prev, next, key, fragments, size, timestamp]
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0, 0]
+        self._links = {}
+        self._paths = {} # Real path => set of keys
+        self._below = {} # Directory => set of cached real paths inside it
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._links)
+    
+    def enabled(self):
+        '''Return True if the cache is configured to store anything.'''
+        return self.max_size > 0
+    
+    def get(self, key):
+        '''Return the fragments stored for key, or None.'''
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            
+            if (link is not None and self.max_age is not None
+                    and time.time() - link[5] > self.max_age):
+                self._remove(key)
+                link = None
+            
+            if link is None:
+                self.misses += 1
+                return None
+            
+            self._unlink(link)
+            self._link_first(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self._lock.release()
+    
+    def put(self, key, fragments):
+        '''Store the fragments for key, evicting least recently used
+        entries as needed. Entries larger than the whole cache are
+        not stored.
+        '''
+        size = sum(map(len, fragments))
+        if size > self.max_size:
+            return
+        
+        self._lock.acquire()
+        try:
+            if key in self._links:
+                self._remove(key)
+            
+            while self.size + size > self.max_size:
+                self._remove(self._root[0][2]) # Least recently used
+            
+            link = [None, None, key, fragments, size, time.time()]
+            self._link_first(link)
+            self._links[key] = link
+            
+            path = os.path.normpath(key[0])
+            if path not in self._paths:
+                self._paths[path] = set()
+                for parent in self._parents(path):
+                    self._below.setdefault(parent, set()).add(path)
+            self._paths[path].add(key)
+            self.size += size
+        finally:
+            self._lock.release()
+    
+    def invalidate(self, real_path):
+        '''Drop all entries that may be affected by a change to real_path:
+        listings of the path itself, of anything inside it and of all its
+        parent directories.
+        '''
+        real_path = os.path.normpath(real_path)
+        
+        self._lock.acquire()
+        try:
+            paths = set(self._below.get(real_path, ()))
+            paths.add(real_path)
+            paths.update(self._parents(real_path))
+            
+            for path in paths:
+                for key in list(self._paths.get(path, ())):
+                    self._remove(key)
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        '''Drop all entries, keeping the hit and miss counters.'''
+        self._lock.acquire()
+        try:
+            for key in self._links.keys():
+                self._remove(key)
+        finally:
+            self._lock.release()
+    
+    def stats(self):
+        '''Return a string describing the cache state, for logging.'''
+        return ('PropfindCache: ' + str(len(self)) + ' entries, '
+            + str(self.size) + ' bytes, ' + str(self.hits) + ' hits, '
+            + str(self.misses) + ' misses')
+    
+    def _parents(self, path):
+        '''Return the parent directories of a normalized path.'''
+        parents = []
+        parent = os.path.dirname(path)
+        while parent != path:
+            parents.append(parent)
+            path, parent = parent, os.path.dirname(parent)
+        return parents
+    
+    def _link_first(self, link):
+        '''Insert link as the most recently used entry.'''
+        root = self._root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+    
+    def _unlink(self, link):
+        '''Remove link from the usage order list.'''
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+    
+    def _remove(self, key):
+        '''Remove a single entry from the cache. The caller holds the lock.'''
+        link = self._links.pop(key)
+        self._unlink(link)
+        self.size -= link[4]
+        
+        path = os.path.normpath(key[0])
+        keys = self._paths[path]
+        keys.discard(key)
+        if not keys:
+            del self._paths[path]
+            for parent in self._parents(path):
+                self._below[parent].discard(path)
+                if not self._below[parent]:
+                    del self._below[parent]
+
+if __name__ == '__main__':
+    print "Unit tests"
+    
+    cache = PropfindCache(100)
+    assert cache.get(('/tmp/a', 1)) is None
+    assert cache.misses == 1
+    
+    cache.put(('/tmp/a', 1), ['x' * 40])
+    cache.put(('/tmp/b', 1), ['x' * 20, 'x' * 20])
+    assert cache.get(('/tmp/a', 1)) == ['x' * 40]
+    assert cache.hits == 1
+    
+    # Least recently used entry /tmp/b gets evicted
+    cache.put(('/tmp/c', 1), ['x' * 40])
+    assert cache.get(('/tmp/b', 1)) is None
+    assert cache.get(('/tmp/a', 1)) is not None
+    assert cache.size == 80 and len(cache) == 2
+    
+    # Entries that don't fit at all are not stored
+    cache.put(('/tmp/d', 1), ['x' * 101])
+    assert len(cache) == 2
+    
+    # Replacing an entry
+    cache.put(('/tmp/a', 1), ['x' * 10])
+    assert cache.size == 50
+    
+    # Invalidation of parents and children
+    cache.put(('/tmp', 1), ['x'])
+    cache.put(('/tmp/a/b', 1), ['x'])
+    cache.put(('/tmp/a/b', 2), ['x'])
+    cache.invalidate('/tmp/a')
+    assert cache.get(('/tmp', 1)) is None
+    assert cache.get(('/tmp/a', 1)) is None
+    assert cache.get(('/tmp/a/b', 2)) is None
+    assert cache.get(('/tmp/c', 1)) is not None
+    assert cache.size == 40 and len(cache) == 1
+    
+    cache.clear()
+    assert cache.size == 0 and len(cache) == 0
+    assert cache._paths == {} and cache._below == {}
+    
+    # Invalidation doesn't touch siblings or paths with a common prefix
+    cache.put(('/tmp/a/', 1), ['x'])
+    cache.put(('/tmp/ab', 1), ['x'])
+    cache.put(('/tmp/a/b/c', 1), ['x'])
+    cache.put(('/var', 1), ['x'])
+    cache.invalidate('/tmp/a/')
+    assert cache.get(('/tmp/a/', 1)) is None
+    assert cache.get(('/tmp/a/b/c', 1)) is None
+    assert cache.get(('/tmp/ab', 1)) is not None
+    assert cache.get(('/var', 1)) is not None
+    cache.invalidate('/')
+    assert len(cache) == 0 and cache._below == {}
+    
+    # Concurrent use from several threads
+    def worker(n):
+        for i in range(2000):
+            path = '/tmp/%d/%d' % (n, i % 7)
+            cache.put((path, 1), ['x' * 10])
+            cache.get((path, 1))
+            cache.invalidate('/tmp/%d' % ((n + i) % 4))
+    threads = [threading.Thread(target = worker, args = (n, ))
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.size == 10 * len(cache) <= 100
+    
+    # Maximum age
+    cache = PropfindCache(100, 0)
+    cache.put(('/tmp', 1), ['x'])
+    time.sleep(0.01)
+    assert cache.get(('/tmp', 1)) is None
+    assert len(cache) == 0
+    
+    print "Unit tests OK"
@@ -6,16 +6,23 @@ import logging
 import os.path
 import unicodedata
 import urlparse
-import urllib
 import wsgiref.util
 import xml.etree.ElementTree as ET
 from xml.parsers.expat import ExpatError
 
 import davutils
+import etag_store
 from davutils import DAVError
 from lock_manager import LockManager
+from property_store import PropertyStore
 import webdavconfig as config
 
+# Access restrictions from configuration, compiled once at load time.
+# EasyDAV's own internal files are always hidden.
+access_matcher = davutils.PathMatcher(list(config.restrict_access)
+                                      + [davutils.INTERNAL_PREFIX + '*'])
+write_matcher = davutils.PathMatcher(config.restrict_write)
+
 class RequestInfo(object):
     '''Parses WSGI environment dictionary and gives easy access to parameters
     that are relevant for WebDAV.
@@ -32,6 +39,7 @@ class RequestInfo(object):
         else:
             self.length = 0
         self._lockmanager = None
+        self._propertystore = None
         self.root_url = self.get_root_url()
         self.check_if_header()
     
@@ -45,6 +53,14 @@ class RequestInfo(object):
     
     lockmanager = property(get_lockmanager)
     
+    def get_propertystore(self):
+        '''Lazy construction for PropertyStore, like get_lockmanager().'''
+        if self._propertystore is None and config.property_db:
+            self._propertystore = PropertyStore()
+        return self._propertystore
+    
+    propertystore = property(get_propertystore)
+    
     def log_environ(self):
         '''Log relevant WSGI environment variables for debugging purposes.'''
         headers = ['HTTP_HOST', 'REQUEST_URI', 'PATH_INFO',
@@ -68,14 +84,14 @@ class RequestInfo(object):
             url = wsgiref.util.guess_scheme(self.environ) # 'http' or 'https'
             url += '://' + self.environ['HTTP_HOST']
             if self.environ.has_key('REQUEST_URI'):
-                full_path = urllib.unquote(self.environ['REQUEST_URI'])
+                full_path = urlparse.unquote(self.environ['REQUEST_URI'])
                 full_path = full_path.split('?', 1)[0] 
                 assert full_path.startswith('/')
                 rel_path = self.environ.get('PATH_INFO', '')
                 assert full_path.endswith(rel_path)
                 
                 full_path = full_path[:-len(rel_path)]
-                url += urllib.quote(full_path)
+                url += davutils.quote_url(full_path)
         
         # Some programs require the root directory url to include
         # a trailing slash, because otherwise Apache performs a
@@ -104,7 +120,7 @@ class RequestInfo(object):
             for c_type, c_invert, c_value in conditions:
                 if c_type == 'etag':
                     real_path = self.get_real_path(rel_path, 'r')
-                    cond_passed = (davutils.create_etag(real_path) == c_value)
+                    cond_passed = (etag_store.get_etag(real_path) == c_value)
                 elif c_type == 'token':
                     cond_passed = self.lockmanager.validate_lock(rel_path, c_value)
                     self.provided_tokens.append((rel_path, c_value))
@@ -120,23 +136,35 @@ class RequestInfo(object):
         if not all_passed:
             raise DAVError('412 Precondition Failed: If header')
     
-    def assert_read(self, real_path):
+    def assert_read(self, real_path, info = None):
         '''Verify that a remote web dav user is allowed to read this path,
         and that the path exists. Throws DAVError otherwise.
         The path can be either a file or a directory.
+        If the caller already has a davutils.ResourceInfo for the path,
+        passing it as info avoids another stat.
         '''
         if not davutils.path_inside_directory(real_path, config.root_dir):
             raise DAVError('403 Permission Denied: Path is outside root_dir')
         
-        if davutils.compare_path(real_path, config.restrict_access):
+        if access_matcher.match(real_path):
             raise DAVError('403 Permission Denied: restrict_access')
         
-        if not os.path.exists(real_path):
+        if info is None and not os.path.exists(real_path):
             raise DAVError('404 Not Found')
         
         if not os.access(real_path, os.R_OK):
             raise DAVError('403 Permission Denied: File mode excludes read')
     
+    def is_readable(self, real_path, info = None):
+        '''Return True if assert_read() passes for the path, False otherwise.
+        Used to leave forbidden files out of directory listings.
+        '''
+        try:
+            self.assert_read(real_path, info)
+            return True
+        except DAVError:
+            return False
+    
     def assert_write(self, real_path, check_locks = True):
         '''Verify that a remote web dav user is allowed to write this path.
         Throws DAVError otherwise.
@@ -151,10 +179,10 @@ class RequestInfo(object):
         if not davutils.path_inside_directory(real_path, config.root_dir):
             raise DAVError('403 Permission Denied: Path is outside root_dir')
         
-        if davutils.compare_path(real_path, config.restrict_access):
+        if access_matcher.match(real_path):
             raise DAVError('403 Permission Denied: restrict_access')
         
-        if davutils.compare_path(real_path, config.restrict_write):
+        if write_matcher.match(real_path):
             raise DAVError('403 Permission Denied: restrict_write')
         
         if not os.path.exists(real_path):
@@ -255,7 +283,7 @@ class RequestInfo(object):
             return None
         
         rel_path = url[len(self.root_url):].strip('/')
-        return unicode(urllib.unquote(rel_path), 'utf-8')
+        return unicode(urlparse.unquote(rel_path), 'utf-8')
     
     def get_destination_path(self, mode):
         '''Return the real filesystem path for url given in HTTP Destination
@@ -269,16 +297,21 @@ class RequestInfo(object):
         
         return self.get_real_path(rel_path, mode)
     
-    def get_url(self, real_path):
+    def get_url(self, real_path, isdir = None):
         '''Get a fully specified URI for the file referenced
         by path. The URL is encoded with % escapes.
+        If isdir is None, the file system is checked for whether
+        the path is a directory.
         '''
         rel_path = davutils.get_relpath(real_path, config.root_dir)
         
-        rel_path = urllib.quote(rel_path.encode('utf-8'))
+        rel_path = davutils.quote_url(rel_path.encode('utf-8'))
         url = urlparse.urljoin(self.root_url, rel_path)
         
-        if os.path.isdir(real_path) and not url.endswith('/'):
+        if isdir is None:
+            isdir = os.path.isdir(real_path)
+        
+        if isdir and not url.endswith('/'):
             url += '/' # Trailing slash for directories
         
         return url
@@ -329,6 +362,55 @@ class RequestInfo(object):
         else:
             return not davutils.compare_etags(etag, if_none_match)
     
+    def check_conditions(self, etag, mtime):
+        '''Evaluate the conditional request headers of a GET or HEAD
+        request, in the order given in RFC 7232 section 6, against the
+        ETag and modification time of the resource.
+        
+        Raises DAVError('412 Precondition Failed') if If-Match or
+        If-Unmodified-Since fails. Returns True if the client's copy is
+        current and the request should be answered with 304 Not Modified.
+        '''
+        if_match = self.environ.get('HTTP_IF_MATCH', '').strip()
+        if_unmodified_since = self.environ.get('HTTP_IF_UNMODIFIED_SINCE')
+        if_none_match = self.environ.get('HTTP_IF_NONE_MATCH', '').strip()
+        if_modified_since = self.environ.get('HTTP_IF_MODIFIED_SINCE')
+        
+        # HTTP dates have a resolution of one second.
+        mtime = int(mtime)
+        
+        if if_match:
+            if not davutils.compare_etags(etag, if_match):
+                raise DAVError('412 Precondition Failed')
+        elif if_unmodified_since:
+            timestamp = davutils.parse_rfcdate(if_unmodified_since)
+            if timestamp is not None and mtime > timestamp:
+                raise DAVError('412 Precondition Failed')
+        
+        if if_none_match:
+            return davutils.compare_etags(etag, if_none_match, weak = True)
+        elif if_modified_since:
+            timestamp = davutils.parse_rfcdate(if_modified_since)
+            return timestamp is not None and mtime <= timestamp
+        
+        return False
+    
+    def check_ifrange(self, etag, mtime):
+        '''Check the HTTP If-Range header against the ETag and
+        modification time of the resource. Returns True if the Range
+        header should be applied, or False if the whole resource should
+        be sent because it has changed.
+        '''
+        if_range = self.environ.get('HTTP_IF_RANGE', '').strip()
+        
+        if not if_range:
+            return True
+        elif if_range.startswith('"') or if_range.startswith('W/'):
+            # Only strong comparison is allowed, so weak tags never match.
+            return if_range == etag
+        else:
+            return davutils.parse_rfcdate(if_range) == int(mtime)
+    
     def get_xml_body(self):
         '''Decode the request body with ElementTree, returning an
         Element object or None.'''
@@ -343,39 +425,42 @@ class RequestInfo(object):
         except ExpatError, e:
             raise DAVError('400 Bad Request: ' + str(e))
     
-    def parse_propfind_body(self, allprops):
+    def parse_propfind_body(self):
         '''Parse the XML body for a PROPFIND request.
         
-        Returns a list of strings, specifying the requested properties,
-        OR the special string 'propname' without any list.
+        Returns a tuple (mode, props), where mode is one of:
+        - 'allprop': props is a list of properties given in DAV:include
+        - 'propname': props is an empty list
+        - 'prop': props is a list of the requested properties
+        Properties are given as strings in {namespace}name notation.
         '''
         
         body = self.get_xml_body()
         
-        if not body:
+        if body is None:
             # Treat empty request body like allprop request
-            return allprops
+            return 'allprop', []
         
         if body.tag != '{DAV:}propfind':
             raise DAVError('400 Bad Request: Root element is not propfind')
         
-        if body.find('{DAV:}allprop'):
+        if body.find('{DAV:}allprop') is not None:
             include_element = body.find('{DAV:}include')
-            if include_element:
+            if include_element is not None:
                 includes = [t.tag for t in include_element.getchildren()]
-                return allprops + includes
+                return 'allprop', includes
             else:
-                return allprops
+                return 'allprop', []
         
-        if body.find('{DAV:}propname'):
-            return 'propname'
+        if body.find('{DAV:}propname') is not None:
+            return 'propname', []
         
         prop_element = body.find('{DAV:}prop')
-        if not prop_element:
+        if prop_element is None:
             raise DAVError('400 Bad Request: No prop in propfind')
         
         props = [t.tag for t in prop_element.getchildren()]
-        return props
+        return 'prop', props
     
     def parse_proppatch(self):
         '''Parse the XML request body for a PROPPATCH request.
@@ -406,7 +491,7 @@ class RequestInfo(object):
                     raise DAVError('400 Bad Request: Non-prop element in DAV:remove')
                 
                 for propelement in element[0]:
-                    instructions.append(('set', propelement.tag, None))
+                    instructions.append(('remove', propelement.tag, None))
         
         return instructions
 
@@ -485,6 +570,31 @@ if __name__ == '__main__':
     assert req.get_url(testfile) == 'http://example.com/webdav.cgi/testfile%25%C3%A4'
     assert req.parse_simple_ref(req.get_url(testfile)) == u'testfile%ä'
     
+    assert not req.check_conditions('"1S3"', 1.5)
+    req.environ['HTTP_IF_NONE_MATCH'] = 'W/"1S3"'
+    assert req.check_conditions('"1S3"', 1.5)
+    req.environ['HTTP_IF_MODIFIED_SINCE'] = davutils.get_rfcformat(0)
+    assert req.check_conditions('"1S3"', 1.5) # If-None-Match has priority
+    del req.environ['HTTP_IF_NONE_MATCH']
+    assert not req.check_conditions('"1S3"', 1.5)
+    req.environ['HTTP_IF_MODIFIED_SINCE'] = davutils.get_rfcformat(1)
+    assert req.check_conditions('"1S3"', 1.5)
+    req.environ['HTTP_IF_MATCH'] = '"2S3"'
+    try:
+        assert not req.check_conditions('"1S3"', 1.5)
+    except DAVError:
+        pass
+    del req.environ['HTTP_IF_MATCH']
+    del req.environ['HTTP_IF_MODIFIED_SINCE']
+    
+    assert req.check_ifrange('"1S3"', 1.5)
+    req.environ['HTTP_IF_RANGE'] = '"1S3"'
+    assert req.check_ifrange('"1S3"', 1.5)
+    assert not req.check_ifrange('"2S3"', 1.5)
+    req.environ['HTTP_IF_RANGE'] = davutils.get_rfcformat(1)
+    assert req.check_ifrange('"1S3"', 1.5)
+    assert not req.check_ifrange('"1S3"', 2.5)
+    
     shutil.rmtree(config.root_dir)
     
     print "Unit tests OK"
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+'''Background removal of deleted directory trees.
+
+Removing a large tree file by file can take minutes, longer than clients
+wait for a response. Instead, a deleted directory is renamed into a
+hidden trash directory, which is instant, and a reaper removes the
+contents of the trash in the background with idle IO priority.
+
+Each file system under root_dir has its own trash directory at its top,
+so that the rename never has to copy data. In a long-running server the
+reaper is a thread. Under CGI the process exits after the response, so
+the reaper is a separate process, which is not started while another
+reaper is still emptying the trash. A reaper also empties trash left
+behind by an earlier crash: the reaper thread when the server starts,
+and the reaper process when it is started by the next delete.
+'''
+
+import atexit
+import binascii
+import errno
+import logging
+import os
+import os.path
+import shutil
+import sys
+import threading
+import time
+
+import davutils
+import fileops
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TRASH_NAME = davutils.INTERNAL_PREFIX + 'trash'
+
+def get_trash_dir(real_path):
+    '''Return the trash directory for real_path, which is at the top
+    directory under root_dir on the same file system.
+    '''
+    root_dir = os.path.normpath(config.root_dir)
+    device = os.lstat(real_path).st_dev
+    top = os.path.dirname(os.path.normpath(real_path))
+    
+    while top != root_dir:
+        parent = os.path.dirname(top)
+        if parent == top or os.lstat(parent).st_dev != device:
+            break
+        top = parent
+    
+    return os.path.join(top, TRASH_NAME)
+
+def find_trash_dirs():
+    '''Return the existing trash directories under root_dir: the one at
+    root_dir and those at the file systems mounted under it.
+    '''
+    root_dir = os.path.normpath(config.root_dir)
+    tops = [root_dir]
+    try:
+        for line in open('/proc/mounts'):
+            mountpoint = line.split()[1].replace('\\040', ' ')
+            if davutils.path_inside_directory(mountpoint, root_dir):
+                tops.append(mountpoint)
+    except IOError:
+        pass # Not Linux
+    
+    return [os.path.join(top, TRASH_NAME) for top in tops
+            if os.path.isdir(os.path.join(top, TRASH_NAME))]
+
+def move_to_trash(real_path):
+    '''Rename real_path into its trash directory. Returns the trash
+    directory, or None if the path can't be renamed, such as when it
+    is a mount point.
+    '''
+    try:
+        trash_dir = get_trash_dir(real_path)
+        try:
+            os.mkdir(trash_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        
+        os.rename(real_path, os.path.join(trash_dir,
+                                          binascii.hexlify(os.urandom(8))))
+        return trash_dir
+    except OSError:
+        return None
+
+# Ioprio_set() system call numbers, which Python and C libraries don't
+# provide a function for.
+IOPRIO_SYSCALLS = {
+    'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289,
+    'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def set_idle_priority():
+    '''Put the calling thread in the idle IO scheduling class, so that it
+    only uses the disk when nothing else does. Returns True on success.
+    '''
+    import platform
+    number = IOPRIO_SYSCALLS.get(platform.machine())
+    if number is None or not sys.platform.startswith('linux'):
+        return False
+    
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno = True)
+        # Process 0 is the calling thread.
+        return libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+    except (ImportError, OSError, AttributeError):
+        return False
+
+def empty_trash(trash_dir, stop = None):
+    '''Remove everything in trash_dir. Returns immediately if another
+    reaper is already emptying it. Stop is an optional threading.Event
+    that interrupts the removal between the deleted trees.
+    '''
+    while True:
+        try:
+            fd = os.open(trash_dir, os.O_RDONLY)
+        except OSError:
+            return # No trash
+        
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return # The other reaper checks again when done
+            
+            failed = set()
+            names = set(os.listdir(trash_dir))
+            while names - failed:
+                for name in names - failed:
+                    if stop is not None and stop.is_set():
+                        return
+                    try:
+                        fileops.remove(os.path.join(trash_dir, name))
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            logging.warn('Emptying trash: ' + str(e))
+                            failed.add(name)
+                names = set(os.listdir(trash_dir))
+        finally:
+            os.close(fd)
+        
+        # Trash added while the lock was held, whose reaper gave up
+        if not set(os.listdir(trash_dir)) - failed:
+            return
+
+def is_being_emptied(trash_dir):
+    '''Return True if a reaper holds the lock of trash_dir. The reaper
+    checks for more trash before it exits, so trash moved there before
+    the call is removed without starting another reaper.
+    '''
+    if fcntl is None:
+        return False
+    
+    try:
+        fd = os.open(trash_dir, os.O_RDONLY)
+    except OSError:
+        return False
+    
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        return False
+    finally:
+        os.close(fd)
+
+_reaper = None
+_reaper_lock = threading.Lock()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_trash_dirs = set()
+
+def _reaper_thread(wakeup, stop, trash_dirs):
+    '''Empty the known trash directories whenever woken up, until stopped.
+    The arguments are the module globals, which are cleared when the
+    interpreter shuts down.
+    '''
+    set_idle_priority()
+    while not stop.is_set():
+        wakeup.clear()
+        for trash_dir in list(trash_dirs):
+            try:
+                empty_trash(trash_dir, stop)
+            except Exception:
+                logging.error('Emptying trash failed', exc_info = 1)
+        
+        while not wakeup.is_set():
+            wakeup.wait(60)
+
+def _stop_reaper():
+    '''Let the reaper thread exit before the interpreter shuts down.'''
+    _stop.set()
+    _wakeup.set()
+    _reaper.join(1)
+
+def start_reaper():
+    '''Start the reaper thread of a long-running server, which first
+    empties any trash left from before. Does nothing if already started.
+    Servers call this once when they start.
+    '''
+    global _reaper
+    _reaper_lock.acquire()
+    try:
+        if _reaper is None:
+            _trash_dirs.update(find_trash_dirs())
+            _reaper = threading.Thread(target = _reaper_thread,
+                                       args = (_wakeup, _stop, _trash_dirs))
+            _reaper.daemon = True
+            _reaper.start()
+            atexit.register(_stop_reaper)
+    finally:
+        _reaper_lock.release()
+
+# Script for the reaper process. Arguments are the trash directories.
+REAPER_SCRIPT = '''
+import os, sys, trash
+os.nice(19)
+trash.set_idle_priority()
+for trash_dir in sys.argv[1:]:
+    trash.empty_trash(trash_dir)
+'''
+
+def start_reaper_process(trash_dirs):
+    '''Start a reaper process that outlives the current one, for CGI.'''
+    import subprocess
+    devnull = open(os.devnull, 'r+')
+    try:
+        subprocess.Popen([sys.executable, '-c', REAPER_SCRIPT] + trash_dirs,
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stdin = devnull, stdout = devnull, stderr = devnull,
+            close_fds = True, preexec_fn = getattr(os, 'setsid', None))
+    finally:
+        devnull.close()
+
+def remove(real_path, run_once = False):
+    '''Remove a file or directory tree. A directory is moved to the trash
+    and removed in the background. Run_once is the wsgi.run_once flag,
+    which tells that the process exits after the request.
+    '''
+    if not os.path.isdir(real_path) or os.path.islink(real_path):
+        os.unlink(real_path)
+        return
+    
+    trash_dir = move_to_trash(real_path)
+    if trash_dir is None:
+        shutil.rmtree(real_path)
+    elif run_once:
+        trash_dirs = [path for path in set(find_trash_dirs() + [trash_dir])
+                      if not is_being_emptied(path)]
+        if trash_dirs:
+            start_reaper_process(sorted(trash_dirs))
+    else:
+        _trash_dirs.add(trash_dir)
+        start_reaper()
+        _wakeup.set()
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import tempfile
+    print "Unit tests"
+    
+    tmpdir = tempfile.mkdtemp()
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = tmpdir + '/'
+    
+    def make_tree(path):
+        os.makedirs(os.path.join(path, 'a', 'b'))
+        for i in range(50):
+            open(os.path.join(path, 'a', 'b', str(i)), 'w').write('x')
+        os.symlink('a', os.path.join(path, 'link'))
+    
+    trash_dir = os.path.join(tmpdir, TRASH_NAME)
+    make_tree(os.path.join(tmpdir, 'x'))
+    assert get_trash_dir(os.path.join(tmpdir, 'x', 'a', 'b')) == trash_dir
+    assert find_trash_dirs() == []
+    
+    # Files are removed directly, directories go to the trash
+    open(os.path.join(tmpdir, 'file'), 'w').write('x')
+    remove(os.path.join(tmpdir, 'file'))
+    assert move_to_trash(os.path.join(tmpdir, 'x', 'a')) == trash_dir
+    assert len(os.listdir(trash_dir)) == 1
+    assert os.listdir(os.path.join(tmpdir, 'x')) == ['link']
+    assert find_trash_dirs() == [trash_dir]
+    
+    empty_trash(trash_dir)
+    assert os.listdir(trash_dir) == []
+    
+    # Reaper thread
+    set_idle_priority()
+    remove(os.path.join(tmpdir, 'x'))
+    assert not os.path.exists(os.path.join(tmpdir, 'x'))
+    for i in range(100):
+        if not os.listdir(trash_dir):
+            break
+        time.sleep(0.05)
+    assert os.listdir(trash_dir) == []
+    
+    # Under CGI the trash directories are passed to the reaper process
+    make_tree(os.path.join(tmpdir, 'y'))
+    start_reaper_process = lambda dirs: empty_trash(dirs[0])
+    remove(os.path.join(tmpdir, 'y'), True)
+    assert os.listdir(trash_dir) == []
+    
+    # No reaper process is started while another one holds the lock
+    started = []
+    start_reaper_process = started.append
+    fd = os.open(trash_dir, os.O_RDONLY)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    assert is_being_emptied(trash_dir)
+    make_tree(os.path.join(tmpdir, 'z'))
+    remove(os.path.join(tmpdir, 'z'), True)
+    assert started == []
+    os.close(fd)
+    assert not is_being_emptied(trash_dir)
+    empty_trash(trash_dir)
+    
+    # The reaper thread exits when stopped
+    _stop_reaper()
+    assert not _reaper.is_alive()
+    
+    shutil.rmtree(tmpdir)
+    
+    print "Unit tests OK"
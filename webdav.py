@@ -19,19 +19,26 @@ are permitted provided that the following conditions are met:
 __program_name__ = 'EasyDAV'
 __version__ = "0.5-dev"
 
-import cgi
-import kid
-import kid.parser
+import binascii
+import hashlib
 import logging
 import os
 import os.path
 import shutil
 import sys
-import tempfile
-import zipfile
+import time
+import xml.etree.ElementTree as ET
 
 import davutils
+import davxml
+import etag_store
+import fileops
+import gzip_cache
+import trash
 from davutils import DAVError
+from lock_manager import LockSet
+from propfind_cache import PropfindCache
+from property_store import PropertyReader
 from requestinfo import RequestInfo
 from wsgi_input_wrapper import WSGIInputWrapper
 import webdavconfig as config
@@ -63,9 +70,23 @@ def initialize_logging():
 if not hasattr(logging, 'log_init_done'):
     initialize_logging()
 
-multistatus = kid.load_template('multistatus.kid')
-dirindex = kid.load_template('dirindex.kid')
-activelock = kid.load_template('activelock.kid')
+_dirindex = None
+
+def get_dirindex():
+    '''Load the directory index template on first use. Importing Kid
+    takes longer than handling most requests, which matters under CGI.
+    Kid stores the compiled template as dirindex.pyc, so it is compiled
+    only once.
+    '''
+    global _dirindex
+    if _dirindex is None:
+        import kid
+        _dirindex = kid.load_template('dirindex.kid')
+    return _dirindex
+
+# Rendered Depth: 1 PROPFIND listings, kept for the lifetime of the process.
+propfind_cache = PropfindCache(config.propfind_cache_size,
+                               config.propfind_cache_max_age)
 
 def handle_options(reqinfo, start_response):
     '''Handle an OPTIONS request.'''
@@ -76,58 +97,51 @@ def handle_options(reqinfo, start_response):
         start_response('200 OK', [('DAV', '1')])
     return ""
 
-def get_resourcetype(path):
+def get_resourcetype(info):
     '''Return the contents for <DAV:resourcetype> property.'''
-    if os.path.isdir(path):
-        element = kid.parser.Element('{DAV:}collection')
-        return kid.parser.ElementStream([
-            (kid.parser.START, element),
-            (kid.parser.END, element)
-        ])
+    if info.isdir:
+        return [ET.Element('{DAV:}collection')]
     else:
         return ''
 
-def get_supportedlock(path):
+supportedlock_entries = [ET.fromstring(
+    '<D:lockentry xmlns:D="DAV:">'
+    + '<D:lockscope><D:' + scope + '/></D:lockscope>'
+    + '<D:locktype><D:write/></D:locktype>'
+    + '</D:lockentry>') for scope in ['exclusive', 'shared']]
+
+def get_supportedlock(info):
     '''Return the contents for <DAV:supportedlock> property.'''
-    if os.path.isdir(path):
-        return kid.parser.XML('''
-            <D:lockentry xmlns:D="DAV">
-                <D:lockscope><D:exclusive /></D:lockscope>
-                <D:locktype><D:write /></D:locktype>
-            </D:lockentry>
-            <D:lockentry xmlns:D="DAV">
-                <D:lockscope><D:shared /></D:lockscope>
-                <D:locktype><D:write /></D:locktype>
-            </D:lockentry>
-        ''')
+    if info.isdir:
+        return supportedlock_entries
     else:
         return ''
 
 # All supported properties.
 # Key is the element name inside DAV:prop element.
 # Value is tuple of functions: (get, set)
-# Get takes a file name and returns string.
+# Get takes a davutils.ResourceInfo and returns string.
 # Set takes a file name and a string value.
 # Set may be None to specify protected property.
 property_handlers = {
     '{DAV:}creationdate': (
-        lambda path: davutils.get_isoformat(os.path.getctime(path)),
+        lambda info: davutils.get_isoformat(info.ctime),
         None
     ),
     '{DAV:}getcontentlength': (
-        lambda path: str(os.path.getsize(path)),
+        lambda info: str(info.size),
         None
     ),
     '{DAV:}getetag': (
-        davutils.create_etag,
+        etag_store.get_etag,
         None
     ),
     '{DAV:}getlastmodified': (
-        lambda path: davutils.get_rfcformat(os.path.getmtime(path)),
+        lambda info: davutils.get_rfcformat(info.mtime),
         davutils.set_mtime
     ),
     '{DAV:}getcontenttype': (
-        davutils.get_mimetype,
+        lambda info: davutils.get_mimetype(info.path),
         None
     ),
     '{DAV:}resourcetype': (
@@ -136,31 +150,77 @@ property_handlers = {
     )
 }
 
+# Live properties that are not in property_handlers, because their value
+# does not depend on the file alone. The locks for <DAV:lockdiscovery> are
+# loaded for the whole listing at once, and the value is passed to
+# read_properties() by propfind_results().
+computed_properties = []
+
 if config.lock_db is not None:
     property_handlers['{DAV:}supportedlock'] = (get_supportedlock, None)
+    computed_properties.append('{DAV:}lockdiscovery')
+
+def read_dead_properties(dead_props):
+    '''Parse the (name, xml) tuples from property_store into a dictionary
+    of name => ElementTree element.
+    '''
+    result = {}
+    for name, value in dead_props:
+        result[name] = ET.fromstring(value)
+    return result
 
-def read_properties(real_path, requested):
-    '''Return a propstats dictionary for the file specified by real_path.
-    The argument 'requested' is either a list of property names,
-    or the special value 'propname'.
-    In the second case this function returns all defined properties but no
-    values.
+def read_properties(info, request, dead_props = None, lockdiscovery = None):
+    '''Return a propstats dictionary for the file described by info,
+    a davutils.ResourceInfo.
+    
+    Request is a tuple (mode, props) as returned by
+    RequestInfo.parse_propfind_body(). Dead_props is a function that
+    returns the list of (name, xml) tuples from property_store for the
+    file, or None if dead properties are not stored. It is only called
+    if dead properties are needed for the request. Lockdiscovery is a
+    function that returns the value of <DAV:lockdiscovery>, or None if
+    the property is not available.
+    
+    For 'propname' requests this function returns all defined properties
+    but no values.
     '''
+    mode, props = request
     propstats = {}
+    live_props = property_handlers.keys() + computed_properties
     
-    if requested == 'propname':
+    if mode == 'propname':
         propstats['200 OK'] = []
-        for propname in property_handlers.keys():
+        for propname in live_props:
             propstats['200 OK'].append((propname, ''))
+        if dead_props is not None:
+            for propname, value in dead_props():
+                propstats['200 OK'].append((propname, ''))
         return propstats
     
-    for prop in requested:
-        if not property_handlers.has_key(prop):
+    dead = {}
+    if dead_props is not None:
+        if mode == 'allprop' or [p for p in props if p not in live_props]:
+            dead = read_dead_properties(dead_props())
+    
+    if mode == 'allprop':
+        props = live_props + dead.keys() + [
+            p for p in props if p not in live_props and not dead.has_key(p)]
+    
+    for prop in props:
+        if dead.has_key(prop):
+            davutils.add_to_dict_list(propstats, '200 OK', (prop, dead[prop]))
+            continue
+        
+        if prop == '{DAV:}lockdiscovery' and lockdiscovery is not None:
+            get_value = lambda info: lockdiscovery()
+        elif property_handlers.has_key(prop):
+            get_value = property_handlers[prop][0]
+        else:
             davutils.add_to_dict_list(propstats, '404 Not Found: Property', (prop, ''))
             continue
         
         try:
-            value = property_handlers[prop][0](real_path)
+            value = get_value(info)
             davutils.add_to_dict_list(propstats, '200 OK', (prop, value))
         except Exception, e:
             logging.error('Property handler ' + repr(prop) + ' failed',
@@ -169,52 +229,244 @@ def read_properties(real_path, requested):
     
     return propstats
 
+class StatusResponse(object):
+    '''A <DAV:response> that has a single status for the whole resource
+    instead of propstats. Can be yielded in place of the propstats
+    dictionary to generate_multistatus().
+    '''
+    def __init__(self, status, description = None):
+        self.status = status
+        self.description = description
+
+def render_response(real_url, propstats):
+    '''Render a single <DAV:response> element. Propstats is either
+    a propstats dictionary or a StatusResponse.
+    '''
+    if isinstance(propstats, StatusResponse):
+        return davxml.response(real_url, status = propstats.status,
+                               description = propstats.description)
+    else:
+        return davxml.response(real_url, propstats)
+
+def generate_multistatus(responses):
+    '''Yield a <DAV:multistatus> document piece by piece.
+    Responses is an iterable of <DAV:response> strings from
+    render_response(). Each one is yielded as soon as it is produced,
+    so the document is never held in memory as a whole.
+    '''
+    yield davxml.MULTISTATUS_START
+    
+    try:
+        for fragment in responses:
+            yield fragment
+    except:
+        # The status line has already been sent, so the only thing
+        # left to do is to log the error and abort the response.
+        logging.error('Multistatus generation failed', exc_info = True)
+        raise
+    
+    yield davxml.MULTISTATUS_END
+
+def log_propfind_limit(reqinfo, message):
+    '''Log a PROPFIND request that hit one of the configured limits,
+    along with the client that made it.
+    '''
+    logging.warning('PROPFIND limit: ' + message + ' for '
+        + repr(reqinfo.parse_request_path()) + ' from '
+        + str(reqinfo.environ.get('REMOTE_ADDR')) + ' '
+        + repr(reqinfo.environ.get('HTTP_USER_AGENT', '')))
+
+def check_propfind_depth(reqinfo, depth):
+    '''Refuse PROPFIND requests deeper than config.propfind_max_depth.'''
+    max_depth = config.propfind_max_depth
+    if max_depth is not None and (depth == -1 or depth > max_depth):
+        if depth == -1:
+            depth = 'infinity'
+        log_propfind_limit(reqinfo, 'Depth ' + str(depth) + ' refused')
+        raise DAVError('403 Forbidden',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            + '<D:error xmlns:D="DAV:"><D:propfind-finite-depth/></D:error>')
+
+def wants_lockdiscovery(request_props):
+    '''Return True if <DAV:lockdiscovery> is requested in PROPFIND.'''
+    mode, props = request_props
+    return mode == 'allprop' or '{DAV:}lockdiscovery' in props
+
+def propfind_results(reqinfo, real_path, depth, request_props):
+    '''Walk the directory tree for PROPFIND, yielding (real_url, propstats)
+    tuples for each readable resource.
+    
+    If the listing exceeds config.propfind_max_resources or
+    config.propfind_time_limit, it is cut short and a
+    507 Insufficient Storage response for the request URI is
+    yielded last, as described in RFC4918 section 11.5.
+    '''
+    start_time = time.time()
+    count = 0
+    
+    # Forbidden paths are skipped from listing, along with everything
+    # under them.
+    prune = lambda info: not reqinfo.is_readable(info.path, info)
+    
+    # Dead properties are fetched one directory at a time.
+    reader = None
+    if reqinfo.propertystore:
+        reader = PropertyReader(reqinfo.propertystore,
+            davutils.get_relpath(real_path, config.root_dir))
+    
+    # All locks on the listed tree and its parents are fetched at once.
+    lockset = None
+    if reqinfo.lockmanager and wants_lockdiscovery(request_props):
+        lockset = LockSet(reqinfo.lockmanager.get_locks(
+            davutils.get_relpath(real_path, config.root_dir), depth != 0))
+    
+    for info in davutils.walk_directory(real_path, depth, prune):
+        if (config.propfind_max_resources is not None
+                and count >= config.propfind_max_resources):
+            message = 'Listing truncated after ' + str(count) + ' resources'
+        elif (config.propfind_time_limit is not None
+                and time.time() - start_time > config.propfind_time_limit):
+            message = ('Listing truncated after '
+                + str(config.propfind_time_limit) + ' seconds')
+        else:
+            real_url = reqinfo.get_url(info.path, info.isdir)
+            rel_path = davutils.get_relpath(info.path, config.root_dir)
+            
+            dead_props = None
+            if reader is not None:
+                dead_props = lambda: reader.get(rel_path)
+            
+            lockdiscovery = None
+            if lockset is not None:
+                lockdiscovery = lambda: [
+                    davxml.activelock(lock, reqinfo.root_url)
+                    for lock in lockset.get_locks(rel_path)]
+            
+            propstats = read_properties(info, request_props, dead_props,
+                                        lockdiscovery)
+            count += 1
+            yield real_url, propstats
+            continue
+        
+        log_propfind_limit(reqinfo, message)
+        yield (reqinfo.get_url(real_path),
+            StatusResponse('507 Insufficient Storage', message))
+        return
+
+def get_propfind_cache_key(reqinfo, info, request_props):
+    '''Return the propfind_cache key for a Depth: 1 listing of the
+    directory described by info. Besides the directory path, the key
+    includes everything else the rendered listing depends on.
+    
+    Returns None if the listing should not be cached, because it
+    contains lock timeouts that change every second.
+    '''
+    lock_state = None
+    if reqinfo.lockmanager:
+        rel_path = davutils.get_relpath(info.path, config.root_dir)
+        locks = reqinfo.lockmanager.get_locks(rel_path, True)
+        lock_state = tuple(sorted([(l.urn, l.valid_until) for l in locks]))
+        
+        if lock_state and wants_lockdiscovery(request_props):
+            return None
+    
+    mode, props = request_props
+    
+    return (os.path.normpath(info.path), reqinfo.root_url, mode, tuple(props),
+            info.mtime, info.ctime, lock_state)
+
+def cache_responses(key, result_files):
+    '''Render result_files, passing on each <DAV:response> as it is
+    produced. Once the listing is complete, it is stored in
+    propfind_cache. Truncated listings and listings too large for the
+    cache are not stored.
+    '''
+    fragments = []
+    size = 0
+    
+    for real_url, propstats in result_files:
+        fragment = render_response(real_url, propstats)
+        
+        if fragments is not None:
+            fragments.append(fragment)
+            size += len(fragment)
+            
+            if (isinstance(propstats, StatusResponse)
+                    or size > propfind_cache.max_size):
+                fragments = None
+        
+        yield fragment
+    
+    if fragments is not None:
+        propfind_cache.put(key, fragments)
+
 def handle_propfind(reqinfo, start_response):
     '''Handle propfind request by listing files and their associated
-    properties.
+    properties. The response is streamed to the client while the
+    directory tree is being walked.
+    
+    Depth: 1 listings of directories are served from propfind_cache
+    when possible.
     '''
     depth = reqinfo.get_depth('infinity')
-    request_props = reqinfo.parse_propfind_body(property_handlers.keys())
+    request_props = reqinfo.parse_propfind_body()
     real_path = reqinfo.get_request_path('r')
+    check_propfind_depth(reqinfo, depth)
+    
+    result_files = propfind_results(reqinfo, real_path, depth, request_props)
+    responses = None
+    
+    if depth == 1 and propfind_cache.enabled():
+        info = davutils.ResourceInfo(real_path)
+        if info.isdir:
+            key = get_propfind_cache_key(reqinfo, info, request_props)
+            if key is not None:
+                responses = propfind_cache.get(key)
+                if responses is None:
+                    responses = cache_responses(key, result_files)
+                logging.debug(propfind_cache.stats())
+    
+    if responses is None:
+        responses = (render_response(real_url, propstats)
+                     for real_url, propstats in result_files)
     
-    result_files = []
-    for path in davutils.search_directory(real_path, depth):
-        try:
-            reqinfo.assert_read(path)
-        except DAVError, e:
-            if e.httpstatus.startswith('403'):
-                continue # Skip forbidden paths from listing
-            raise
-        
-        real_url = reqinfo.get_url(path)
-        propstats = read_properties(path, request_props)
-        result_files.append((real_url, propstats))
-
     start_response('207 Multistatus',
         [('Content-Type', 'text/xml; charset=utf-8')])
-    t = multistatus.Template(result_files = result_files)
-    return [t.serialize(output = 'xml')]
+    return generate_multistatus(responses)
      
+def is_dead_property(propname):
+    '''Return True if propname can be stored in property_store. Unknown
+    properties in the DAV: namespace are not accepted, as they are
+    reserved for the protocol.
+    '''
+    return (config.property_db is not None
+            and not property_handlers.has_key(propname)
+            and not propname.startswith('{DAV:}'))
+
 def proppatch_verify_instruction(real_path, instruction):
     '''Verify that the property can be set on the file, or throw a DAVError.
     Used to verify instructions before they are executed.
     '''
     command, propname, propelement = instruction
     
+    if is_dead_property(propname):
+        return
+    
+    if not property_handlers.has_key(propname):
+        raise DAVError('403 Forbidden: No such property')
+    
     if command == 'set':
         if propelement.getchildren():
             raise DAVError('409 Conflict: XML property values are not supported')
         
-        if not property_handlers.has_key(propname):
-            raise DAVError('403 Forbidden: No such property')
-        
         if property_handlers[propname][1] is None:
             raise DAVError('403 Forbidden',
                 '<DAV:cannot-modify-protected-property/>')
     
     elif command == 'remove':
-        # No properties to remove so far.
-        raise DAVError('403 Forbidden: Properties cannot be removed')
+        # Live properties cannot be removed.
+        raise DAVError('403 Forbidden',
+            '<DAV:cannot-modify-protected-property/>')
 
 def handle_proppatch(reqinfo, start_response):
     '''Modify properties on a single file.'''
@@ -239,39 +491,245 @@ def handle_proppatch(reqinfo, start_response):
             propstats['424 Failed Dependency'] = propstats['200 OK']
             del propstats['200 OK']
     else:
+        # Dead properties are changed in a single transaction, in
+        # document order. They are done first because the live properties
+        # can't be rolled back.
+        dead_changes = []
         for command, propname, propelement in instructions:
-            property_handlers[propname][1](real_path, propelement.text)
+            if is_dead_property(propname):
+                if command == 'set':
+                    dead_changes.append((propname, ET.tostring(propelement)))
+                else:
+                    dead_changes.append((propname, None))
+        
+        if dead_changes:
+            rel_path = davutils.get_relpath(real_path, config.root_dir)
+            reqinfo.propertystore.set_properties(rel_path, dead_changes)
+        
+        for command, propname, propelement in instructions:
+            if not is_dead_property(propname):
+                property_handlers[propname][1](real_path, propelement.text)
+        propfind_cache.invalidate(real_path)
     
     start_response('207 Multistatus',
         [('Content-Type', 'text/xml; charset=utf-8')])
-    t = multistatus.Template(result_files = [(real_url, propstats)])
-    return [t.serialize(output = 'xml')]
+    return generate_multistatus([render_response(real_url, propstats)])
+
+def write_file(real_path, source, length = None):
+    '''Write the contents of file object source to real_path, replacing
+    any existing file. If length is given, exactly that many bytes are
+    expected and the disk space is reserved before writing.
+    
+    The data is first written to a hidden temporary file in the same
+    directory, which is renamed over real_path only when complete.
+    Readers see either the old or the new file, never a partial one,
+    and old GET operations can continue reading the old file. If writing
+    fails, the temporary file is removed. The new file gets the default
+    mode bits, not those of the old file.
+    
+    Config.put_fsync selects whether the file and the directory entry
+    are flushed to disk before returning. With content digest ETags,
+    the digest is computed from the data as it is written.
+    '''
+    directory = os.path.dirname(real_path)
+    temp_path, outfile = davutils.create_temp_file(directory)
+    
+    if config.etag_mode == 'digest':
+        digest = etag_store.new_digest()
+    else:
+        digest = None
+    
+    try:
+        try:
+            if length is not None:
+                davutils.preallocate(outfile.fileno(), length)
+            
+            copied = davutils.copy_stream(source, outfile, length,
+                                          digest = digest)
+            if length is not None and copied < length:
+                raise DAVError('400 Bad Request: Incomplete request body')
+            
+            sync_file(outfile)
+            outfile.flush()
+            st = os.fstat(outfile.fileno())
+        finally:
+            outfile.close()
+        
+        publish_file(temp_path, real_path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    
+    if digest is not None:
+        etag_store.remember(st, digest.hexdigest())
+
+def sync_file(outfile):
+    '''Flush an uploaded file to disk if config.put_fsync asks for it.'''
+    if config.put_fsync in ('file', 'file+dir'):
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+def publish_file(temp_path, real_path):
+    '''Rename a completely written upload to its final name, dropping
+    the compressed copy of any file it replaces.
+    '''
+    davutils.replace_file(temp_path, real_path)
+    gzip_cache.remove_sidecar(real_path)
+    
+    if config.put_fsync == 'file+dir':
+        davutils.fsync_directory(os.path.dirname(real_path))
+
+UPLOAD_PREFIX = davutils.INTERNAL_PREFIX + 'upload-'
+
+def get_upload_path(real_path, total, upload_id):
+    '''Return the path of the hidden file where the segments of a resumable
+    upload of total bytes to real_path are collected. Upload_id separates
+    concurrent uploads of the same file by different clients.
+    '''
+    name = os.path.basename(real_path)
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    
+    return os.path.join(os.path.dirname(real_path), UPLOAD_PREFIX
+        + hashlib.md5(name).hexdigest() + '-' + str(total) + '-' + upload_id)
+
+def get_upload_id(reqinfo):
+    '''Return the Upload-Id header of a resumable upload request, or None
+    if the client did not send one.
+    '''
+    upload_id = reqinfo.environ.get('HTTP_UPLOAD_ID')
+    if upload_id is None:
+        return None
+    
+    upload_id = upload_id.strip().lower()
+    if len(upload_id) != 16 or upload_id.strip('0123456789abcdef'):
+        raise DAVError('400 Bad Request: Invalid Upload-Id')
+    return upload_id
+
+def expire_uploads(directory):
+    '''Remove resumable uploads in directory that have not received any
+    data in config.upload_expire seconds.
+    '''
+    limit = time.time() - config.upload_expire
+    for name in os.listdir(directory):
+        if not name.startswith(UPLOAD_PREFIX):
+            continue
+        
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.unlink(path)
+        except OSError:
+            pass # Removed by another request
+
+def put_segment(reqinfo, start_response, real_path, content_range):
+    '''Handle PUT with Content-Range, which uploads a file in segments.
+    
+    The segments are collected in a hidden file until all total bytes
+    have been received, and then the file is published atomically like
+    a normal PUT. Segments must start at or before the end of the data
+    received so far. The data of an interrupted segment is kept, so the
+    client can continue after the last byte that got through.
+    
+    Until the upload is complete, the response is 308 Resume Incomplete
+    with a Range header telling the bytes received. A request with
+    'Content-Range: bytes */total' and no body only asks for this status.
+    The 308 status is the one used by existing resumable upload clients,
+    such as those of Google's upload protocol. Without a Location header
+    clients don't take it as a redirect.
+    
+    The first segment starts a new upload, and the response gives its
+    identifier in an Upload-Id header. The client sends the identifier
+    with the later segments and status queries, so that uploads of the
+    same file by several clients don't mix.
+    Returns the WSGI response body, or None when the file was published.
+    '''
+    first, last, total = content_range
+    upload_id = get_upload_id(reqinfo)
+    received = None
+    
+    if upload_id is not None:
+        upload_path = get_upload_path(real_path, total, upload_id)
+        try:
+            received = os.path.getsize(upload_path)
+        except OSError:
+            pass
+    elif first is not None or total == 0:
+        upload_id = binascii.hexlify(os.urandom(8))
+        upload_path = get_upload_path(real_path, total, upload_id)
+    
+    if first is not None and first <= (received or 0):
+        count = last - first + 1
+        if reqinfo.length >= 0 and reqinfo.length != count:
+            raise DAVError('400 Bad Request: Content-Range does not match body')
+        
+        if received is None:
+            expire_uploads(os.path.dirname(real_path))
+        
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        outfile = os.fdopen(os.open(upload_path, flags, 0666), 'wb')
+        try:
+            outfile.seek(first)
+            copied = davutils.copy_stream(reqinfo.wsgi_input, outfile, count)
+            received = max(received or 0, first + copied)
+            
+            if copied < count:
+                raise DAVError('400 Bad Request: Incomplete request body')
+            
+            if received == total:
+                sync_file(outfile)
+        finally:
+            outfile.close()
+    else:
+        # Status query, or a segment that would leave a gap.
+        reqinfo.wsgi_input.read()
+    
+    if total == 0 or received == total:
+        if received is None:
+            open(upload_path, 'wb').close() # Empty file
+        publish_file(upload_path, real_path)
+        return None
+    
+    headers = [('Content-Type', 'text/plain')]
+    if received is not None:
+        headers.append(('Upload-Id', upload_id))
+    if received:
+        headers.append(('Range', 'bytes=0-' + str(received - 1)))
+    
+    start_response('308 Resume Incomplete', headers)
+    return ''
 
 def handle_put(reqinfo, start_response):
     '''Write to a single file, possibly replacing an existing one.'''
     real_path = reqinfo.get_request_path('w')
+    info = davutils.get_resourceinfo(real_path)
     
-    if os.path.isdir(real_path):
+    if info is not None and info.isdir:
         raise DAVError('405 Method Not Allowed: Overwriting directory')
     
-    if os.path.exists(real_path):
-        etag = davutils.create_etag(real_path)
+    if info is not None:
+        etag = etag_store.get_etag(info)
     else:
         etag = None
     
     if not reqinfo.check_ifmatch(etag):
         raise DAVError('412 Precondition Failed')
     
-    new_file = not os.path.exists(real_path)
-    if not new_file:
-        # Unlink the old file to reset mode bits.
-        # This has the additional benefit that old GET operations can
-        # continue even if the file is replaced.
-        os.unlink(real_path)
-
-    outfile = open(real_path, 'wb')
-    block_generator = davutils.read_blocks(reqinfo.wsgi_input)
-    davutils.write_blocks(outfile, block_generator)
+    new_file = info is None
+    content_range = reqinfo.environ.get('HTTP_CONTENT_RANGE')
+    if content_range:
+        content_range = davutils.parse_content_range(content_range)
+        body = put_segment(reqinfo, start_response, real_path, content_range)
+        if body is not None:
+            return body
+    elif reqinfo.length >= 0:
+        write_file(real_path, reqinfo.wsgi_input, reqinfo.length)
+    else:
+        write_file(real_path, reqinfo.wsgi_input) # Chunked encoding
+    propfind_cache.invalidate(real_path)
     
     if new_file:
         start_response('201 Created', [])
@@ -280,29 +738,133 @@ def handle_put(reqinfo, start_response):
     
     return ""
 
+def send_file(reqinfo, infile, offset = 0, count = None):
+    '''Return a WSGI response body for count bytes of the open file infile,
+    starting at offset, or for the rest of the file if count is None.
+    The file is closed when the server closes the response.
+    
+    The body goes through the server's wsgi.file_wrapper when it
+    provides one, so that the server can send the file with sendfile()
+    instead of copying it through Python strings. Only bodies that extend
+    to the end of the file are passed as the plain file object, because
+    servers send the file from the current position to the end.
+    '''
+    body = davutils.FileRange(infile, offset, count)
+    file_wrapper = reqinfo.environ.get('wsgi.file_wrapper')
+    
+    if file_wrapper is None:
+        return body
+    elif count is None:
+        return file_wrapper(infile, body.blocksize)
+    else:
+        return file_wrapper(body, body.blocksize)
+
+def not_modified(start_response, etag, mtime, headers = []):
+    '''Send a 304 Not Modified response, which has only the headers.'''
+    start_response('304 Not Modified',
+        [('Etag', etag),
+         ('Last-Modified', davutils.get_rfcformat(mtime))] + headers)
+    return ''
+
 def handle_get(reqinfo, start_response):
     '''Download a single file or show directory index.'''
     reqinfo.assert_nobody()
     real_path = reqinfo.get_request_path('r')
+    info = davutils.ResourceInfo(real_path)
     
-    if os.path.isdir(real_path):
+    if info.isdir:
         return handle_dirindex(reqinfo, start_response)
     
-    etag = davutils.create_etag(real_path)
-    if not reqinfo.check_ifmatch(etag):
-        raise DAVError('412 Precondition Failed')
+    etag = etag_store.get_etag(info)
+    content_type = davutils.get_mimetype(real_path)
+    vary = []
     
-    start_response('200 OK',
-        [('Content-Type', davutils.get_mimetype(real_path)),
-         ('Etag', etag),
-         ('Content-Length', str(os.path.getsize(real_path))),
-         ('Last-Modified', davutils.get_rfcformat(os.path.getmtime(real_path)))])
+    # Compressible files are sent gzip encoded to clients that accept it,
+    # except for range requests. Without a fresh sidecar, the file is
+    # compressed while sending.
+    compressed = False
+    sidecar = None
+    if gzip_cache.is_compressible(content_type, info.size):
+        vary = [('Vary', 'Accept-Encoding')]
+        accept_encoding = reqinfo.environ.get('HTTP_ACCEPT_ENCODING', '')
+        if (gzip_cache.accepts_gzip(accept_encoding)
+                and not reqinfo.environ.get('HTTP_RANGE')):
+            cached = gzip_cache.open_sidecar(info)
+            if cached is None:
+                compressed = True
+            elif cached[0] is not None:
+                compressed = True
+                sidecar, size = cached
     
-    if reqinfo.environ['REQUEST_METHOD'] == 'HEAD':
-        return ''
+    if compressed:
+        etag = gzip_cache.gzip_etag(etag)
+    
+    if reqinfo.check_conditions(etag, info.mtime):
+        if sidecar:
+            sidecar.close()
+        return not_modified(start_response, etag, info.mtime, vary)
+    
+    headers = [('Etag', etag),
+               ('Last-Modified', davutils.get_rfcformat(info.mtime)),
+               ('Accept-Ranges', 'bytes')] + vary
+    
+    if compressed:
+        headers.append(('Content-Encoding', 'gzip'))
+        if sidecar:
+            headers.append(('Content-Length', str(size)))
+        start_response('200 OK', [('Content-Type', content_type)] + headers)
+        
+        if reqinfo.environ['REQUEST_METHOD'] == 'HEAD':
+            if sidecar:
+                sidecar.close()
+            return ''
+        elif sidecar:
+            return send_file(reqinfo, sidecar)
+        else:
+            return gzip_cache.compress_file(info)
+    
+    # Range requests are only defined for GET, and If-Range makes
+    # the server ignore them if the file has changed.
+    ranges = None
+    range_header = reqinfo.environ.get('HTTP_RANGE')
+    if (range_header and reqinfo.environ['REQUEST_METHOD'] == 'GET'
+            and reqinfo.check_ifrange(etag, info.mtime)):
+        ranges = davutils.parse_range(range_header, info.size)
+    
+    if ranges == []:
+        status = '416 Requested Range Not Satisfiable'
+        start_response(status,
+            [('Content-Type', 'text/plain'),
+             ('Content-Range', 'bytes */' + str(info.size))])
+        return [status]
+    
+    if not ranges:
+        start_response('200 OK',
+            [('Content-Type', content_type),
+             ('Content-Length', str(info.size))] + headers)
+        
+        if reqinfo.environ['REQUEST_METHOD'] == 'HEAD':
+            return ''
+        
+        return send_file(reqinfo, open(real_path, 'rb'))
     
     infile = open(real_path, 'rb')
-    return davutils.read_blocks(infile)
+    
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        start_response('206 Partial Content',
+            [('Content-Type', content_type),
+             ('Content-Length', str(last - first + 1)),
+             ('Content-Range', 'bytes %d-%d/%d' % (first, last, info.size))]
+            + headers)
+        return send_file(reqinfo, infile, first, last - first + 1)
+    
+    content_type, length, blocks = davutils.multipart_byteranges(
+        infile, ranges, info.size, content_type)
+    start_response('206 Partial Content',
+        [('Content-Type', content_type),
+         ('Content-Length', str(length))] + headers)
+    return davutils.ClosingIterator(blocks, infile.close)
 
 def handle_mkcol(reqinfo, start_response):
     '''Create a new directory.'''
@@ -313,18 +875,21 @@ def handle_mkcol(reqinfo, start_response):
         raise DAVError('405 Method Not Allowed: Collection already exists')
 
     os.mkdir(real_path)
+    propfind_cache.invalidate(real_path)
     
     start_response('201 Created', [])
     return ""
 
 def purge_locks(lockmanager, real_path):
     '''Remove all locks when a resource is moved or removed.'''
-    rel_path = davutils.get_relpath(real_path, config.root_dir)
-    
-    for lock in lockmanager.get_locks(rel_path, True):
-        if not davutils.path_inside_directory(lock.path, rel_path):
-            continue
-        lockmanager.release_lock(lock.path, lock.urn)
+    if lockmanager:
+        lockmanager.release_subtree(
+            davutils.get_relpath(real_path, config.root_dir))
+
+def purge_properties(propertystore, real_path):
+    '''Remove the dead properties of a removed resource.'''
+    if propertystore:
+        propertystore.delete(davutils.get_relpath(real_path, config.root_dir))
 
 def handle_delete(reqinfo, start_response):
     '''Delete a file or a directory.'''
@@ -338,11 +903,14 @@ def handle_delete(reqinfo, start_response):
         raise DAVError('404 Not Found')
     
     if os.path.isdir(real_path):
-        shutil.rmtree(real_path)
+        trash.remove(real_path, reqinfo.environ.get('wsgi.run_once', False))
     else:
         os.unlink(real_path)
+        gzip_cache.remove_sidecar(real_path)
     
+    propfind_cache.invalidate(real_path)
     purge_locks(reqinfo.lockmanager, real_path)
+    purge_properties(reqinfo.propertystore, real_path)
     
     start_response('204 No Content', [])
     return ""
@@ -358,25 +926,44 @@ def handle_copy_move(reqinfo, start_response):
     if not new_resource:
         if not reqinfo.get_overwrite():
             raise DAVError('412 Precondition Failed: Would overwrite')
-        elif os.path.isdir(real_dest):
-            shutil.rmtree(real_dest)
-        else:
-            os.unlink(real_dest)
+        propfind_cache.invalidate(real_dest)
     
     if reqinfo.environ['REQUEST_METHOD'] == 'COPY':
+        if not new_resource:
+            trash.remove(real_dest, reqinfo.environ.get('wsgi.run_once', False))
+            gzip_cache.remove_sidecar(real_dest)
+        
         if os.path.isdir(real_source):
             if depth == 0:
                 os.mkdir(real_dest)
                 shutil.copystat(real_source, real_dest)
             else:
-                shutil.copytree(real_source, real_dest, symlinks = True)
+                fileops.copy_tree(real_source, real_dest, config.copy_threads)
         else:
-            shutil.copy2(real_source, real_dest)
+            fileops.copy_file(real_source, real_dest)
     else:
+        # An overwritten destination is replaced only once the source
+        # has been moved or copied to the destination file system.
         real_source = reqinfo.get_request_path('wd')
-        shutil.move(real_source, real_dest)
+        fileops.move(real_source, real_dest, config.copy_threads)
+        gzip_cache.remove_sidecar(real_source)
+        if not new_resource:
+            gzip_cache.remove_sidecar(real_dest)
+        propfind_cache.invalidate(real_source)
         purge_locks(reqinfo.lockmanager, real_source)
     
+    # Dead properties follow the resource, replacing those of any
+    # overwritten destination.
+    if reqinfo.propertystore:
+        rel_source = davutils.get_relpath(real_source, config.root_dir)
+        rel_dest = davutils.get_relpath(real_dest, config.root_dir)
+        if reqinfo.environ['REQUEST_METHOD'] == 'COPY':
+            reqinfo.propertystore.copy(rel_source, rel_dest, depth != 0)
+        else:
+            reqinfo.propertystore.move(rel_source, rel_dest)
+    
+    propfind_cache.invalidate(real_dest)
+    
     if new_resource:
         start_response('201 Created', [])
     else:
@@ -406,15 +993,14 @@ def handle_lock(reqinfo, start_response):
     if not os.path.exists(real_path):
         status = "201 Created"
         open(real_path, 'w').write('')
+        propfind_cache.invalidate(real_path)
     else:
         status = "200 OK"
     
     start_response(status,
         [('Content-Type', 'text/xml; charset=utf-8'),
          ('Lock-Token', lock.urn)])
-    t = activelock.Template(lock = lock, reqinfo = reqinfo,
-        part_only = False)
-    return [t.serialize(output = 'xml')]
+    return [davxml.lock_response(lock, reqinfo.root_url)]
 
 def handle_unlock(reqinfo, start_response):
     '''Remove an existing lock.'''
@@ -453,28 +1039,74 @@ def handle_dirindex(reqinfo, start_response, message = None):
     except DAVError:
         can_write = False
     
-    files = os.listdir(real_path)
-    for filename in files:
-        try:
-            reqinfo.assert_read(os.path.join(real_path, filename))
-        except DAVError, e:
-            if e.httpstatus.startswith('403'):
-                files.remove(filename) # Remove forbidden files from listing
+    # Remove forbidden files from listing
+    prune = lambda info: not reqinfo.is_readable(info.path, info)
+    files = list(davutils.list_directory(real_path, prune, ordered = True))
+    files.sort(key = lambda info: not info.isdir)
     
-    files.sort(key = lambda f: not os.path.isdir(os.path.join(real_path, f)))
+    headers = [('Content-Type', 'text/html; charset=utf-8')]
     
-    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
-    t = dirindex.Template(
+    if message is None:
+        # Weak validators derived from everything shown on the page, so
+        # that browsers can revalidate without the page being rendered.
+        mtime = max([info.mtime for info in files]
+                    + [davutils.ResourceInfo(real_path).mtime])
+        state = repr((__version__, real_url, has_parent, can_write,
+            [(info.name, info.isdir, info.size, info.mtime) for info in files]))
+        etag = 'W/"' + hashlib.md5(state).hexdigest() + '"'
+        
+        if reqinfo.check_conditions(etag, mtime):
+            return not_modified(start_response, etag, mtime)
+        
+        headers += [('Etag', etag),
+                    ('Last-Modified', davutils.get_rfcformat(mtime))]
+    
+    start_response('200 OK', headers)
+    
+    if reqinfo.environ['REQUEST_METHOD'] == 'HEAD':
+        return ''
+    
+    t = get_dirindex().Template(
         real_url = real_url, real_path = real_path, reqinfo = reqinfo,
         files = files, has_parent = has_parent, message = message,
         can_write = can_write
     )
     return [t.serialize(output = 'xhtml')]
 
+def generate_zip(reqinfo, file_paths):
+    '''Generate a ZIP archive of the files and directory trees at
+    file_paths while reading them. Names in the archive are relative
+    to root_dir, and files the user can't read are left out.
+    '''
+    import zipstream
+    
+    pool = None
+    if config.zip_threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(config.zip_threads)
+    
+    try:
+        zipper = zipstream.ZipStream(pool, config.zip_threads)
+        prune = lambda info: not reqinfo.is_readable(info.path, info)
+        for file_path in file_paths:
+            for info in davutils.walk_directory(file_path, prune = prune):
+                name = davutils.get_relpath(info.path, config.root_dir)
+                for data in zipper.add(info, name):
+                    yield data
+        
+        for data in zipper.close():
+            yield data
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 def handle_post(reqinfo, start_response):
     '''Handle a POST request.
     Used for file uploads and deletes in the HTML GUI.
     '''
+    # Imported here to keep the startup fast for the other requests.
+    import cgi
+    
     if 'w' not in config.html_interface:
         raise DAVError('403 HTML interface is configured as read-only')
     
@@ -482,65 +1114,48 @@ def handle_post(reqinfo, start_response):
     real_path = reqinfo.get_request_path('r')
     message = ""
     
+    # File names in the form are UTF-8, while real_path is unicode.
+    try:
+        filenames = [unicode(f, 'utf-8') for f in fields.getlist('select')]
+        if fields.getfirst('file'):
+            upload_name = unicode(fields['file'].filename, 'utf-8')
+    except UnicodeDecodeError:
+        raise DAVError('400 Bad Request: File name is not UTF-8')
+    
     if fields.getfirst('file'):
-        f = fields['file']
-        dest_path = os.path.join(real_path, f.filename)
+        dest_path = os.path.join(real_path, upload_name)
         reqinfo.assert_write(dest_path)
         
         if os.path.isdir(dest_path):
             raise DAVError('405 Method Not Allowed: Overwriting directory')
     
-        if os.path.exists(dest_path):
-            os.unlink(dest_path)
-        
-        outfile = open(dest_path, 'wb')
-        davutils.write_blocks(outfile, davutils.read_blocks(f.file))
+        write_file(dest_path, fields['file'].file)
+        propfind_cache.invalidate(dest_path)
         
-        message = "Successfully uploaded " + f.filename + "."
+        message = "Successfully uploaded " + upload_name + "."
     
     if fields.getfirst('btn_remove'):
-        filenames = fields.getlist('select')
-        
         for f in filenames:
             rm_path = os.path.join(real_path, f)
             reqinfo.assert_write(rm_path)
             
-            if os.path.isdir(rm_path):
-                shutil.rmtree(rm_path)
-            else:
-                os.unlink(rm_path)
+            trash.remove(rm_path, reqinfo.environ.get('wsgi.run_once', False))
+            gzip_cache.remove_sidecar(rm_path)
+            propfind_cache.invalidate(rm_path)
+            purge_properties(reqinfo.propertystore, rm_path)
         
         message = "Successfully removed " + str(len(filenames)) + " files."
     
     if fields.getfirst('btn_download'):
-        filenames = fields.getlist('select')
-        datafile = tempfile.TemporaryFile()
-        zipobj = zipfile.ZipFile(datafile, 'w', zipfile.ZIP_DEFLATED, True)
-        
-        def check_read(path):
-            '''Callback function for zipping to verify that each file in
-            the zip has access rights.'''
-            try:
-                reqinfo.assert_read(path)
-                return True
-            except DAVError:
-                return False
-        
-        for f in filenames:
-            file_path = os.path.join(real_path, f)
+        file_paths = [os.path.join(real_path, f) for f in filenames]
+        for file_path in file_paths:
             reqinfo.assert_read(file_path)
-            davutils.add_to_zip_recursively(zipobj, file_path,
-                config.root_dir, check_read)
-        
-        zipobj.close()
         
-        start_response('200 OK', [
-            ('Content-Type', 'application/zip'),
-            ('Content-Length', str(datafile.tell()))
-        ])
+        # The length of the archive is not known in advance, so the server
+        # sends it with chunked encoding or closes the connection after it.
+        start_response('200 OK', [('Content-Type', 'application/zip')])
         
-        datafile.seek(0)
-        return davutils.read_blocks(datafile)
+        return generate_zip(reqinfo, file_paths)
     
     return handle_dirindex(reqinfo, start_response, message)
 
@@ -614,6 +1229,7 @@ def main(environ, start_response):
         return [exc]
 
 if __name__ == '__main__':
-    from wsgiref.simple_server import make_server
+    from wsgi_server import make_server
+    trash.start_reaper()
     server = make_server('localhost', 8080, main)
     server.serve_forever()
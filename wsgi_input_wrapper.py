@@ -23,6 +23,8 @@ class WSGIInputWrapper:
         self.length = self.get_length(environ)
         self.bytes_read = 0
         self.wsgi_input = environ['wsgi.input']
+        if hasattr(self.wsgi_input, 'readinto'):
+            self.readinto = self._readinto
     
     def get_length(self, environ):
         '''Get length of request body or -1 if the client uses chunked encoding.
@@ -57,6 +59,26 @@ class WSGIInputWrapper:
         self.bytes_read += len(result)
         return result
 
+    def _readinto(self, buffer):
+        '''Read up to len(buffer) bytes into a writable buffer, such as
+        a bytearray, and return the number of bytes read. Available as
+        readinto() only when wsgi.input supports it, because otherwise
+        reading into a buffer would only add a copy.
+        '''
+        count = len(buffer)
+        if self.length != -1:
+            count = max(0, min(count, self.length - self.bytes_read))
+        
+        if count == 0:
+            return 0
+        
+        if count < len(buffer):
+            buffer = memoryview(buffer)[:count]
+        result = self.wsgi_input.readinto(buffer)
+        
+        self.bytes_read += result
+        return result
+    
     def readline(self, size = -1):
         result = self.wsgi_input.readline(size)
         self.bytes_read += len(result)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''Stand-alone WSGI server used when webdav.py is run directly.
+
+This is wsgiref.simple_server with support for sending files with the
+sendfile() system call. Responses returned through wsgi.file_wrapper
+are copied from the file to the socket by the kernel, without passing
+the data through Python strings.
+'''
+
+import os
+import sys
+from wsgiref.simple_server import (ServerHandler, WSGIRequestHandler,
+    WSGIServer)
+
+import davutils
+
+def _find_sendfile():
+    '''Return a function sendfile(out_fd, in_fd, offset, count) that
+    returns the number of bytes sent, or None if it is not available.
+    Python 2 has no os.sendfile, so on Linux it is called through ctypes.
+    '''
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno = True)
+        function = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    
+    function.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_long
+    
+    def sendfile(out_fd, in_fd, offset, count):
+        position = ctypes.c_int64(offset)
+        result = function(out_fd, in_fd, ctypes.byref(position), count)
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+    
+    return sendfile
+
+sendfile = _find_sendfile()
+
+# Largest count accepted by sendfile() on Linux.
+MAX_SENDFILE = 0x7ffff000
+
+class SendfileHandler(ServerHandler):
+    '''Server handler that transmits wrapped files with sendfile().'''
+    def sendfile(self):
+        filelike = self.result.filelike
+        
+        if isinstance(filelike, davutils.FileRange):
+            infile = filelike.source
+            offset = filelike.offset
+            remaining = filelike.count
+        elif hasattr(filelike, 'fileno'):
+            infile = filelike
+            offset = filelike.tell()
+            remaining = None
+        else:
+            return False
+        
+        try:
+            in_fd = infile.fileno()
+            out_fd = self.stdout.fileno()
+        except (AttributeError, IOError):
+            return False
+        
+        if sendfile is None:
+            return False
+        
+        if remaining is None:
+            remaining = max(0, os.fstat(in_fd).st_size - offset)
+        
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        
+        while remaining > 0:
+            sent = sendfile(out_fd, in_fd, offset, min(remaining, MAX_SENDFILE))
+            if sent == 0:
+                break # File was truncated while sending
+            offset += sent
+            remaining -= sent
+        
+        return True
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    '''Request handler that uses SendfileHandler for the responses.'''
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        
+        if not self.parse_request():
+            return
+        
+        handler = SendfileHandler(self.rfile, self.wfile,
+            self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+def make_server(host, port, app, handler_class = SendfileRequestHandler):
+    '''Create a WSGIServer for app, like wsgiref.simple_server.make_server.'''
+    server = WSGIServer((host, port), handler_class)
+    server.set_app(app)
+    return server
+
+if __name__ == '__main__':
+    import httplib
+    import tempfile
+    import threading
+    print "Unit tests"
+    
+    data = ''.join([chr(i % 251) for i in range(300000)])
+    datafiles = []
+    
+    # Record the calls to the real sendfile
+    calls = []
+    real_sendfile = sendfile
+    if real_sendfile is not None:
+        def sendfile(*args):
+            calls.append(args)
+            return real_sendfile(*args)
+    
+    def app(environ, start_response):
+        datafile = tempfile.TemporaryFile()
+        datafile.write(data)
+        datafiles.append(datafile)
+        
+        start_response('200 OK', [])
+        if environ['PATH_INFO'] == '/range':
+            body = davutils.FileRange(datafile, 1000, 200000)
+        else:
+            datafile.seek(5)
+            body = datafile
+        return environ['wsgi.file_wrapper'](body)
+    
+    class QuietHandler(SendfileRequestHandler):
+        def log_message(self, *args):
+            pass
+    
+    server = make_server('127.0.0.1', 0, app, QuietHandler)
+    thread = threading.Thread(target = server.handle_request)
+    thread.start()
+    
+    connection = httplib.HTTPConnection('127.0.0.1', server.server_port)
+    connection.request('GET', '/range')
+    assert connection.getresponse().read() == data[1000:201000]
+    thread.join()
+    
+    thread = threading.Thread(target = server.handle_request)
+    thread.start()
+    connection = httplib.HTTPConnection('127.0.0.1', server.server_port)
+    connection.request('GET', '/')
+    assert connection.getresponse().read() == data[5:]
+    thread.join()
+    
+    assert datafiles[0].closed and datafiles[1].closed
+    assert real_sendfile is None or len(calls) >= 2
+    server.server_close()
+    
+    print "Unit tests OK"
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+'''Streaming ZIP archive writer for the download function of the HTML
+interface.
+
+The archive is generated as a series of strings while the files are read,
+so nothing is written to disk and the first bytes are sent immediately.
+Because the compressed size and CRC of each file are known only after
+compressing it, they are written in a data descriptor after the file data
+(general purpose flag bit 3). Files, archives and offsets beyond 4 GB use
+the ZIP64 extensions.
+
+Optionally the deflate compression runs in a pool of worker threads.
+Each file is then split into blocks that are compressed independently and
+joined with sync flushes into a single deflate stream, like pigz does.
+Zlib releases the interpreter lock while compressing, so the blocks are
+compressed in parallel.
+'''
+
+import collections
+import os.path
+import struct
+import time
+import zlib
+
+import davutils
+
+# Files with these extensions are already compressed, so they are stored
+# instead of deflated.
+STORED_EXTENSIONS = set([
+    '.7z', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jar', '.jpeg',
+    '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.odp', '.ods',
+    '.odt', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp',
+    '.xlsx', '.xz', '.zip', '.zst',
+])
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Flag bits: sizes in data descriptor, UTF-8 file name
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+# Files larger than this use ZIP64 sizes. The margin allows for the growth
+# of incompressible data in deflate.
+ZIP64_FILE_LIMIT = 0xFFFFFFFF - (1 << 24)
+ZIP64_LIMIT = 0xFFFFFFFF
+
+def dos_datetime(timestamp):
+    '''Return the (time, date) fields of a ZIP header for a timestamp.'''
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1 # 1980-01-01
+    
+    dostime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dosdate = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dostime, dosdate
+
+def _compress_block(data):
+    '''Compress a block into raw deflate data that ends on a byte
+    boundary, so that blocks can be concatenated. Runs in worker threads.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class ZipStream:
+    '''Generates a ZIP archive. Add entries with add() and finish the
+    archive with close(). Both return iterators of strings to send.
+    
+    Pool is an optional multiprocessing.pool.ThreadPool for compressing
+    with threads count workers.
+    '''
+    def __init__(self, pool = None, threads = 1, blocksize = 1024*1024):
+        self.pool = pool
+        self.threads = threads
+        self.blocksize = blocksize
+        self.offset = 0
+        self.entries = []
+    
+    def add(self, info, arcname):
+        '''Yield the local header, data and data descriptor for the file
+        or directory described by the ResourceInfo info. Arcname is the
+        name of the entry in the archive, either unicode or a UTF-8 byte
+        string. Files that can't be read are left out.
+        '''
+        if isinstance(arcname, str):
+            arcname = arcname.decode('utf-8', 'replace')
+        
+        if info.isdir:
+            arcname = arcname.rstrip('/') + '/'
+            infile = None
+            method = ZIP_STORED
+        else:
+            try:
+                infile = open(info.path, 'rb')
+            except IOError:
+                return
+            
+            extension = os.path.splitext(info.path)[1].lower()
+            if extension in STORED_EXTENSIONS:
+                method = ZIP_STORED
+            else:
+                method = ZIP_DEFLATED
+        
+        name = arcname.encode('utf-8')
+        flags = FLAG_DATA_DESCRIPTOR
+        if name != arcname.encode('ascii', 'replace'):
+            flags |= FLAG_UTF8
+        
+        entry = {
+            'name': name,
+            'flags': flags,
+            'method': method,
+            'datetime': dos_datetime(info.mtime),
+            'offset': self.offset,
+            'zip64': info.size > ZIP64_FILE_LIMIT,
+            'mode': info.stat.st_mode,
+            'isdir': info.isdir,
+        }
+        
+        try:
+            yield self._write(self._local_header(entry))
+            
+            crc = 0
+            size = 0
+            compressed_size = 0
+            if infile is not None:
+                # Read no more than the original size, which decided
+                # whether ZIP64 is needed.
+                for data, block in self._file_data(infile, info.size, method):
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    compressed_size += len(data)
+                    if data:
+                        yield self._write(data)
+        finally:
+            if infile is not None:
+                infile.close()
+        
+        entry['crc'] = crc & 0xFFFFFFFF
+        entry['size'] = size
+        entry['compressed_size'] = compressed_size
+        
+        if entry['zip64']:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, entry['crc'],
+                                     compressed_size, size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, entry['crc'],
+                                     compressed_size, size)
+        yield self._write(descriptor)
+        self.entries.append(entry)
+    
+    def _write(self, data):
+        '''Account for data written to the archive.'''
+        self.offset += len(data)
+        return data
+    
+    def _file_data(self, infile, count, method):
+        '''Yield tuples (data to write, uncompressed block) for a file.'''
+        blocks = davutils.read_blocks(infile, count, self.blocksize)
+        
+        if method == ZIP_STORED:
+            for block in blocks:
+                yield block, block
+        elif self.pool is None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            for block in blocks:
+                yield compressor.compress(block), block
+            yield compressor.flush(), ''
+        else:
+            # Keep a limited number of blocks in the workers at a time,
+            # so that large files are not read to memory.
+            pending = collections.deque()
+            for block in blocks:
+                pending.append((self.pool.apply_async(_compress_block,
+                                                      (block, )), block))
+                if len(pending) > self.threads * 2:
+                    result, block = pending.popleft()
+                    yield result.get(), block
+            
+            while pending:
+                result, block = pending.popleft()
+                yield result.get(), block
+            
+            # Empty final block ends the deflate stream.
+            yield zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS).flush(), ''
+    
+    def _local_header(self, entry):
+        '''Return the local file header for an entry.'''
+        dostime, dosdate = entry['datetime']
+        if entry['zip64']:
+            version = 45
+            sizes = ZIP64_LIMIT
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        else:
+            version = 20
+            sizes = 0
+            extra = ''
+        
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version,
+            entry['flags'], entry['method'], dostime, dosdate,
+            0, sizes, sizes, len(entry['name']), len(extra)) \
+            + entry['name'] + extra
+    
+    def _central_header(self, entry):
+        '''Return the central directory header for an entry.'''
+        dostime, dosdate = entry['datetime']
+        sizes = [entry['size'], entry['compressed_size'], entry['offset']]
+        
+        # Values too large for the header go in the ZIP64 extra field
+        # in this order.
+        extra_values = [value for value in sizes if value >= ZIP64_LIMIT]
+        sizes = [min(value, ZIP64_LIMIT) for value in sizes]
+        if extra_values or entry['zip64']:
+            version = 45
+        else:
+            version = 20
+        
+        extra = ''
+        if extra_values:
+            extra = struct.pack('<HH', 1, 8 * len(extra_values))
+            extra += struct.pack('<' + 'Q' * len(extra_values), *extra_values)
+        
+        attributes = (entry['mode'] & 0xFFFF) << 16
+        if entry['isdir']:
+            attributes |= 0x10 # MS-DOS directory flag
+        
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+            (3 << 8) | 45, version, entry['flags'], entry['method'],
+            dostime, dosdate, entry['crc'], sizes[1], sizes[0],
+            len(entry['name']), len(extra), 0, 0, 0, attributes & 0xFFFFFFFF,
+            sizes[2]) + entry['name'] + extra
+    
+    def close(self):
+        '''Yield the central directory that ends the archive.'''
+        start = self.offset
+        for entry in self.entries:
+            yield self._write(self._central_header(entry))
+        
+        size = self.offset - start
+        count = len(self.entries)
+        
+        if count >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end64 = self.offset
+            yield self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44,
+                (3 << 8) | 45, 45, 0, 0, count, count, size, start))
+            yield self._write(struct.pack('<IIQI', 0x07064b50, 0, end64, 1))
+        
+        yield self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+            min(count, 0xFFFF), min(count, 0xFFFF),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import zipfile
+    from multiprocessing.pool import ThreadPool
+    from StringIO import StringIO
+    print "Unit tests"
+    
+    tmpdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(tmpdir, 'dir'))
+    data = ''.join([chr(i % 251) for i in range(300000)]) * 3
+    open(os.path.join(tmpdir, 'dir', 'text.txt'), 'wb').write('hello ' * 10000)
+    open(os.path.join(tmpdir, 'dir', 'data.bin'), 'wb').write(data)
+    open(os.path.join(tmpdir, 'dir', 'photo.jpg'), 'wb').write(data)
+    open(os.path.join(tmpdir, 'dir', u'\xe4.txt'.encode('utf-8')), 'wb').write('')
+    
+    # Byte string paths, and unicode paths as used by webdav.py
+    pool = ThreadPool(2)
+    for zipper, root in [(ZipStream(), tmpdir),
+                         (ZipStream(pool, 2, 100000), unicode(tmpdir))]:
+        parts = []
+        for info in davutils.walk_directory(os.path.join(root, 'dir')):
+            name = davutils.get_relpath(info.path, root)
+            parts.extend(zipper.add(info, name))
+        parts.extend(zipper.close())
+        
+        archive = zipfile.ZipFile(StringIO(''.join(parts)))
+        assert archive.testzip() is None
+        assert archive.read('dir/data.bin') == data
+        assert archive.read('dir/text.txt') == 'hello ' * 10000
+        assert archive.getinfo('dir/photo.jpg').compress_type == ZIP_STORED
+        assert archive.getinfo('dir/text.txt').compress_size < 1000
+        assert archive.getinfo('dir/').external_attr & 0x10
+        assert archive.read(u'dir/\xe4.txt') == ''
+    pool.close()
+    
+    # ZIP64 end of central directory records
+    zipper = ZipStream()
+    zipper.offset = ZIP64_LIMIT + 10
+    info = davutils.ResourceInfo(os.path.join(tmpdir, 'dir', 'text.txt'))
+    parts = list(zipper.add(info, u'text.txt'))
+    header = zipper._central_header(zipper.entries[0])
+    assert header[-12:-8] == struct.pack('<HH', 1, 8)
+    end = ''.join(zipper.close())
+    assert end[-98:-94] == struct.pack('<I', 0x06064b50)
+    
+    assert dos_datetime(0) == (0, 33)
+    
+    shutil.rmtree(tmpdir)
+    
+    print "Unit tests OK"